@@ -8,16 +8,21 @@ Usage:
     uvicorn agentcompass_service_fastapi:app --host 0.0.0.0 --port 8080 --workers 4
 
 Features:
-- Synchronous execution (no threading/multiprocessing complexity)
-- Multiple workers for concurrent request handling
-- Each CKAgent runs in worker process main thread (no signal issues)
+- Synchronous API (the result is returned with the response)
+- Each CKAgent runs in a thread of the worker's threadpool (the code execution timeout is signal-free),
+  so one worker can serve multiple tasks concurrently; multiple workers can still be used
+- Each task has a cancel token (with the time limit), which is cancelled if the client disconnects
+  (polled while the task is running, since uvicorn does not cancel a running handler on disconnection),
+  so that the sub-agents, LLM calls and browser requests stop promptly
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
 import os
 import sys
+import asyncio
 
 # Ensure repo root is on sys.path
 _REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
@@ -54,7 +59,16 @@ for _cand in (os.path.join(os.getcwd(), ".env"), os.path.join(os.path.dirname(__
         _load_env_file(_cand)
         break
 
+# Optionally load the shared tokenizer at import time (e.g., PRELOAD_TOKENIZER=Qwen/Qwen3-32B).
+# With a preloading server (e.g., gunicorn --preload), this happens once before workers fork;
+# otherwise each worker loads it at startup instead of at its first request.
+_preload_tokenizer = os.getenv("PRELOAD_TOKENIZER", "")
+if _preload_tokenizer:
+    from ck_pro.agents.model import preload_shared_tokenizer
+    preload_shared_tokenizer(_preload_tokenizer if _preload_tokenizer not in ("1", "true", "True") else "Qwen/Qwen3-32B")
+
 app = FastAPI(title="CognitiveKernel-Pro Service", version="1.0.0")
+DISCONNECT_POLL_INTERVAL = 1.0  # seconds between the checks of the client's disconnection
 
 class TaskRequest(BaseModel):
     params: Optional[Dict[str, Any]] = None
@@ -217,7 +231,7 @@ def _apply_default_subagents(ck_kwargs: dict, modality: str) -> dict:
     return ck_kwargs
 
 @app.post("/api/tasks", response_model=TaskResponse)
-async def run_task(request: TaskRequest):
+async def run_task(request: TaskRequest, http_request: Request):
     """Run CKAgent synchronously and return result immediately."""
     payload = request.model_dump()
 
@@ -243,14 +257,28 @@ async def run_task(request: TaskRequest):
         if input_file:
             task_text = f"{prompt}\n(* You are given the following input file: {input_file})"
 
-        # Import and run CKAgent (in worker process main thread - no signal issues)
+        # Import and run CKAgent (in a threadpool thread, not blocking the event loop)
         from ck_pro.ck_main.agent import CKAgent
         llm_cfg = payload.get('llm_config')
         ck_kwargs = _ck_kwargs_from_llm_config(llm_cfg)
         ck_kwargs = _apply_default_subagents(ck_kwargs, modality)
 
         agent = CKAgent(**ck_kwargs) if ck_kwargs else CKAgent()
-        res = agent.run(task_text)
+        from ck_pro.agents.cancel import CancelToken
+        cancel_token = CancelToken(timeout=agent.max_time_limit)
+        run_future = asyncio.ensure_future(run_in_threadpool(agent.run, task_text, cancel_token=cancel_token))
+        try:
+            while not run_future.done():  # check for the client's disconnection while waiting
+                await asyncio.wait([run_future], timeout=DISCONNECT_POLL_INTERVAL)
+                if not run_future.done() and not cancel_token.cancelled and await http_request.is_disconnected():
+                    rprint(f"Client disconnected, cancel the task: {prompt[:100]}", style="white on red")
+                    cancel_token.cancel("client disconnected")  # note: still wait for the (quick) finalization
+            res = run_future.result()
+        except asyncio.CancelledError:  # the handler itself is cancelled (such as at shutdown): also stop the running task
+            cancel_token.cancel("request cancelled")
+            raise
+        finally:
+            agent.close()  # note: the agent (with its mrun workers and executors) is created for each request
         # Collect token usage statistics and attach to session/info
         call_stat = agent.get_call_stat(clear=True)
         raw_sess = res.to_dict() if hasattr(res, 'to_dict') else {}
@@ -300,6 +328,12 @@ async def health_check():
     """Health check endpoint."""
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def endpoint_metrics():
+    """States of the LLM endpoint controllers (in this worker process)."""
+    from ck_pro.agents.endpoint import EndpointController
+    return {"endpoints": EndpointController.get_all_metrics()}
+
 if __name__ == "__main__":
     import uvicorn
     import argparse
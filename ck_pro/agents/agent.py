@@ -7,18 +7,40 @@ __all__ = [
     "AgentResult", "ActionResult", "MultiStepAgent"
 ]
 
+import os
+import re
+import glob
 import json
+import pickle
+import hashlib
 import traceback
 import time
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
 from typing import List
 from collections import Counter
 from .model import LLM
 from .session import AgentSession
 from .tool import Tool
+from .sandbox import SandboxPool
+from .cancel import CancelToken, TaskCancelledError, get_cancel_token, set_cancel_token, reset_cancel_token, new_child_cancel_token
+from .trace import Tracer, start_span, trace_span, set_current_span, reset_current_span
 from .utils import KwargsInitializable, rprint, TemplatedString, parse_response, CodeExecutor, zwarn
 
 TEMPLATES = {}
 
+_SPEC_EXECUTOR_LOCK = threading.Lock()
+
+# the routing key of the running step (inherited by the sub-agents called in the action code)
+_CURRENT_AFFINITY_KEY = contextvars.ContextVar("ck_affinity_key", default=None)
+# the session of the running step's action (the same agent can run multiple sessions concurrently, for example, with the parallel tool)
+_CURRENT_SESSION_ID = contextvars.ContextVar("ck_session_id", default=None)
+# the checkpoint key prefix of the running step's action (the sub-agents called in it get derived keys, so that they can also be resumed)
+_CURRENT_CHECKPOINT_SCOPE = contextvars.ContextVar("ck_checkpoint_scope", default=None)
+_CHECKPOINT_SCOPE_LOCK = threading.Lock()
+
 def register_template(templates):
     for k, v in templates.items():
         # assert k not in TEMPLATES
@@ -70,9 +92,51 @@ class StopReasons:
     NORMAL_END = "Normal Ending."
     MAX_STEP = "Max step exceeded."
     MAX_TIME = "Time limit exceeded."
+    CANCELLED = "Task cancelled."
 
 CODE_ERROR_PERFIX = "Code Execution Error:\n"
 
+# --
+# fused plan+action: one call to update the progress state and predict the action
+FUSED_ACTION_SEP = "Action Thought:"
+FUSED_OUTPUT_STR = """## Output
+In this step, you serve as both the planning module and the action module: first update the progress state, and then generate the next action based on the updated progress state. Please generate your response, your reply should strictly follow the format:
+Thought: {Provide an explanation for your planning in one line. Begin with a concise review of the previous steps to provide context. Next, describe any new observations or relevant information obtained since the last step. Finally, clearly explain your reasoning and the rationale behind your current output or decision.}
+Code: {Then, output your python dict of the updated progress state. Remember to wrap the code with "```python ```" marks.}
+Action Thought: {Provide an explanation for your action in one line, following the updated progress state.}
+Action Code: {Then, output your python code blob for the next action to execute. Remember that you should issue **ONLY ONE** action for the current step. Remember to wrap the code with "```python ```" marks.}
+"""
+
+# combine the plan and action messages: both system prompts + the action's user inputs (with the output section replaced)
+def fuse_plan_action_messages(plan_messages, action_messages):
+    _plan_sys = "\n".join([m["content"] for m in plan_messages if m["role"] == "system"])
+    _action_sys = "\n".join([m["content"] for m in action_messages if m["role"] == "system"])
+    sys_str = f"# Part 1: Planning Module\n\n{_plan_sys}\n\n# Part 2: Action Module\n\n{_action_sys}\n"
+    ret = [{"role": "system", "content": sys_str}]
+    for message in action_messages:
+        if message["role"] == "system":
+            continue
+        _content = message["content"]
+        if message["role"] == "user":
+            if isinstance(_content, str):
+                _content = _replace_output_section(_content)
+            else:  # find the text piece with the output section
+                _content = [dict(z) for z in _content]
+                _texts = [z for z in _content if z.get("type") == "text" and "## Output" in z.get("text", "")]
+                if _texts:
+                    _texts[-1]["text"] = _replace_output_section(_texts[-1]["text"])
+                else:
+                    _content.append({"type": "text", "text": "\n\n" + FUSED_OUTPUT_STR})
+        ret.append({**message, "content": _content})
+    return ret
+
+def _replace_output_section(s: str):
+    _matches = list(re.finditer(r"## Output\n.*?(?=\n\n## |\Z)", s, flags=re.DOTALL))
+    if not _matches:
+        return s + "\n\n" + FUSED_OUTPUT_STR
+    _m = _matches[-1]
+    return s[:_m.start()] + FUSED_OUTPUT_STR + s[_m.end():]
+
 # --
 # a basic class for a multi-step agent
 class MultiStepAgent(KwargsInitializable):
@@ -88,21 +152,55 @@ class MultiStepAgent(KwargsInitializable):
         self.max_time_limit = 0  # early stop if exceeding this time (in seconds)
         self.recent_steps = 5  # feed recent steps
         self.store_io = True  # whether store the inputs/outputs of the model in session
+        self.compact_io = False  # store the inputs in a compact encoding (shared segments of the session, see AgentSession.encode_io)
         self.exec_timeout_with_call = 0  # how many seconds to timeout for each exec (0 means no timeout) (with sub-agent call)
         self.exec_timeout_wo_call = 0  # how many seconds to timeout for each exec (0 means no timeout) (without sub-agent call)
         self.obs_max_token = 8192  # avoid obs that is too long
+        self.fuse_plan_action = False  # use one LLM call to predict both the plan (state update) and the action
+        self.sandbox = SandboxPool(_default_init=True)  # (optionally) execute the action code in sandbox processes
+        self.speculate_action = False  # start the action call with the previous state together with the plan call (kept if the action inputs turn out the same)
+        self.checkpoint_dir = ""  # if not empty, save a checkpoint after each step for the runs with a checkpoint_key (and resume from it)
+        self.enable_trace = False  # trace the spans of the top-level runs (stored at session.info["trace"]), the sub-agents are traced if the caller is traced
+        self.trace_dir = ""  # if not empty, also save the Chrome trace file of each top-level run there
         # --
         self.active_functions = []  # note: put active functions here!
         # --
         super().__init__(**kwargs)
         self.templates = {k: get_template(v) for k, v in self.templates.items()}  # read real templates from registered ones
+        if self.checkpoint_dir:
+            self.checkpoint_dir = os.path.abspath(self.checkpoint_dir)  # note: the running dir may be changed later
+        if self.trace_dir:
+            self.trace_dir = os.path.abspath(self.trace_dir)
+        for agent in self.sub_agents:  # note: the sub-agents save their checkpoints in the same dir (if not specified)
+            if self.checkpoint_dir and not agent.checkpoint_dir:
+                agent.checkpoint_dir = self.checkpoint_dir
         # self.python_executor = CodeExecutor()  # our own simple python executor (simply recreate it for each run!)
         ALL_FUNCTIONS = {z.name: z for z in (self.sub_agents + self.tools)}
         assert len(ALL_FUNCTIONS) == len(self.sub_agents + self.tools), "There may be repeated function names of sub-agents and tools."
         self.ACTIVE_FUNCTIONS = {k: ALL_FUNCTIONS[k] for k in self.active_functions}
-        self.final_result = None  # to store final result
+        self._final_results = {}  # session-id -> final result
+        self._subagent_tool_strs = None  # (signature of the functions, cached definition strs)
+        self._step_strs = {}  # session-id -> {step_idx: (action, formatted str)}
+        self._spec_executor = None  # lazily created for the speculative action calls
         # --
 
+    # note: do not pickle the executor
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        ret["_spec_executor"] = None
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    # release the runtime resources (also for the sub-agents), the agent can still be used later (lazily re-created)
+    def close(self):
+        _executor, self._spec_executor = self._spec_executor, None
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        for agent in self.sub_agents:
+            agent.close()
+
     @property
     def sub_agents(self):  # obtaining the sub-agents by getattr
         return [getattr(self, name) for name in self.sub_agent_names]
@@ -129,6 +227,14 @@ class MultiStepAgent(KwargsInitializable):
                 elif isinstance(vv, MultiStepAgent):
                     vv.set_seed(seed)
 
+    # enable/disable the image optimizers of all the models (including the sub-agents')
+    def set_optimize_images(self, enabled: bool):
+        for kk, vv in self.__dict__.items():
+            if isinstance(vv, LLM):
+                vv.image_optimizer.enabled = enabled
+            elif isinstance(vv, MultiStepAgent):
+                vv.set_optimize_images(enabled)
+
     # called as a managed agent
     # note: the communications/APIs between agents should be simple: INPUT={task, **kwargs}, OUTPUT={output(None if error), log}
     def __call__(self, task: str, **kwargs):
@@ -142,60 +248,162 @@ class MultiStepAgent(KwargsInitializable):
         raise NotImplementedError("To be implemented")
 
     # run as the main agent
-    def run(self, task, stream=False, session=None, max_steps: int = None, **extra_info):
+    # note: the cancel_token is shared with the sub-agents (a new one is created for the top-level task if not given)
+    def run(self, task, stream=False, session=None, max_steps: int = None, cancel_token=None, **extra_info):
         start_pc = time.perf_counter()
         rprint(f"ZZStart task for {self.name} [ctime={time.ctime()}]")
         # init session
+        resume = None
+        if session is None and self.checkpoint_dir and not extra_info.get("checkpoint_key"):  # called inside the step of a checkpointed run?
+            _sub_key = self.get_sub_checkpoint_key(task)
+            if _sub_key:
+                extra_info["checkpoint_key"] = _sub_key
+        if session is None and self.checkpoint_dir and extra_info.get("checkpoint_key"):  # try to resume from the checkpoint
+            resume = self.load_checkpoint(extra_info["checkpoint_key"], task)
+            if resume is not None:
+                session = resume["session"]
         if session is None:
             session = AgentSession(task=task, **extra_info)
+        if "affinity_key" not in session.info:  # sub-agents share the key of the calling session
+            session.info["affinity_key"] = _CURRENT_AFFINITY_KEY.get() or session.id
+        session.info.setdefault("agent", self.name)  # for the analysis
         max_steps = max_steps if max_steps is not None else self.max_steps
+        _parent_token = get_cancel_token()
+        if cancel_token is None:
+            cancel_token = _parent_token if _parent_token is not None else CancelToken(timeout=self.max_time_limit)
+        is_top = (_parent_token is None)  # the top-level one still finalizes (with the LLM calls) after the time limit
         # --
         if stream:  # The steps are returned as they are executed through a generator to iterate on.
-            ret = self.yield_session_run(session=session, max_steps=max_steps)  # return a yielder
+            ret = self.yield_session_run(session=session, max_steps=max_steps, resume=resume, cancel_token=cancel_token, is_top=is_top)  # return a yielder
         else:  # Outputs are returned only at the end. We only look at the last step.
-            for _ in self.yield_session_run(session=session, max_steps=max_steps):
+            for _ in self.yield_session_run(session=session, max_steps=max_steps, resume=resume, cancel_token=cancel_token, is_top=is_top):
                 pass
             ret = session
         rprint(f"ZZEnd task for {self.name} [ctime={time.ctime()}, interval={time.perf_counter()-start_pc}]")
         return ret
 
     # main running loop
-    def yield_session_run(self, session, max_steps):
+    def yield_session_run(self, session, max_steps, resume=None, cancel_token=None, is_top=True):
         # run them!
         start_pc = time.perf_counter()
-        self.init_run(session)  # start
+        if cancel_token is None:
+            cancel_token = CancelToken(timeout=self.max_time_limit)
+        tracer, run_span = None, start_span("agent.run", agent=self.name, session=session.id)
+        if run_span is None and is_top and self.enable_trace:
+            tracer = Tracer()
+            run_span = tracer.start_span("agent.run", agent=self.name, session=session.id)
+        _ctx_token, _ctx_token2 = set_cancel_token(cancel_token), set_current_span(run_span)
+        try:
+            with trace_span("agent.init"):
+                self.init_run(session)  # start
+        finally:
+            reset_cancel_token(_ctx_token)
+            reset_current_span(_ctx_token2)
+        try:
+            yield from self._yield_session_steps(session, max_steps, resume, cancel_token, is_top, start_pc, run_span)
+        finally:  # note: always release the envs (such as the browsers)
+            self.end_run(session)
+            if run_span is not None:
+                run_span.set(num_steps=session.num_of_steps())
+                run_span.end()
+            if tracer is not None:
+                session.info["trace"] = tracer.to_list()
+                if self.trace_dir:
+                    tracer.save(os.path.join(self.trace_dir, f"{session.id}.trace.json"))
+        # --
+
+    def _yield_session_steps(self, session, max_steps, resume, cancel_token, is_top, start_pc, run_span):
         progress_state = {}  # current state
         stop_reason = None
-        while True:
+        if session.steps and not session.stats:  # for example, continuing a session loaded from an older file
+            for _step in session.steps:
+                if "action" in _step:
+                    self._update_step_stats(session, _step["action"])
+        if resume is not None:  # continue from the last finished step
+            progress_state.update(resume["state"])
+            if resume["final_result"] is not None:
+                self._final_results[session.id] = resume["final_result"]
+            self.restore_checkpoint_env(session, resume["env"])
+            rprint(f"Resume the session of {self.name} from step {session.num_of_steps()}", timed=True)
+            if self.step_check_end(session):
+                stop_reason = StopReasons.NORMAL_END
+        while stop_reason is None:
             step_idx = session.num_of_steps()
-            _error_counts = sum(self.get_obs_str(z['action']).strip().startswith(CODE_ERROR_PERFIX) for z in session.steps)
+            _error_counts = session.get_stat("error_steps")
             if (step_idx >= max_steps + _error_counts) or (step_idx >= int(max_steps*1.5)):  # make up for the errors (but avoid too many steps)
                 stop_reason = StopReasons.MAX_STEP  # step limit
                 break
             if (self.max_time_limit > 0) and ((time.perf_counter() - start_pc) > self.max_time_limit):
                 stop_reason = StopReasons.MAX_TIME  # time limit
                 break
+            if cancel_token.cancelled:
+                stop_reason = StopReasons.CANCELLED
+                break
             rprint(f"# ======\nAgent {self.name} -- Step {step_idx}", timed=True)
             _step_info = {"step_idx": step_idx}
             session.add_step(_step_info)  # simply append before running
-            yield from self.step(session, progress_state)
+            step_span = start_span("agent.step", parent=run_span, agent=self.name, step_idx=step_idx)
+            _step_t0 = time.perf_counter()
+            try:
+                yield from _iter_in_context(self.step(session, progress_state), cancel_token, step_span)
+            except TaskCancelledError:  # cancelled in the middle of the step
+                stop_reason = StopReasons.CANCELLED
+                break
+            finally:
+                if step_span is not None:
+                    step_span.end()
+            _timing = _step_info.setdefault("timing", {})
+            with step_timing("serialize", _timing):
+                self.save_checkpoint(session, progress_state)
+            _timing["total"] = round(time.perf_counter() - _step_t0, 6)
             if self.step_check_end(session):
                 stop_reason = StopReasons.NORMAL_END
                 break
+        if cancel_token.cancelled:
+            session.info["abort_reason"] = cancel_token.reason
+            if stop_reason == StopReasons.CANCELLED:
+                stop_reason = f"{stop_reason} ({cancel_token.reason})"
         rprint(f"# ======\nAgent {self.name} -- Stop reason={stop_reason}", timed=True)
-        yield from self.finalize(session, progress_state, stop_reason)  # ending!
-        self.end_run(session)
+        # note: after the time limit, the top-level one still needs the final results (with the LLM calls), while the sub-agents stop as soon as possible;
+        # -- after an explicit cancellation (such as the client disconnecting), nobody waits for the results, so no more calls either
+        finalize_span = start_span("agent.finalize", parent=run_span, agent=self.name, stop_reason=stop_reason)
+        _finalize_token = None if (is_top and (not cancel_token.cancelled or cancel_token.timed_out)) else cancel_token
+        try:
+            yield from _iter_in_context(self.finalize(session, progress_state, stop_reason), _finalize_token, finalize_span)  # ending!
+        finally:
+            if finalize_span is not None:
+                finalize_span.end()
+        self.remove_checkpoint(session)
         # --
 
     def step(self, session, state):
-        _input_kwargs, _extra_kwargs = self.step_prepare(session, state)
         _current_step = session.get_current_step()
+        _timing = _current_step.setdefault("timing", {})  # seconds of each phase
+        with trace_span("step.prepare"), step_timing("prepare", _timing):
+            _input_kwargs, _extra_kwargs = self.step_prepare(session, state)
         # planning
         has_plan_template = "plan" in self.templates
+        fuse_plan_action = has_plan_template and self.fuse_plan_action
+        _t0 = time.perf_counter()
+        if fuse_plan_action:  # one call for both, the results are still split into plan and action
+            with trace_span("step.plan_action_call"):
+                with step_timing("render", _timing):
+                    plan_messages = action_messages = self.get_fused_messages(_input_kwargs)
+                with step_timing("plan_action_llm", _timing):
+                    plan_response = action_response = self.step_call(messages=plan_messages, session=session, stop_checker=self._check_fused_output_complete)
+            plan_res, action_res = self._parse_fused_output(plan_response)
+            action_res["fused"] = True  # note: the llm_input/llm_output of the fused call are only stored with the plan
+        spec_action = None
+        if has_plan_template and (not fuse_plan_action) and self.speculate_action:
+            spec_action = self._start_spec_action(session, _input_kwargs)
         if has_plan_template:  # planning to update state
-            plan_messages = self.templates["plan"].format(**_input_kwargs)
-            plan_response = self.step_call(messages=plan_messages, session=session)
-            plan_res = self._parse_output(plan_response)
+            if not fuse_plan_action:
+                with trace_span("step.plan_call"):
+                    with step_timing("render", _timing):
+                        plan_messages = self.templates["plan"].format(**_input_kwargs)
+                    with step_timing("plan_llm", _timing):
+                        plan_response = self.step_call(messages=plan_messages, session=session)
+                plan_res = self._parse_output(plan_response)
             # state update
             if plan_res["code"]:
                 try:
@@ -216,34 +424,62 @@ class MultiStepAgent(KwargsInitializable):
                         state['experience'] = []
                     # hardcode here: disable the current visual_content if jailbreaking. This is because most jailbreak happens for images.
                     _input_kwargs['visual_content'] = None
+            session.update_stats(time_plan=time.perf_counter() - _t0)
             # update session step
             _current_step["plan"] = plan_res
             plan_res["state"] = state.copy()  # after updating the progress state (make a copy)
             if self.store_io:  # further storage
-                plan_res.update({"llm_input": plan_messages, "llm_output": plan_response})
+                with step_timing("serialize", _timing):
+                    plan_res.update({"llm_input": self.get_stored_io(session, plan_messages), "llm_output": plan_response})
             yield {"type": "plan", "step_info": _current_step}
         # predict action
         _action_input_kwargs = _input_kwargs.copy()
-        _action_input_kwargs["state"] = json.dumps(state, ensure_ascii=False, indent=2)  # there can be state updates
-        action_messages = self.templates["action"].format(**_action_input_kwargs)
-        action_response = self.step_call(messages=action_messages, session=session)
-        action_res = self._parse_output(action_response)
+        with step_timing("render", _timing):
+            _action_input_kwargs["state"] = json.dumps(state, ensure_ascii=False, indent=2)  # there can be state updates
+        _t0 = time.perf_counter()
+        if not fuse_plan_action:
+            with trace_span("step.action_call") as _span:
+                with step_timing("render", _timing):
+                    action_messages = self.templates["action"].format(**_action_input_kwargs)
+                with step_timing("action_llm", _timing):  # note: the waiting time if speculated
+                    action_response = self._finish_spec_action(spec_action, action_messages) if spec_action is not None else None
+                    if _span is not None:
+                        _span.set(speculated=(action_response is not None))
+                    if action_response is None:  # no speculation or rejected
+                        action_response = self.step_call(messages=action_messages, session=session)
+            action_res = self._parse_output(action_response)
+        _t1 = time.perf_counter()
         # perform action
-        step_res = self.step_action(action_res, _action_input_kwargs, **_extra_kwargs)
+        _token, _token2, _token3 = _CURRENT_AFFINITY_KEY.set(self.get_affinity_key(session)), _CURRENT_SESSION_ID.set(session.id), _CURRENT_STEP_TIMING.set(_timing)
+        _token4 = _CURRENT_CHECKPOINT_SCOPE.set(self.get_checkpoint_scope(session))
+        try:
+            with trace_span("step.exec"), step_timing("exec", _timing):  # note: including the env time
+                step_res = self.step_action(action_res, _action_input_kwargs, **_extra_kwargs)
+        finally:
+            _CURRENT_AFFINITY_KEY.reset(_token)
+            _CURRENT_SESSION_ID.reset(_token2)
+            _CURRENT_STEP_TIMING.reset(_token3)
+            _CURRENT_CHECKPOINT_SCOPE.reset(_token4)
+        session.update_stats(time_action=_t1 - _t0, time_exec=time.perf_counter() - _t1)
         # update session info
         _current_step["action"] = action_res
         action_res["observation"] = step_res  # after executing the step
-        if self.store_io:  # further storage
-            action_res.update({"llm_input": action_messages, "llm_output": action_response})
+        self._update_step_stats(session, action_res)
+        if self.store_io and not fuse_plan_action:  # further storage
+            with step_timing("serialize", _timing):
+                action_res.update({"llm_input": self.get_stored_io(session, action_messages), "llm_output": action_response})
         yield {"type": "action", "step_info": _current_step}
         # --
 
     def finalize(self, session, state, stop_reason: str):
-        has_end_template = "end" in self.templates
-        has_final_result = self.has_final_result()
-        final_results = self.get_final_result() if has_final_result else None
+        _cancel_token = get_cancel_token()
+        has_end_template = ("end" in self.templates) and not (_cancel_token is not None and _cancel_token.cancelled)  # no more calls if cancelled
+        has_final_result = self.has_final_result(session)
+        final_results = self.get_final_result(session=session) if has_final_result else None
+        _timing = session.get_current_step().setdefault("timing", {}) if session.steps else {}
         if has_end_template:  # we have an ending module to further specify final results
-            _input_kwargs, _extra_kwargs = self.step_prepare(session, state)
+            with step_timing("end_prepare", _timing):
+                _input_kwargs, _extra_kwargs = self.step_prepare(session, state)
             # --
             # special ask_llm if not normal ending
             if stop_reason != StopReasons.NORMAL_END and hasattr(self, "tool_ask_llm"):
@@ -253,11 +489,15 @@ class MultiStepAgent(KwargsInitializable):
             if final_results:
                 stop_reason = f"{stop_reason} (with the result of {final_results})"
             _input_kwargs["stop_reason"] = stop_reason
-            end_messages = self.templates["end"].format(**_input_kwargs)
-            end_response = self.step_call(messages=end_messages, session=session)
+            with trace_span("step.end_call"):
+                with step_timing("end_render", _timing):
+                    end_messages = self.templates["end"].format(**_input_kwargs)
+                with step_timing("end_llm", _timing):
+                    end_response = self.step_call(messages=end_messages, session=session)
             end_res = self._parse_output(end_response)
             if self.store_io:  # further storage
-                end_res.update({"llm_input": end_messages, "llm_output": end_response})
+                with step_timing("serialize", _timing):
+                    end_res.update({"llm_input": self.get_stored_io(session, end_messages), "llm_output": end_response})
         else:  # no end module
             end_res = {}
         # no need to execute anything and simply prepare final outputs
@@ -294,7 +534,7 @@ class MultiStepAgent(KwargsInitializable):
     def _prepare_common_input_kwargs(self, session, state):
         # previous steps
         _recent_steps = session.get_latest_steps(count=self.recent_steps)  # no including the last which is simply empty
-        _recent_steps_str = "\n\n".join([f"### Step {ss['step_idx']}\nThought: {ss['action']['thought']}\nAction: ```\n{ss['action']['code']}```\nObservation: {self.get_obs_str(ss['action'])}" for ii, ss in enumerate(_recent_steps)])
+        _recent_steps_str = "\n\n".join([self._get_step_str(session, ss) for ss in _recent_steps])
         _current_step = session.get_current_step()
         _current_step_action = _current_step.get("action", {})
         _current_step_str = f"Thought: {_current_step_action.get('thought')}\nAction: ```\n{_current_step_action.get('code')}```\nObservation: {self.get_obs_str(_current_step_action)}"
@@ -304,15 +544,41 @@ class MultiStepAgent(KwargsInitializable):
             "recent_steps": _recent_steps, "recent_steps_str": _recent_steps_str,
             "current_step": _current_step, "current_step_str": _current_step_str,
         }
-        for short in [True, False]:
-            _subagent_str = "## Sub-Agent Functions\n" + "\n".join([z.get_function_definition(short) for z in self.sub_agents])
-            _tool_str = "## Tool Functions\n" + "\n".join([z.get_function_definition(short) for z in self.tools])
-            _subagent_tool_str = f"{_subagent_str}\n\n{_tool_str}"
-            _kkk = "subagent_tool_str_short" if short else "subagent_tool_str_long"
-            ret[_kkk] = _subagent_tool_str
+        ret.update(self.get_subagent_tool_strs())
         # --
         return ret
 
+    # definitions of the sub-agents and tools (re-computed only if the functions change)
+    def get_subagent_tool_strs(self):
+        _functions = self.sub_agents + self.tools
+        _signature = tuple(id(z) for z in _functions)
+        if self._subagent_tool_strs is None or self._subagent_tool_strs[0] != _signature:
+            _strs = {}
+            for short in [True, False]:
+                _subagent_str = "## Sub-Agent Functions\n" + "\n".join([z.get_function_definition(short) for z in self.sub_agents])
+                _tool_str = "## Tool Functions\n" + "\n".join([z.get_function_definition(short) for z in self.tools])
+                _subagent_tool_str = f"{_subagent_str}\n\n{_tool_str}"
+                _kkk = "subagent_tool_str_short" if short else "subagent_tool_str_long"
+                _strs[_kkk] = _subagent_tool_str
+            self._subagent_tool_strs = (_signature, _strs)
+        return self._subagent_tool_strs[1]
+
+    # counters of a finished step (so that the running loop does not need to go through all the steps)
+    def _update_step_stats(self, session, action_res):
+        _obs_str = self.get_obs_str(action_res)
+        session.update_stats(steps=1, error_steps=int(_obs_str.strip().startswith(CODE_ERROR_PERFIX)), obs_bytes=len(_obs_str.encode("utf-8", errors="ignore")))
+
+    # formatted str of a finished step (cached since finished steps do not change)
+    def _get_step_str(self, session, ss):
+        _cache = self._step_strs.setdefault(session.id, {})
+        _action = ss['action']
+        _cached = _cache.get(ss['step_idx'])
+        if _cached is None or _cached[0] is not _action:
+            _str = f"### Step {ss['step_idx']}\nThought: {_action['thought']}\nAction: ```\n{_action['code']}```\nObservation: {self.get_obs_str(_action)}"
+            _cached = (_action, _str)
+            _cache[ss['step_idx']] = _cached
+        return _cached[1]
+
     def _parse_output(self, output: str):
         _target_list = ["Thought:", "Code:"]
         if (output is None) or (output.strip() == ""):
@@ -323,43 +589,203 @@ class MultiStepAgent(KwargsInitializable):
         _res["code"] = CodeExecutor.extract_code(output)
         return _res
 
+    # whether the (partial) output is complete for _parse_output: we only need things until the closing of the first code block
+    @staticmethod
+    def _check_output_complete(output: str):
+        if "Code:" not in output:
+            return False
+        _code_part = output.split("Code:", 1)[1]
+        return re.search(r"```(?:py[^t]|python).*?\n\s*```", _code_part, flags=re.DOTALL) is not None
+
+    # speculative action: call with the previous state in the background
+    def _start_spec_action(self, session, input_kwargs):
+        _messages = self.templates["action"].format(**input_kwargs)
+        _cancel_token, _stat = new_child_cancel_token(), {}  # note: cancelled if rejected (or if the task is cancelled)
+        _model = self.get_call_model(_messages, session)  # note: the counters are recorded to the model that makes the call
+        def _call():
+            set_cancel_token(_cancel_token)  # note: already in a copied context (also keeping the trace span)
+            return self.step_call(messages=_messages, session=session, model=_model, stop_checker=self._check_output_complete, extra_stat=_stat)
+        with _SPEC_EXECUTOR_LOCK:
+            if self._spec_executor is None:
+                self._spec_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="spec_action")  # note: the agent may run several sessions at the same time
+            _future = self._spec_executor.submit(contextvars.copy_context().run, _call)
+        return {"messages": _messages, "future": _future, "cancel_token": _cancel_token, "stat": _stat, "model": _model}
+
+    # return the speculative response if the action inputs are the same, otherwise None
+    def _finish_spec_action(self, spec_action, action_messages):
+        _call_stat = spec_action["model"].call_stat
+        _call_stat["spec_action"] = _call_stat.get("spec_action", 0) + 1
+        if spec_action["messages"] == action_messages:
+            try:
+                ret = spec_action["future"].result()
+                _call_stat["spec_action_accepted"] = _call_stat.get("spec_action_accepted", 0) + 1
+                return ret
+            except Exception as e:
+                zwarn(f"Speculative action call failed: {e}")
+        spec_action["cancel_token"].cancel("speculative action rejected")  # stop the call (if still running)
+        _call_stat["spec_action_rejected"] = _call_stat.get("spec_action_rejected", 0) + 1
+        def _record_waste(_future):  # the usage is only known after it is finished
+            for k in ["prompt_tokens", "completion_tokens"]:
+                _call_stat[f"spec_wasted_{k}"] = _call_stat.get(f"spec_wasted_{k}", 0) + spec_action["stat"].get(k, 0)
+        spec_action["future"].add_done_callback(_record_waste)
+        return None
+
+    # messages for the fused mode (the previous state is given in the action template)
+    def get_fused_messages(self, input_kwargs):
+        plan_messages = self.templates["plan"].format(**input_kwargs)
+        action_messages = self.templates["action"].format(**input_kwargs)
+        return fuse_plan_action_messages(plan_messages, action_messages)
+
+    # split the fused output into the plan part and the action part
+    def _parse_fused_output(self, output: str):
+        if output and FUSED_ACTION_SEP in output:
+            _plan_output, _action_output = output.split(FUSED_ACTION_SEP, 1)
+            _action_output = "Thought:" + _action_output.replace("Action Code:", "Code:", 1)
+        else:
+            _plan_output, _action_output = output, ""
+        return self._parse_output(_plan_output), self._parse_output(_action_output)
+
+    @staticmethod
+    def _check_fused_output_complete(output: str):
+        if FUSED_ACTION_SEP not in output:
+            return False
+        _action_output = output.split(FUSED_ACTION_SEP, 1)[1]
+        return MultiStepAgent._check_output_complete(_action_output.replace("Action Code:", "Code:", 1))
+
     # --
     # an explicit mechanism for ending
-    def has_final_result(self):
-        return self.final_result is not None
+    # note: by default, for the session whose action is running
+    def has_final_result(self, session=None):
+        return self._final_results.get(self._get_session_key(session)) is not None
 
     def put_final_result(self, final_result):
-        self.final_result = final_result
+        self._final_results[self._get_session_key(None)] = final_result
 
-    def get_final_result(self, clear=True):
-        ret = self.final_result
+    def get_final_result(self, clear=True, session=None):
+        _key = self._get_session_key(session)
+        ret = self._final_results.get(_key)
         if clear:
-            self.final_result = None
+            self._final_results.pop(_key, None)
         return ret
+
+    @staticmethod
+    def _get_session_key(session):
+        return session.id if session is not None else _CURRENT_SESSION_ID.get()
     # --
 
+    # --
+    # checkpoints (saved after each finished step): the session, the progress state, the final result and the env states
+
+    def get_checkpoint_path(self, checkpoint_key):
+        _key = re.sub(r"[^\w.-]", "_", str(checkpoint_key))
+        return os.path.join(self.checkpoint_dir, f"{_key}.ckpt.pkl")
+
+    def save_checkpoint(self, session, state):
+        if not (self.checkpoint_dir and session.info.get("checkpoint_key")):
+            return
+        ckpt = {"session": session, "state": state, "final_result": self._final_results.get(session.id), "env": self.get_checkpoint_env(session)}
+        try:
+            _data = pickle.dumps(ckpt)
+        except Exception:  # there can be unpicklable objects in the observations
+            _data = pickle.dumps(_to_picklable(ckpt))
+        _path = self.get_checkpoint_path(session.info["checkpoint_key"])
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        with open(f"{_path}.tmp", "wb") as fd:
+            fd.write(_data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(f"{_path}.tmp", _path)  # note: atomic, the last checkpoint is kept if crashing when writing
+
+    def load_checkpoint(self, checkpoint_key, task):
+        _path = self.get_checkpoint_path(checkpoint_key)
+        if not os.path.exists(_path):
+            return None
+        try:
+            with open(_path, "rb") as fd:
+                ret = pickle.load(fd)
+        except Exception as e:
+            zwarn(f"Failed to load checkpoint {_path}: {e}")
+            return None
+        if ret["session"].task != task:
+            zwarn(f"Ignore the checkpoint {_path} with a mismatched task: {ret['session'].task} vs {task}")
+            return None
+        rprint(f"Load checkpoint from {_path} with {ret['session'].num_of_steps()} steps")
+        return ret
+
+    def remove_checkpoint(self, session):
+        if self.checkpoint_dir and session.info.get("checkpoint_key"):
+            _path = self.get_checkpoint_path(session.info["checkpoint_key"])
+            _sub_paths = glob.glob(glob.escape(_path[:-len(".ckpt.pkl")]) + ".step*.ckpt.pkl")  # the remaining ones of the sub-agents (not called again when resuming)
+            for one_path in [_path] + _sub_paths:
+                if os.path.exists(one_path):
+                    os.remove(one_path)
+
+    # the scope for the sub-agents called in the current step (None if this run is not checkpointed)
+    def get_checkpoint_scope(self, session):
+        if not (self.checkpoint_dir and session.info.get("checkpoint_key")):
+            return None
+        return {"prefix": f"{session.info['checkpoint_key']}.step{session.num_of_steps() - 1}", "counts": {}}
+
+    # key of a sub-agent run (None if not inside a checkpointed step): the n-th call of the same task by this agent in the step
+    # note: the re-executed step (after resuming) resumes the sub-agent runs with the same tasks
+    def get_sub_checkpoint_key(self, task):
+        scope = _CURRENT_CHECKPOINT_SCOPE.get()
+        if scope is None:
+            return None
+        _name = f"{self.name}.{hashlib.sha1(str(task).encode()).hexdigest()[:12]}"
+        with _CHECKPOINT_SCOPE_LOCK:
+            _idx = scope["counts"].get(_name, 0)
+            scope["counts"][_name] = _idx + 1
+        return f"{scope['prefix']}.{_name}.{_idx}"
+
+    # the states of the envs (to be restored when resuming)
+    def get_checkpoint_env(self, session):
+        return None
+
+    def restore_checkpoint_env(self, session, env_state):
+        pass
+
     # --
     # to be implemented in sub-classes
 
     def init_run(self, session):
-        pass
+        if self.sandbox.enabled:
+            self.sandbox.warmup()
 
     def end_run(self, session):
-        pass
+        self._step_strs.pop(session.id, None)
+        self._final_results.pop(session.id, None)
 
-    def step_call(self, messages, session, model=None):
+    def step_call(self, messages, session, model=None, stop_checker=None, extra_stat=None):
         if model is None:
-            model = self.model
-        response = model(messages)
+            model = self.get_call_model(messages, session)
+        if stop_checker is None:
+            stop_checker = self._check_output_complete
+        response = model(messages, stop_checker=stop_checker, affinity_key=self.get_affinity_key(session), extra_stat=extra_stat)  # allow early stopping in streaming mode
         return response
 
+    # which model to use for the call (can be overridden, such as with a multimodal one)
+    def get_call_model(self, messages, session):
+        return self.model
+
+    # the llm inputs to store in the session
+    def get_stored_io(self, session, messages):
+        return session.encode_io(messages) if self.compact_io else messages
+
+    # routing key for the LLM calls of this session (used in the affinity routing mode)
+    @staticmethod
+    def get_affinity_key(session):
+        if session is None:
+            return None
+        return session.info.get("affinity_key", session.id)
+
     def step_prepare(self, session, state):
         _input_kwargs = self._prepare_common_input_kwargs(session, state)
         _extra_kwargs = {}
         return _input_kwargs, _extra_kwargs
 
     def step_action(self, action_res, action_input_kwargs, **kwargs):
-        python_executor = CodeExecutor()
+        python_executor = self.sandbox.get_executor() if self.sandbox.enabled else CodeExecutor()
         python_executor.add_global_vars(**self.ACTIVE_FUNCTIONS)  # to avoid that things might get re-defined at some place ...
         _exec_timeout = self.exec_timeout_with_call if any((z in action_res["code"]) for z in self.sub_agent_names) else self.exec_timeout_wo_call  # choose timeout value
         python_executor.run(action_res["code"], catch_exception=True, timeout=_exec_timeout)  # handle err inside!
@@ -368,4 +794,44 @@ class MultiStepAgent(KwargsInitializable):
         return ret  # return a result str
 
     def step_check_end(self, session):
-        return self.has_final_result()
+        return self.has_final_result(session)
+
+# accumulate the time of the block into the timing dict of a step (by default, the one of the step whose action is running)
+_CURRENT_STEP_TIMING = contextvars.ContextVar("ck_step_timing", default=None)
+
+@contextlib.contextmanager
+def step_timing(key: str, timing=None):
+    if timing is None:
+        timing = _CURRENT_STEP_TIMING.get()
+    _t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing[key] = round(timing.get(key, 0.) + (time.perf_counter() - _t0), 6)
+
+# run the generator with the cancel token and the current span set (but not when it is paused at the yields)
+def _iter_in_context(gen, cancel_token, span):
+    ctx = contextvars.copy_context()
+    ctx.run(set_cancel_token, cancel_token)
+    ctx.run(set_current_span, span)
+    while True:
+        try:
+            item = ctx.run(next, gen)
+        except StopIteration:
+            return
+        yield item
+
+# replace the unpicklable parts with their strs (for the checkpoints)
+def _to_picklable(obj):
+    if isinstance(obj, AgentSession):
+        return AgentSession.init_from_dict(_to_picklable(obj.to_dict()))
+    elif isinstance(obj, dict):
+        return {k: _to_picklable(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_to_picklable(v) for v in obj] if isinstance(obj, list) else tuple(_to_picklable(v) for v in obj)
+    try:
+        pickle.dumps(obj)
+        return obj
+    except Exception:
+        return str(obj)
@@ -0,0 +1,91 @@
+#
+
+# content-addressed store for the large payloads (screenshots, snapshots, ...) in the session files:
+# each large string is stored once as a file named by its hash, and replaced by a small reference inline
+
+import os
+import json
+import hashlib
+import threading
+from .utils import zwarn
+
+BLOB_REF_KEY = "__blob__"
+
+def is_blob_ref(obj):
+    return isinstance(obj, dict) and len(obj) == 1 and BLOB_REF_KEY in obj
+
+# by default, the blobs of "X.jsonl" are stored at "X.jsonl.blobs"
+def get_default_blob_dir(file: str):
+    return os.path.abspath(file) + ".blobs"
+
+class BlobStore:
+    def __init__(self, root_dir: str, min_size=4096):
+        self.root_dir = os.path.abspath(root_dir)
+        self.min_size = min_size  # only store the strings with at least this number of chars
+        self._known = set()  # keys that are already stored
+        self._lock = threading.Lock()
+
+    # find the store for an output file (None if there is not one)
+    @staticmethod
+    def find_for_file(file: str, blob_dir=""):
+        _dir = blob_dir if blob_dir else get_default_blob_dir(file)
+        return BlobStore(_dir) if os.path.isdir(_dir) else None
+
+    def get_path(self, key: str):
+        return os.path.join(self.root_dir, key[:2], key)
+
+    def put(self, data: str):
+        key = hashlib.sha256(data.encode("utf-8", errors="surrogatepass")).hexdigest()
+        with self._lock:
+            _known = key in self._known
+        if not _known:
+            _path = self.get_path(key)
+            if not os.path.exists(_path):
+                os.makedirs(os.path.dirname(_path), exist_ok=True)
+                _tmp_path = f"{_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(_tmp_path, "w", encoding="utf-8", errors="surrogatepass") as fd:
+                    fd.write(data)
+                os.replace(_tmp_path, _path)  # note: atomic, so concurrent writers are fine
+            with self._lock:
+                self._known.add(key)
+        return {BLOB_REF_KEY: key}
+
+    def get(self, ref):
+        key = ref[BLOB_REF_KEY] if isinstance(ref, dict) else ref
+        with open(self.get_path(key), encoding="utf-8", errors="surrogatepass") as fd:
+            return fd.read()
+
+    # return a new object with the large strings replaced by references
+    def dedup(self, obj):
+        if isinstance(obj, str):
+            return self.put(obj) if len(obj) >= self.min_size else obj
+        elif isinstance(obj, dict):
+            return {k: self.dedup(v) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return [self.dedup(v) for v in obj]
+        else:
+            return obj
+
+    # return a new object with the references replaced by the contents (the missing ones are kept as they are)
+    def rehydrate(self, obj):
+        if is_blob_ref(obj):
+            try:
+                return self.get(obj)
+            except OSError as e:
+                zwarn(f"Cannot load blob {obj}: {e}")
+                return obj
+        elif isinstance(obj, dict):
+            return {k: self.rehydrate(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [self.rehydrate(v) for v in obj]
+        else:
+            return obj
+
+# read the instances from an output file, optionally rehydrating the blob references
+def yield_jsonl_with_blobs(file: str, blob_dir="", rehydrate=True):
+    store = BlobStore.find_for_file(file, blob_dir) if rehydrate else None
+    with open(file) as fd:
+        for line in fd:
+            if line.strip():
+                inst = json.loads(line)
+                yield store.rehydrate(inst) if store is not None else inst
@@ -0,0 +1,130 @@
+#
+
+# a content-addressed cache for LLM responses: in-memory LRU + (optional) on-disk sqlite
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from .utils import KwargsInitializable, rprint
+
+class ResponseCache(KwargsInitializable):
+    def __init__(self, **kwargs):
+        self.enabled = False  # whether using the cache
+        self.mem_size = 1024  # max number of entries in the memory tier (0 means no memory tier)
+        self.disk_path = ""  # sqlite file for the disk tier (empty means no disk tier)
+        self.disk_max_bytes = 2 * (1 << 30)  # evict the least recently used entries if exceeding this size
+        self.disk_evict_ratio = 0.9  # evict until below this ratio of disk_max_bytes
+        self.ignore_kwargs = ["api_key", "api_base", "openai_endpoint"]  # not included in the key
+        self.cache_sampled = False  # also cache the calls with temperature > 0 (by default, only the deterministic ones)
+        # --
+        super().__init__(**kwargs)
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._mem = OrderedDict()  # key -> value
+        self._lock = threading.Lock()
+        self._conn = None  # lazily opened (per process)
+        self._conn_pid = None
+        self._disk_bytes = 0
+
+    # note: simply re-open things in the new process
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        for k in ["_mem", "_lock", "_conn", "_conn_pid", "_disk_bytes"]:
+            del ret[k]
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def get_key(self, messages, call_target, call_kwargs, seed):
+        _kwargs = {k: v for k, v in call_kwargs.items() if k not in self.ignore_kwargs}
+        _data = {"messages": messages, "call_target": call_target, "call_kwargs": _kwargs, "seed": seed}
+        _s = json.dumps(_data, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)  # normalized form
+        return hashlib.sha256(_s.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return True, self._mem[key]
+            conn = self._get_conn()
+            if conn is not None:
+                row = conn.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE cache SET atime=? WHERE key=?", (time.time(), key))
+                    conn.commit()
+                    value = json.loads(row[0])
+                    self._put_mem(key, value)
+                    return True, value
+        return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_mem(key, value)
+            conn = self._get_conn()
+            if conn is not None:
+                _s = json.dumps(value, ensure_ascii=False)
+                _size = len(_s.encode())
+                old = conn.execute("SELECT size FROM cache WHERE key=?", (key,)).fetchone()
+                conn.execute("INSERT OR REPLACE INTO cache (key, value, size, atime) VALUES (?, ?, ?, ?)", (key, _s, _size, time.time()))
+                conn.commit()
+                self._disk_bytes += _size - (old[0] if old else 0)
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk(conn)
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            conn = self._get_conn()
+            if conn is not None:
+                conn.execute("DELETE FROM cache")
+                conn.commit()
+                self._disk_bytes = 0
+
+    # --
+    # helpers
+
+    def _put_mem(self, key, value):
+        if self.mem_size <= 0:
+            return
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_size:
+            self._mem.popitem(last=False)  # drop the least recently used one
+
+    def _get_conn(self):
+        if not self.disk_path:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            _dir = os.path.dirname(self.disk_path)
+            if _dir:
+                os.makedirs(_dir, exist_ok=True)
+            conn = sqlite3.connect(self.disk_path, timeout=60, check_same_thread=False)  # note: protected by our own lock
+            conn.execute("PRAGMA journal_mode=WAL")  # allow concurrent readers from multiple processes
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, atime REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)")
+            conn.commit()
+            self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            self._conn, self._conn_pid = conn, os.getpid()
+            rprint(f"Open response cache at {self.disk_path}: size={self._disk_bytes}")
+        return self._conn
+
+    def _evict_disk(self, conn):
+        _target = int(self.disk_max_bytes * self.disk_evict_ratio)
+        self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]  # re-sync since other processes may also write
+        _removed = 0
+        while self._disk_bytes > _target:
+            rows = conn.execute("SELECT key, size FROM cache ORDER BY atime LIMIT 32").fetchall()
+            if not rows:
+                break
+            conn.executemany("DELETE FROM cache WHERE key=?", [(r[0],) for r in rows])
+            self._disk_bytes -= sum(r[1] for r in rows)
+            _removed += len(rows)
+        conn.commit()
+        rprint(f"Evict {_removed} entries from the response cache at {self.disk_path}, current size={self._disk_bytes}")
@@ -0,0 +1,87 @@
+#
+
+# cooperative cancellation: one token for each top-level task (shared by the sub-agents through a context var),
+# checked at the LLM calls, the env calls and the agent loops, so that the abandoned work stops promptly
+
+import time
+import threading
+import contextvars
+
+class TaskCancelledError(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Task cancelled: {reason}")
+        self.reason = reason
+
+class CancelToken:
+    DEADLINE_REASON = "time limit exceeded"
+
+    def __init__(self, timeout=0., parent=None):
+        self.deadline = (time.monotonic() + timeout) if timeout > 0 else None  # cancelled when exceeding this
+        self.parent = parent  # also cancelled when the parent is cancelled (but not the other way around)
+        self.reason = None  # the first reason
+        self._lock = threading.Lock()
+
+    # a child token for the work that can be abandoned separately (such as the calls of a timed-out action)
+    def new_child(self, timeout=0.):
+        return CancelToken(timeout=timeout, parent=self)
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+        return self
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.parent is not None and self.parent.cancelled:
+            self.cancel(self.parent.reason)
+        if self.reason is None and self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel(CancelToken.DEADLINE_REASON)
+        return self.reason is not None
+
+    # cancelled because of the deadline (of this one or the ancestors) rather than explicitly
+    @property
+    def timed_out(self):
+        return self.cancelled and self.reason == CancelToken.DEADLINE_REASON
+
+    # remaining seconds until the deadline (None if no deadline)
+    def remaining(self):
+        _remaining = None if self.deadline is None else max(0., self.deadline - time.monotonic())
+        _parent_remaining = None if self.parent is None else self.parent.remaining()
+        if _parent_remaining is not None and (_remaining is None or _parent_remaining < _remaining):
+            _remaining = _parent_remaining
+        return _remaining
+
+    def check(self):
+        if self.cancelled:
+            raise TaskCancelledError(self.reason)
+
+_CURRENT_CANCEL_TOKEN = contextvars.ContextVar("ck_cancel_token", default=None)
+
+def get_cancel_token():
+    return _CURRENT_CANCEL_TOKEN.get()
+
+def set_cancel_token(token):
+    return _CURRENT_CANCEL_TOKEN.set(token)
+
+def reset_cancel_token(ctx_token):
+    _CURRENT_CANCEL_TOKEN.reset(ctx_token)
+
+# a child of the current token (or a new root one if there is not a current one)
+def new_child_cancel_token(timeout=0.):
+    token = _CURRENT_CANCEL_TOKEN.get()
+    return token.new_child(timeout=timeout) if token is not None else CancelToken(timeout=timeout)
+
+# raise TaskCancelledError if the current task is cancelled
+def check_cancelled():
+    token = _CURRENT_CANCEL_TOKEN.get()
+    if token is not None:
+        token.check()
+
+# the timeout for a blocking call (capped by the remaining time of the current task)
+def get_capped_timeout(timeout):
+    token = _CURRENT_CANCEL_TOKEN.get()
+    _remaining = token.remaining() if token is not None else None
+    if _remaining is None:
+        return timeout
+    return max(1., min(timeout, _remaining)) if timeout else max(1., _remaining)
@@ -0,0 +1,295 @@
+#
+
+# adaptive control of the calls to one endpoint (shared in the process):
+# concurrency limit (AIMD by throttling and latency) + token bucket + circuit breaker + health (for selecting among equivalent endpoints)
+
+import os
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from .utils import KwargsInitializable, zwarn
+
+# --
+# error helpers
+
+class HttpStatusError(RuntimeError):
+    def __init__(self, msg, status_code=None, headers=None):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.headers = dict(headers) if headers else {}
+
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    headers = {str(k).lower(): v for k, v in dict(headers).items()}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.
+        _v = headers.get("retry-after")
+        if _v:
+            try:
+                return float(_v)
+            except ValueError:  # http-date
+                return max(0., email.utils.parsedate_to_datetime(_v).timestamp() - time.time())
+    except Exception:
+        pass
+    return None
+
+# classify an error into: throttle / failure / other, also return the retry-after time (if any)
+def get_error_info(e: Exception):
+    status, headers = getattr(e, "status_code", None), getattr(e, "headers", None)
+    _resp = getattr(e, "response", None)
+    if isinstance(_resp, dict):  # botocore's ClientError
+        _meta = _resp.get("ResponseMetadata", {})
+        status = _meta.get("HTTPStatusCode", status)
+        headers = _meta.get("HTTPHeaders", headers)
+        if _resp.get("Error", {}).get("Code") in ["ThrottlingException", "LimitExceededException", "TooManyRequestsException"]:
+            status = 429
+    elif _resp is not None and not headers:
+        headers = getattr(_resp, "headers", None)
+    if type(e).__name__ == "RateLimitError":
+        status = 429
+    retry_after = parse_retry_after(headers)
+    if status == 429 or (status == 503 and retry_after is not None):
+        return "throttle", retry_after
+    _name = type(e).__name__
+    if (status is not None and (status >= 500 or status == 408)) or (status is None and ("Timeout" in _name or "Connect" in _name or isinstance(e, (OSError, asyncio.TimeoutError)))):
+        return "failure", retry_after
+    return "other", None  # for example, bad requests: not the endpoint's fault
+
+# --
+class EndpointController(KwargsInitializable):
+    _controllers = {}  # name -> EndpointController
+    _controllers_pid = None
+    _controllers_lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        self.name = ""
+        # concurrency limit
+        self.init_limit = 16  # starting concurrency limit
+        self.min_limit = 1
+        self.max_limit = 256
+        self.decrease_factor = 0.5  # multiplicative decrease when throttled
+        self.decrease_cooldown = 2.  # at most one decrease in this window (in seconds)
+        self.latency_tolerance = 0.  # slightly decrease if the latency EWMA exceeds this times the best one (0 means ignoring latency, the default, since the LLM latency mostly tracks the output length rather than the load)
+        self.latency_best_decay = 0.05  # the best latency drifts towards the current EWMA by this ratio per call (so that an early minimum does not stick)
+        self.latency_decrease_factor = 0.9
+        self.latency_alpha = 0.1  # for EWMA
+        self.latency_window = 200  # keep recent latencies for the quantiles
+        # token bucket
+        self.rate = 0.  # requests per second (0 means no rate limit)
+        self.burst = 10  # bucket capacity
+        self.default_retry_after = 5.  # pause time if throttled without explicit retry-after
+        # circuit breaker
+        self.failure_threshold = 5  # consecutive failures to open the circuit
+        self.open_time = 10.  # seconds to keep the circuit open (doubled for each re-opening)
+        self.max_open_time = 120.
+        # health (for selecting among multiple endpoints)
+        self.health_alpha = 0.2  # EWMA of the success rate (throttling not included)
+        self.eject_health = 0.3  # eject (open the circuit) if the health goes below this
+        self.default_latency = 1.  # assumed latency if not known yet
+        # --
+        self.poll_interval = 0.05  # base waiting interval
+        super().__init__(**kwargs)
+        # --
+        self._lock = threading.Lock()
+        self.limit = float(self.init_limit)
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.pause_until = 0.  # paused by retry-after
+        self.circuit = "closed"  # closed / open / half_open
+        self.circuit_until = 0.
+        self.curr_open_time = self.open_time
+        self.probing = False  # a probing call is running in half_open state
+        self.consecutive_failures = 0
+        self.last_decrease = 0.
+        self.latency_ewma = None
+        self.latency_best = None
+        self.latencies = deque(maxlen=self.latency_window)
+        self.health = 1.
+        self.counts = Counter()
+
+    @staticmethod
+    def get_shared(name: str, **kwargs):
+        with EndpointController._controllers_lock:
+            if EndpointController._controllers_pid != os.getpid():  # note: do not inherit the states from the parent process
+                EndpointController._controllers = {}
+                EndpointController._controllers_pid = os.getpid()
+            if name not in EndpointController._controllers:  # lazy init (the first one's kwargs are used)
+                EndpointController._controllers[name] = EndpointController(name=name, **kwargs)
+            return EndpointController._controllers[name]
+
+    @staticmethod
+    def get_all_metrics():
+        return {k: v.get_metrics() for k, v in list(EndpointController._controllers.items())}
+
+    def get_metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            ret = {"limit": round(self.limit, 3), "in_flight": self.in_flight, "tokens": (round(self.tokens, 3) if self.rate > 0 else None),
+                   "circuit": self.circuit, "pause_remaining": round(max(0., self.pause_until - now), 3),
+                   "latency_ewma": self.latency_ewma, "latency_best": self.latency_best, "health": round(self.health, 3)}
+            ret.update(self.counts)
+        return ret
+
+    # the q-quantile of the recent latencies (None if not enough samples)
+    @staticmethod
+    def get_latency_quantile(controllers, q: float, min_samples=1):
+        all_latencies = []
+        for c in controllers:
+            with c._lock:
+                all_latencies.extend(c.latencies)
+        if len(all_latencies) < max(1, min_samples):
+            return None
+        all_latencies.sort()
+        return all_latencies[min(len(all_latencies) - 1, int(q * len(all_latencies)))]
+
+    # select one from the (equivalent) endpoints: the available one with the lowest expected waiting
+    @staticmethod
+    def select(controllers):
+        now = time.monotonic()
+        scores = [c.get_score(now) for c in controllers]
+        _best = min(scores)
+        return random.choice([i for i, s in enumerate(scores) if s == _best])  # break ties randomly
+
+    # smaller is better: (unavailable, score)
+    def get_score(self, now: float):
+        with self._lock:
+            _wait = self._get_unavailable_time(now)
+            if _wait > 0:
+                return (1, _wait)
+            _latency = self.default_latency if self.latency_ewma is None else self.latency_ewma
+            _load = (self.in_flight + 1) / max(1., self.limit)
+            return (0, _load * _latency / max(self.health, 0.01))
+
+    # --
+    # acquire & release
+
+    # note: start is given if already acquired by try_acquire
+    @asynccontextmanager
+    async def slot(self, start=None):
+        if start is None:
+            start = await self.acquire()
+        try:
+            yield self
+        except asyncio.CancelledError:
+            self.release(start, "cancel")
+            raise
+        except Exception as e:
+            kind, retry_after = get_error_info(e)
+            self.release(start, kind, retry_after)
+            raise
+        else:
+            self.release(start, "success")
+
+    async def acquire(self):
+        while True:
+            start, _wait = self.try_acquire()
+            if start is not None:
+                return start
+            await asyncio.sleep(self.get_sleep_time(_wait))
+
+    # return (start_time, None) if acquired, otherwise (None, waiting_time)
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            _wait = self._get_wait(now)
+            if _wait > 0:
+                self.counts["wait"] += 1
+                return None, _wait
+            self.in_flight += 1
+            if self.rate > 0:
+                self.tokens -= 1
+            if self.circuit == "half_open":
+                self.probing = True
+            return now, None
+
+    def get_sleep_time(self, wait: float):
+        return min(max(wait, self.poll_interval), 1.) * random.uniform(1., 1.5)  # add jitter to avoid a herd when recovering
+
+    def release(self, start: float, kind: str, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self.counts[kind] += 1
+            self.probing = False  # decided by this one or let another one probe
+            if kind == "success":
+                self.consecutive_failures = 0
+                self.health = self.health_alpha + (1 - self.health_alpha) * self.health
+                if self.circuit == "half_open":  # recovered
+                    self.circuit, self.curr_open_time = "closed", self.open_time
+                    self.health = max(self.health, min(1., self.eject_health + 0.2))  # a fresh start
+                latency = now - start
+                self.latencies.append(latency)
+                self.latency_ewma = latency if self.latency_ewma is None else (self.latency_alpha * latency + (1 - self.latency_alpha) * self.latency_ewma)
+                if self.latency_best is None or self.latency_ewma < self.latency_best:
+                    self.latency_best = self.latency_ewma
+                else:
+                    self.latency_best += self.latency_best_decay * (self.latency_ewma - self.latency_best)
+                if self.latency_tolerance > 0 and self.latency_ewma > self.latency_best * self.latency_tolerance:
+                    self._decrease(now, self.latency_decrease_factor)  # getting slower
+                elif self.in_flight + 1 >= int(self.limit):  # additive increase (only if the limit is actually reached)
+                    self.limit = min(float(self.max_limit), self.limit + 1. / self.limit)
+            elif kind == "throttle":
+                self._decrease(now, self.decrease_factor)
+                _pause = retry_after if retry_after is not None else self.default_retry_after
+                self.pause_until = max(self.pause_until, now + _pause)
+                if self.circuit == "half_open":
+                    self._open_circuit(now)
+            elif kind == "failure":
+                self.consecutive_failures += 1
+                self.health = (1 - self.health_alpha) * self.health
+                if self.circuit == "half_open" or self.consecutive_failures >= self.failure_threshold or self.health < self.eject_health:
+                    self._open_circuit(now)
+                if retry_after is not None:
+                    self.pause_until = max(self.pause_until, now + retry_after)
+
+    # suggested waiting time before retrying (the pacing is mainly done by acquire)
+    def get_retry_wait(self):
+        return random.uniform(0., 1.)
+
+    # --
+    # helpers
+
+    def _get_unavailable_time(self, now: float):
+        if now < self.pause_until:
+            return self.pause_until - now
+        if self.circuit == "open":
+            if now < self.circuit_until:
+                return self.circuit_until - now
+            self.circuit, self.probing = "half_open", False  # try one probe
+        if self.circuit == "half_open" and self.probing:
+            return self.poll_interval * 10
+        return 0.
+
+    def _get_wait(self, now: float):
+        _wait = self._get_unavailable_time(now)
+        if _wait > 0:
+            return _wait
+        if self.in_flight >= max(self.min_limit, int(self.limit)):
+            return self.poll_interval
+        if self.rate > 0:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0.
+
+    def _decrease(self, now: float, factor: float):
+        if now - self.last_decrease >= self.decrease_cooldown:
+            self.limit = max(float(self.min_limit), self.limit * factor)
+            self.last_decrease = now
+
+    def _open_circuit(self, now: float):
+        if self.circuit == "open":
+            return
+        if self.circuit == "half_open":  # failed again: wait longer
+            self.curr_open_time = min(self.max_open_time, self.curr_open_time * 2)
+        self.circuit, self.circuit_until = "open", now + self.curr_open_time
+        self.counts["circuit_open"] += 1
+        zwarn(f"Open the circuit for endpoint {self.name} for {self.curr_open_time}s")
@@ -12,6 +12,7 @@ from openai import OpenAIError, AzureOpenAI
 from ..ck_main.gaia_scorer import question_scorer
 from ..agents.model import OpenaiHelper, Boto3Helper, LLM
 from .evaluator_prompt import prompt_dict
+from .session import decode_session_io
 from langchain_openai import AzureChatOpenAI
 from langchain.evaluation import load_evaluator
 import os
@@ -298,10 +299,11 @@ class Evaluator(KwargsInitializable):
         }
     
     def detect_failure(self, session, evaluation_type):
+        session = decode_session_io(session)  # in case of the compact llm inputs
         failed_to_answer = False
         # final action message
         action_dict = deepcopy(session['steps'][-1]['action'])
-        final_message = action_dict['llm_output']
+        final_message = action_dict['llm_output'] if not action_dict.get('fused') else session['steps'][-1]['plan']['llm_output']  # the fused call is stored with the plan
         # end message: output formatting
         end_messages = []
         for i in range(len(session['steps'])):
@@ -0,0 +1,125 @@
+#
+
+# shrinking the images (base64 data urls) in the outgoing messages: downsizing + re-encoding (cached by content hash)
+
+import io
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from .utils import KwargsInitializable, zwarn
+
+class ImageOptimizer(KwargsInitializable):
+    def __init__(self, **kwargs):
+        self.enabled = False  # opt-in, since the images are lossily re-encoded (note: simply skip if Pillow is not available)
+        self.max_pixels = 1568 * 1568  # downsize (keeping the aspect ratio) if having more pixels than this
+        self.min_bytes = 200 * 1024  # only re-encode images larger than this (if not downsized)
+        self.max_bytes = 1024 * 1024  # byte budget of one image (try lower qualities and then smaller sizes to fit it)
+        self.format = "jpeg"  # jpeg/webp
+        self.qualities = [85, 70, 55, 40]  # qualities to try
+        self.cache_size = 256  # max number of cached results
+        # --
+        super().__init__(**kwargs)
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._cache = OrderedDict()  # hash -> new url
+        self._lock = threading.Lock()
+
+    # note: simply re-create things in the new process
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        for k in ["_cache", "_lock"]:
+            del ret[k]
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    # return new messages (the original ones are not changed)
+    def optimize_messages(self, messages, stat=None):
+        if not self.enabled or not isinstance(messages, list):
+            return messages
+        ret = []
+        for message in messages:
+            _content = message.get("content")
+            if isinstance(_content, list) and any(isinstance(z, dict) and z.get("type") == "image_url" for z in _content):
+                new_content = []
+                for part in _content:
+                    if isinstance(part, dict) and part.get("type") == "image_url":
+                        _url = part["image_url"]["url"]
+                        _new_url = self.optimize_url(_url, stat=stat)
+                        if _new_url is not _url:
+                            part = {**part, "image_url": {**part["image_url"], "url": _new_url}}
+                    new_content.append(part)
+                message = {**message, "content": new_content}
+            ret.append(message)
+        return ret
+
+    def optimize_url(self, url: str, stat=None):
+        if not url.startswith("data:image/") or ";base64," not in url:
+            return url  # only handle the inline ones
+        _key = hashlib.sha1(url.encode()).digest()
+        with self._lock:
+            if _key in self._cache:
+                self._cache.move_to_end(_key)
+                _update_stat(stat, "image_cache_hit", 1)
+                return self._cache[_key]
+        try:
+            ret = self._optimize(url, stat)
+        except ImportError:
+            zwarn("Pillow is not available, disable ImageOptimizer")
+            self.enabled = False
+            return url
+        except Exception as e:  # simply keep the original one
+            zwarn(f"Failed to optimize image: {e}")
+            ret = url
+        with self._lock:
+            self._cache[_key] = ret
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ret
+
+    def _optimize(self, url: str, stat):
+        from PIL import Image  # note: optional dependency
+        _data = base64.b64decode(url.split(";base64,", 1)[1])
+        img = Image.open(io.BytesIO(_data))
+        _w, _h = img.size
+        _need_resize = (_w * _h > self.max_pixels)
+        if not _need_resize and len(_data) <= self.min_bytes:
+            return url  # small enough
+        if _need_resize:
+            _ratio = (self.max_pixels / (_w * _h)) ** 0.5
+            img = img.resize((max(1, int(_w * _ratio)), max(1, int(_h * _ratio))), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):  # no alpha for jpeg
+            _bg = Image.new("RGB", img.size, (255, 255, 255))
+            _img = img.convert("RGBA")
+            _bg.paste(_img, mask=_img.split()[-1])
+            img = _bg
+        _fmt = "webp" if self.format == "webp" else "jpeg"
+        while True:
+            for _quality in self.qualities:
+                _buf = io.BytesIO()
+                img.save(_buf, format=_fmt.upper(), quality=_quality)
+                _new_data = _buf.getvalue()
+                if len(_new_data) <= self.max_bytes:
+                    break
+            if len(_new_data) <= self.max_bytes or min(img.size) <= 64:
+                break
+            img = img.resize((max(1, int(img.size[0] * 0.75)), max(1, int(img.size[1] * 0.75))), Image.LANCZOS)  # further shrink
+        if len(_new_data) >= len(_data):
+            if not _need_resize:
+                return url  # no benefit
+            _buf = io.BytesIO()
+            img.save(_buf, format="PNG", optimize=True)  # lossy formats may be worse for some images (such as noisy screenshots)
+            if len(_buf.getvalue()) < len(_new_data):
+                _fmt, _new_data = "png", _buf.getvalue()
+        _update_stat(stat, "image_optimized", 1)
+        _update_stat(stat, "image_bytes_before", len(_data))
+        _update_stat(stat, "image_bytes_after", len(_new_data))
+        return f"data:image/{_fmt};base64," + base64.b64encode(_new_data).decode()
+
+def _update_stat(stat, key, value):
+    if stat is not None:
+        stat[key] = stat.get(key, 0) + value
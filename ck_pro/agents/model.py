@@ -2,31 +2,102 @@
 
 # a simple wrapper for LLM calling
 
+import os
+import re
 import time
-import requests
-from .utils import wrapped_trying, rprint, GET_ENV_VAR, KwargsInitializable
-
-from transformers import AutoTokenizer
+import json
+import random
+import asyncio
+import threading
+import hashlib
+import contextlib
+import contextvars
+import concurrent.futures
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from .utils import awrapped_trying, rprint, GET_ENV_VAR, KwargsInitializable, have_images_in_messages
+from .cache import ResponseCache
+from .image import ImageOptimizer
+from .replay import ReplayStore
+from .endpoint import EndpointController, HttpStatusError
+from .cancel import check_cancelled
+from .trace import trace_span
 
 class MessageTruncator:
-    def __init__(self, model_name="Qwen/Qwen3-32B"):
+    _shared_truncators = {}  # model_name -> MessageTruncator (shared in the process)
+    _shared_lock = threading.Lock()
+
+    def __init__(self, model_name="Qwen/Qwen3-32B", max_cache_size=8192):
+        from transformers import AutoTokenizer  # note: lazy import since it is slow and only needed by the request path
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.max_cache_size = max_cache_size  # max number of memoized token counts
+        self.token_count_cache = OrderedDict()  # content-hash -> token count (LRU)
+        self.cache_lock = threading.Lock()
+
+    # note: the lock cannot be pickled, simply make a new one
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        del ret["cache_lock"]
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache_lock = threading.Lock()
+
+    @staticmethod
+    def get_shared(model_name="Qwen/Qwen3-32B"):
+        if model_name not in MessageTruncator._shared_truncators:
+            with MessageTruncator._shared_lock:
+                if model_name not in MessageTruncator._shared_truncators:  # lazy init
+                    time0 = time.perf_counter()
+                    MessageTruncator._shared_truncators[model_name] = MessageTruncator(model_name)
+                    rprint(f"Load shared tokenizer {model_name} [interval={time.perf_counter() - time0:.3f}s]")
+        return MessageTruncator._shared_truncators[model_name]
+
+    @staticmethod
+    def _get_texts(content):
+        if isinstance(content, str):
+            return [content]
+        elif isinstance(content, list):
+            return [part.get("text", "") for part in content if part.get("type") == "text"]
+        else:
+            return []
+
+    def _count_texts(self, texts, stat=None):
+        """
+        Count tokens of a list of texts, with memoization by content hash.
+        All the cache misses are encoded together in one batch.
+        """
+        keys = [hashlib.sha1(t.encode()).digest() for t in texts]
+        counts = {}
+        with self.cache_lock:
+            for k in keys:
+                if k in self.token_count_cache:
+                    self.token_count_cache.move_to_end(k)
+                    counts[k] = self.token_count_cache[k]
+        miss_texts = {}
+        for k, t in zip(keys, texts):
+            if k not in counts:
+                miss_texts[k] = t
+        if miss_texts:
+            all_ids = self.tokenizer(list(miss_texts.values()), add_special_tokens=False)["input_ids"]
+            with self.cache_lock:
+                for k, ids in zip(miss_texts.keys(), all_ids):
+                    counts[k] = len(ids)
+                    self.token_count_cache[k] = len(ids)
+                while len(self.token_count_cache) > self.max_cache_size:
+                    self.token_count_cache.popitem(last=False)
+        if stat is not None:
+            stat["token_cache_hit"] = stat.get("token_cache_hit", 0) + len(keys) - len(miss_texts)
+            stat["token_cache_miss"] = stat.get("token_cache_miss", 0) + len(miss_texts)
+        return [counts[k] for k in keys]
 
     def _count_text_tokens(self, content):
         """
         Count tokens in a message's content.
         Handles both string and list-of-dict (multimodal) content.
         """
-        if isinstance(content, str):
-            return len(self.tokenizer.encode(content, add_special_tokens=False))
-        elif isinstance(content, list):
-            total = 0
-            for part in content:
-                if part.get("type") == "text":
-                    total += len(self.tokenizer.encode(part.get("text", ""), add_special_tokens=False))
-            return total
-        else:
-            return 0
+        return sum(self._count_texts(self._get_texts(content)))
 
     def _truncate_text_content(self, content, max_tokens):
         """
@@ -63,17 +134,24 @@ class MessageTruncator:
         else:
             return content
 
-    def truncate_message_list(self, messages, max_length):
+    def truncate_message_list(self, messages, max_length, stat=None):
         """
         Truncate a list of messages so that the total token count does not exceed max_length.
         Keeps the most recent messages. If the most recent message alone exceeds max_length,
         its text content will be truncated to fit. Images are never truncated or removed.
         """
+        time0 = time.perf_counter()
+        all_texts = [self._get_texts(msg.get("content", "")) for msg in messages]
+        all_counts = self._count_texts(sum(all_texts, []), stat=stat)  # count them all in one batch
+        msg_tokens, _idx = [], 0
+        for _texts in all_texts:
+            msg_tokens.append(sum(all_counts[_idx:_idx+len(_texts)]))
+            _idx += len(_texts)
+        # --
         truncated = []
         total_tokens = 0
-        for msg in reversed(messages):
+        for msg, tokens in zip(reversed(messages), reversed(msg_tokens)):
             content = msg.get("content", "")
-            tokens = self._count_text_tokens(content)
             if total_tokens + tokens > max_length:
                 if not truncated:
                     # Truncate the most recent message's text content to fit max_length
@@ -84,21 +162,125 @@ class MessageTruncator:
                 break
             truncated.insert(0, msg)
             total_tokens += tokens
+        if stat is not None:
+            stat["truncate_call"] = stat.get("truncate_call", 0) + 1
+            stat["truncate_time"] = stat.get("truncate_time", 0) + (time.perf_counter() - time0)
         return truncated
 
 # --
 # helper
+# an extra stat dict to collect the usage of the current call only, set by LLM.acall
+_EXTRA_STAT = contextvars.ContextVar("llm_extra_stat", default=None)
+
 def update_stat(stat, call_return):
     usage = call_return.get("usage", {})
-    if stat is not None:
-        stat["llm_call"] = stat.get("llm_call", 0) + 1
+    for one_stat in [stat, _EXTRA_STAT.get()]:
+        if one_stat is None:
+            continue
+        one_stat["llm_call"] = one_stat.get("llm_call", 0) + 1
         for k in ['completion_tokens', 'prompt_tokens', 'total_tokens']:
             k = {'outputTokens': 'completion_tokens', 'inputTokens': 'prompt_tokens', 'totalTokens': 'total_tokens'}.get(k, k) # handling keys in claude
-            stat[k] = stat.get(k, 0) + usage.get(k, 0)
+            one_stat[k] = one_stat.get(k, 0) + usage.get(k, 0)
+        # prompt tokens served from the server-side prefix cache
+        _cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or usage.get("cacheReadInputTokens") or 0
+        one_stat["cached_tokens"] = one_stat.get("cached_tokens", 0) + _cached
 # --
 
+# remove the <think> ... </think> pieces
+def remove_think_str(s: str, keep_unclosed=True):
+    ret = re.sub(r'<think>.*?</think>', '', s, flags=re.DOTALL)
+    if (not keep_unclosed) and "<think>" in ret:  # still thinking
+        ret = ret.split("<think>", 1)[0]
+    return ret
+
+# a process-wide background event loop, through which the sync calls are routed (so that pooled connections can be reused)
+class AsyncRunner:
+    _loop = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_loop():
+        with AsyncRunner._lock:
+            if AsyncRunner._loop is None or AsyncRunner._pid != os.getpid():  # lazy init (also re-init in a forked child)
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm_loop", daemon=True).start()
+                AsyncRunner._loop, AsyncRunner._pid = loop, os.getpid()
+            return AsyncRunner._loop
+
+    @staticmethod
+    def run(coro):
+        loop = AsyncRunner.get_loop()
+        try:
+            _running = asyncio.get_running_loop()
+        except RuntimeError:
+            _running = None
+        if _running is loop:
+            coro.close()
+            raise RuntimeError("Cannot make sync calls inside the LLM loop, please use the async version instead!")
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            while not future.done():  # note: wait in slices so that the async exceptions (such as ExecTimeoutError) can get in
+                concurrent.futures.wait([future], timeout=0.2)
+                check_cancelled()  # also stop waiting if the current task is cancelled
+            return future.result()
+        except BaseException:  # for example, interrupted by timeout: also cancel the running one
+            future.cancel()
+            raise
+
+# pooled keep-alive http clients for the request target
+class HttpHelper:
+    _http_clients = {}  # (loop, endpoint) -> AsyncClient
+
+    @staticmethod
+    def get_endpoint(url: str):
+        _parsed = urlsplit(url)
+        return f"{_parsed.scheme}://{_parsed.netloc}"
+
+    @staticmethod
+    def get_http_client(url: str):
+        import httpx
+        loop = asyncio.get_running_loop()  # note: async clients cannot be shared across loops
+        cache_key = (loop, HttpHelper.get_endpoint(url))
+        if cache_key not in HttpHelper._http_clients:  # lazy init
+            for _key in [k for k in HttpHelper._http_clients if k[0].is_closed()]:  # clear the ones from closed loops
+                del HttpHelper._http_clients[_key]
+            _limits = httpx.Limits(
+                max_connections=int(GET_ENV_VAR("LLM_HTTP_MAX_CONNECTIONS", df=100)),
+                max_keepalive_connections=int(GET_ENV_VAR("LLM_HTTP_MAX_KEEPALIVE", df=20)),
+                keepalive_expiry=float(GET_ENV_VAR("LLM_HTTP_KEEPALIVE_EXPIRY", df=60)),
+            )
+            HttpHelper._http_clients[cache_key] = httpx.AsyncClient(limits=_limits)
+        return HttpHelper._http_clients[cache_key]
+
+    @staticmethod
+    async def post_json(url: str, json_data, timeout):
+        _client = HttpHelper.get_http_client(url)
+        r = await _client.post(url, headers={"Content-Type": "application/json"}, json=json_data, timeout=timeout)
+        if not (200 <= r.status_code <= 300):
+            raise HttpStatusError(f"response error: {r.status_code} {json_data}", status_code=r.status_code, headers=r.headers)
+        return r.json()
+
+    # yield the json objects of the server-sent events (closing the generator will abort the request)
+    @staticmethod
+    async def stream_json(url: str, json_data, timeout):
+        _client = HttpHelper.get_http_client(url)
+        async with _client.stream("POST", url, headers={"Content-Type": "application/json"}, json=json_data, timeout=timeout) as r:
+            if not (200 <= r.status_code <= 300):
+                await r.aread()
+                raise HttpStatusError(f"response error: {r.status_code} {json_data}", status_code=r.status_code, headers=r.headers)
+            async for line in r.aiter_lines():
+                line = line.strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+
 class OpenaiHelper:
     _openai_clients = {}  # model_name -> Helper
+    _async_openai_clients = {}  # (loop, model_name, ...) -> Helper
 
     @staticmethod
     def get_openai_client(model_name="", api_endpoint="", api_key=""):
@@ -120,6 +302,88 @@ class OpenaiHelper:
             OpenaiHelper._openai_clients[cache_key] = client
         return OpenaiHelper._openai_clients[cache_key]
 
+    # note: fixed_endpoint (specified in the call_target) has priority over the env variables
+    @staticmethod
+    def get_async_openai_client(model_name="", api_endpoint="", api_key="", fixed_endpoint=""):
+        loop = asyncio.get_running_loop()  # note: async clients cannot be shared across loops
+        cache_key = (loop, model_name or "", api_endpoint or "", api_key or "", fixed_endpoint or "")
+        model_name_suffix = f"_{model_name}" if model_name else ""
+        if cache_key not in OpenaiHelper._async_openai_clients:  # lazy init
+            import openai
+            for _key in [k for k in OpenaiHelper._async_openai_clients if k[0].is_closed()]:  # clear the ones from closed loops
+                del OpenaiHelper._async_openai_clients[_key]
+            if GET_ENV_VAR("AZURE_OPENAI_API_KEY", f"AZURE_OPENAI_API_KEY{model_name_suffix}"):
+                client = openai.AsyncAzureOpenAI(
+                    azure_endpoint=(fixed_endpoint or GET_ENV_VAR("AZURE_OPENAI_ENDPOINT", f"AZURE_OPENAI_ENDPOINT{model_name_suffix}", df=api_endpoint)),
+                    api_key=GET_ENV_VAR("AZURE_OPENAI_API_KEY", f"AZURE_OPENAI_API_KEY{model_name_suffix}", df=api_key),
+                    api_version=GET_ENV_VAR("AZURE_OPENAI_API_VERSION", df="2024-02-01")
+                )
+            else:
+                client = openai.AsyncOpenAI(
+                    base_url=(fixed_endpoint or GET_ENV_VAR("OPENAI_ENDPOINT", f"OPENAI_ENDPOINT{model_name_suffix}", df=api_endpoint)),
+                    api_key=GET_ENV_VAR("OPENAI_API_KEY", f"OPENAI_API_KEY{model_name_suffix}", df=api_key),
+                )
+            OpenaiHelper._async_openai_clients[cache_key] = client
+        return OpenaiHelper._async_openai_clients[cache_key]
+
+    @staticmethod
+    def get_chat_response(call_return):
+        if "content" not in call_return["choices"][0]["message"]:
+            response = ""
+        else:
+            response = call_return["choices"][0]["message"]["content"]
+        if response.strip() == "":
+            raise RuntimeError(f"Get empty response from gpt: {call_return}")
+        return response
+
+    @staticmethod
+    async def acall_chat(messages, stat=None, **openai_kwargs):
+        rprint(f"Call gpt with openai_kwargs={openai_kwargs}")
+        _client = OpenaiHelper.get_async_openai_client(
+            openai_kwargs.get("model", ""),
+            api_endpoint=openai_kwargs.get("api_base"),
+            api_key=openai_kwargs.get("api_key"),
+            fixed_endpoint=openai_kwargs.get("openai_endpoint"),
+        )
+        _kwargs = dict(openai_kwargs)
+        for k in ("api_base", "openai_endpoint", "api_key"):
+            _kwargs.pop(k, None)
+        chat_completion = await _client.chat.completions.create(messages=messages, **_kwargs)
+        call_return = chat_completion.to_dict()
+        update_stat(stat, call_return)
+        return OpenaiHelper.get_chat_response(call_return)
+
+    @staticmethod
+    async def astream_chat(messages, stat=None, stream_usage=True, **openai_kwargs):
+        rprint(f"Call gpt (stream) with openai_kwargs={openai_kwargs}")
+        _client = OpenaiHelper.get_async_openai_client(
+            openai_kwargs.get("model", ""),
+            api_endpoint=openai_kwargs.get("api_base"),
+            api_key=openai_kwargs.get("api_key"),
+            fixed_endpoint=openai_kwargs.get("openai_endpoint"),
+        )
+        _kwargs = dict(openai_kwargs)
+        for k in ("api_base", "openai_endpoint", "api_key"):
+            _kwargs.pop(k, None)
+        if stream_usage:
+            _kwargs["stream_options"] = {"include_usage": True}
+        chat_stream = await _client.chat.completions.create(messages=messages, stream=True, **_kwargs)
+        _got_usage = False
+        try:
+            async for chunk in chat_stream:
+                chunk = chunk.to_dict()
+                if chunk.get("usage"):
+                    update_stat(stat, chunk)
+                    _got_usage = True
+                for choice in chunk.get("choices", [])[:1]:
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece:
+                        yield piece
+        finally:
+            await chat_stream.close()  # abort the generation if not finished
+            if not _got_usage:
+                update_stat(stat, {})  # still count the call
+
     @staticmethod
     def call_chat(messages, stat=None, **openai_kwargs):
         rprint(f"Call gpt with openai_kwargs={openai_kwargs}")
@@ -134,14 +398,8 @@ class OpenaiHelper:
         chat_completion = _client.chat.completions.create(messages=messages, **_kwargs)
         call_return = chat_completion.to_dict()
         update_stat(stat, call_return)
-        if "content" not in call_return["choices"][0]["message"]:
-            response = ""
-        else:
-            response = call_return["choices"][0]["message"]["content"]
-        if response.strip() == "":
-            raise RuntimeError(f"Get empty response from gpt: {call_return}")
-        return response
-    
+        return OpenaiHelper.get_chat_response(call_return)
+
 class Boto3Helper:
     _boto3_client = {}  # model_name -> Helper
 
@@ -150,8 +408,10 @@ class Boto3Helper:
         model_name_suffix = f"_{model_name}" if model_name else ""
         if model_name not in Boto3Helper._boto3_client:  # lazy init
             import boto3
+            from botocore.config import Config as BotoConfig
             if GET_ENV_VAR("AWS_ACCESS_KEY", f"AWS_ACCESS_KEY{model_name_suffix}") and GET_ENV_VAR("AWS_SECRET_ACCESS_KEY", f"AWS_SECRET_ACCESS_KEY{model_name_suffix}"):
                 client = boto3.client("bedrock-runtime", 
+                      config=BotoConfig(max_pool_connections=int(GET_ENV_VAR("LLM_HTTP_MAX_KEEPALIVE", df=20))),  # keep-alive pool shared by the threads
                       region_name=GET_ENV_VAR("AWS_REGION_NAME", df=region_name),
                       aws_access_key_id=GET_ENV_VAR("AWS_ACCESS_KEY", f"AWS_ACCESS_KEY{model_name_suffix}", df=api_key),
                     aws_secret_access_key=GET_ENV_VAR("AWS_SECRET_ACCESS_KEY", f"AWS_SECRET_ACCESS_KEY{model_name_suffix}", df=api_secret_key))
@@ -197,13 +457,8 @@ class Boto3Helper:
         ]
 
     @staticmethod
-    def call_chat(messages, stat=None, **boto3_kwargs):
-        rprint(f"Call gpt with boto3_kwargs={boto3_kwargs}")
-        # import pdb; pdb.set_trace()
-        _client = Boto3Helper.get_boto3_client(boto3_kwargs["model"])
-        # import pdb; pdb.set_trace()
-        # chat_completion = _client.chat.completions.create(messages=messages, **boto3_kwargs)
-        messages = Boto3Helper.to_bedrock_messages(messages)
+    def get_converse_kwargs(messages, **boto3_kwargs):
+        ret = {"modelId": GET_ENV_VAR("AWS_MODEL_ID", df="us.anthropic.claude-3-7-sonnet-20250219-v1:0"), "messages": Boto3Helper.to_bedrock_messages(messages)}
         if boto3_kwargs['thinking']:
             reasoning_config = {
                 "thinking": {
@@ -211,9 +466,17 @@ class Boto3Helper:
                     "budget_tokens": 2000
                 }
             }
-            chat_completion = _client.converse(modelId=GET_ENV_VAR("AWS_MODEL_ID", df="us.anthropic.claude-3-7-sonnet-20250219-v1:0"), messages=messages, additionalModelRequestFields=reasoning_config)
-        else:
-            chat_completion = _client.converse(modelId=GET_ENV_VAR("AWS_MODEL_ID", df="us.anthropic.claude-3-7-sonnet-20250219-v1:0"), messages=messages)
+            ret["additionalModelRequestFields"] = reasoning_config
+        return ret
+
+    @staticmethod
+    def call_chat(messages, stat=None, **boto3_kwargs):
+        rprint(f"Call gpt with boto3_kwargs={boto3_kwargs}")
+        # import pdb; pdb.set_trace()
+        _client = Boto3Helper.get_boto3_client(boto3_kwargs["model"])
+        # import pdb; pdb.set_trace()
+        # chat_completion = _client.chat.completions.create(messages=messages, **boto3_kwargs)
+        chat_completion = _client.converse(**Boto3Helper.get_converse_kwargs(messages, **boto3_kwargs))
         
         call_return = chat_completion
         update_stat(stat, call_return)
@@ -236,11 +499,80 @@ class Boto3Helper:
             raise RuntimeError(f"Get empty response from claude: {call_return}")
         return response
 
+    @staticmethod
+    async def acall_chat(messages, stat=None, **boto3_kwargs):
+        # note: there is no async api for boto3, simply run it in threads (the client itself is thread-safe and pooled)
+        return await asyncio.to_thread(Boto3Helper.call_chat, messages, stat=stat, **boto3_kwargs)
+
+    # sync generator of text pieces (checking stop_flag to abort)
+    @staticmethod
+    def iter_stream_chat(messages, stop_flag, stat=None, **boto3_kwargs):
+        rprint(f"Call gpt (stream) with boto3_kwargs={boto3_kwargs}")
+        _client = Boto3Helper.get_boto3_client(boto3_kwargs["model"])
+        chat_stream = _client.converse_stream(**Boto3Helper.get_converse_kwargs(messages, **boto3_kwargs))["stream"]
+        _got_usage, _curr_type = False, None
+        try:
+            for event in chat_stream:
+                if stop_flag.is_set():
+                    break
+                if "metadata" in event and "usage" in event["metadata"]:
+                    update_stat(stat, event["metadata"])
+                    _got_usage = True
+                delta = event.get("contentBlockDelta", {}).get("delta", {})
+                if "reasoningContent" in delta and delta["reasoningContent"].get("text"):
+                    if _curr_type != "reasoning":
+                        yield "Reasoning: "  # same format as the non-stream mode
+                        _curr_type = "reasoning"
+                    yield delta["reasoningContent"]["text"]
+                elif delta.get("text"):
+                    if _curr_type == "reasoning":
+                        yield "\n"
+                    _curr_type = "text"
+                    yield delta["text"]
+        finally:
+            chat_stream.close()
+            if not _got_usage:
+                update_stat(stat, {})  # still count the call
+
+    @staticmethod
+    async def astream_chat(messages, stat=None, **boto3_kwargs):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop_flag = threading.Event()
+        # --
+        def _produce():
+            try:
+                for piece in Boto3Helper.iter_stream_chat(messages, stop_flag, stat=stat, **boto3_kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, (piece, None))
+                loop.call_soon_threadsafe(queue.put_nowait, (None, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+        # --
+        loop.run_in_executor(None, contextvars.copy_context().run, _produce)  # keep the context vars (for the extra stat)
+        try:
+            while True:
+                piece, err = await queue.get()
+                if err is not None:
+                    raise err
+                if piece is None:
+                    break
+                yield piece
+        finally:
+            stop_flag.set()  # abort the producer
+
+
+# the routing key of the current call (for example, the session id), set by LLM.acall
+_AFFINITY_KEY = contextvars.ContextVar("llm_affinity_key", default=None)
 
 class LLM(KwargsInitializable):
+    ERROR_RESPONSE_PREFIXES = ("Error calling ", "Thought: Jailbreak or content filter violation detected.")  # the error strings returned (rather than raised) by the calls
+
     def __init__(self, **kwargs):
+        if isinstance(kwargs.get("call_target"), (list, tuple)):  # multiple equivalent endpoints
+            kwargs["call_target"] = ",".join(kwargs["call_target"])
         # basics
-        self.call_target = "manual"  # fake=fake, manual=input, gpt(gpt:model_name)=openai [such as gpt:gpt-4o-mini], request(http...)=request
+        self.call_target = "manual"  # fake=fake, manual=input, gpt(gpt:model_name)=openai [such as gpt:gpt-4o-mini], request(http...)=request, replay(replay:path)=recorded outputs
+        # note: multiple equivalent endpoints (of the same type) can be separated by ",", such as "http://a:8000/v1/chat/completions,http://b:8000/v1/chat/completions" or "gpt:gpt-4o-mini@http://a/v1,gpt:gpt-4o-mini@http://b/v1"
         self.thinking = False
         self.print_call_in = "white on blue"  # easier to read
         self.print_call_out = "white on green"  # easier to read
@@ -250,14 +582,38 @@ class LLM(KwargsInitializable):
         self.request_timeout = 100  # timeout time
         self.max_token_num = 32768
         self.call_kwargs = {"temperature": 0.0, "top_p": 0.95, "max_tokens": 4096}  # other kwargs for gpt/request calling
+        # replay: serve the recorded llm_output of the same llm_input from the session files (a jsonl file, a glob pattern or a dir)
+        self.replay_fallback = ""  # call_target to use if not found in the records (such as fake or gpt:gpt-4o-mini), empty means raising an error
+        self.response_cache = ResponseCache(_default_init=True)  # cache of responses (disabled by default)
+        self.tokenizer_name = "Qwen/Qwen3-32B"  # tokenizer for truncating messages of the request target
+        self.image_optimizer = ImageOptimizer(_default_init=True)  # shrink the images in the messages before sending (disabled by default, enable with image_optimizer={"enabled": True})
+        # stream
+        self.stream = False  # use streaming mode for the gpt/claude/request targets
+        self.stream_usage = True  # ask for the usage chunk in streaming mode (some older endpoints may not support this)
+        # endpoint control
+        self.endpoint_control = True  # adaptive concurrency/rate control of the endpoint (shared in the process)
+        self.endpoint_kwargs = {}  # kwargs for EndpointController (note: the first LLM creating the controller decides these)
+        # with multiple endpoints, each call goes to the healthy one with the lowest load*latency (requiring endpoint_control, otherwise randomly)
+        self.routing = "balance"  # balance=as above, affinity=calls with the same affinity_key (session) stick to one endpoint (for prefix caching) unless it is unavailable
+        # hedging: if a call has not returned after the observed latency quantile, send a duplicate one and take the first response
+        self.hedge = False
+        self.hedge_quantile = 0.9
+        self.hedge_min_samples = 20  # only hedge after observing enough latencies
+        self.hedge_min_delay = 1.  # do not hedge earlier than this (in seconds)
+        self.hedge_budget = 0.1  # at most this ratio of extra requests (over the calls under hedging)
         # --
         super().__init__(**kwargs)  # init
         # --
         # post init
+        self.call_targets = [z.strip() for z in self.call_target.split(",") if z.strip()]
         self.call_target_type = self.get_call_target_type()
         self.call_stat = {}  # stat of calling
+        self._replay_fallback_llm = None
         # --
-        self.message_truncator = MessageTruncator()
+
+    @property
+    def message_truncator(self):  # note: shared in the process and lazily loaded when first needed
+        return MessageTruncator.get_shared(self.tokenizer_name)
 
     def __repr__(self):
         return f"LLM(target={self.call_target},kwargs={self.call_kwargs})"
@@ -268,9 +624,180 @@ class LLM(KwargsInitializable):
     def set_seed(self, seed):
         self.seed = seed
 
-    def __call__(self, messages, **kwargs):
-        func = lambda: self._call_with_messages(messages, **kwargs)
-        return wrapped_trying(func, max_times=self.max_retry_times)
+    # stop_checker: Callable[[str], bool], in streaming mode, abort the generation once it returns True on the partial output
+    # affinity_key: routing key (such as the session id) for the affinity routing mode
+    # extra_stat: a dict to additionally collect the usage of this call (besides call_stat)
+    def __call__(self, messages, stop_checker=None, affinity_key=None, extra_stat=None, **kwargs):
+        check_cancelled()
+        with trace_span("llm.call", target=self.call_target) as span:
+            if span is not None and extra_stat is None:
+                extra_stat = {}  # to get the usage of this call
+            ret = AsyncRunner.run(self.acall(messages, stop_checker=stop_checker, affinity_key=affinity_key, extra_stat=extra_stat, **kwargs))  # simply run it in the shared loop
+            if span is not None:
+                span.set(**{k: extra_stat.get(k, 0) for k in ["prompt_tokens", "completion_tokens", "cached_tokens"]})
+        return ret
+
+    async def acall(self, messages, stop_checker=None, affinity_key=None, extra_stat=None, **kwargs):
+        _token, _token2 = _AFFINITY_KEY.set(affinity_key), _EXTRA_STAT.set(extra_stat)
+        try:
+            return await self._acall(messages, stop_checker=stop_checker, **kwargs)
+        finally:
+            _AFFINITY_KEY.reset(_token)
+            _EXTRA_STAT.reset(_token2)
+
+    async def _acall(self, messages, stop_checker=None, **kwargs):
+        # note: hashing and sqlite I/O are blocking, not in the loop
+        _cache_key = (await asyncio.to_thread(self.get_cache_key, messages, kwargs)) if self.response_cache.enabled else None
+        if _cache_key is not None:
+            _hit, ret = await asyncio.to_thread(self.response_cache.get, _cache_key)
+            _stat_key = "cache_hit" if _hit else "cache_miss"
+            self.call_stat[_stat_key] = self.call_stat.get(_stat_key, 0) + 1
+            if _hit:
+                if self.print_call_out:
+                    await asyncio.to_thread(rprint, [f"# == Cached result [key={_cache_key[:16]}] =>\n", (str(ret), self.print_call_out), "\n# =="])
+                return ret
+        if self.hedge and self.call_target_type in ["gpt", "claude", "request"]:
+            afunc = lambda: self._ahedged_call(messages, stop_checker=stop_checker, **kwargs)
+        else:
+            afunc = lambda: self._acall_with_messages(messages, stop_checker=stop_checker, **kwargs)
+        _controller = self.get_endpoint_controller(self.call_targets[0], kwargs)
+        _retry_wait = (lambda e: _controller.get_retry_wait()) if _controller is not None else None  # the pacing (and failover) is done by the controllers
+        _max_times = -1 if self.call_target_type == "replay" else self.max_retry_times  # no retrying for replaying
+        ret = await awrapped_trying(afunc, max_times=_max_times, retry_wait=_retry_wait)
+        if _cache_key is not None and LLM.is_cacheable_response(ret):
+            await asyncio.to_thread(self.response_cache.put, _cache_key, ret)
+        return ret
+
+    # only cache the normal responses (not the error strings, which are returned rather than raised by some targets)
+    @staticmethod
+    def is_cacheable_response(ret):
+        return isinstance(ret, str) and ret.strip() != "" and not ret.startswith(LLM.ERROR_RESPONSE_PREFIXES)
+
+    async def _ahedged_call(self, messages, stop_checker=None, **kwargs):
+        _stat = self.call_stat
+        _stat["hedge_eligible"] = _stat.get("hedge_eligible", 0) + 1
+        _delay = self.get_hedge_delay(kwargs)
+        afunc = lambda: self._acall_with_messages(messages, stop_checker=stop_checker, **kwargs)
+        if _delay is None:  # not enough information yet
+            return await afunc()
+        primary, backup = asyncio.ensure_future(afunc()), None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=_delay)
+            if done:
+                return primary.result()
+            if _stat.get("hedge_sent", 0) + 1 > self.hedge_budget * _stat["hedge_eligible"]:  # out of budget
+                _stat["hedge_budget_skip"] = _stat.get("hedge_budget_skip", 0) + 1
+                return await primary
+            _stat["hedge_sent"] = _stat.get("hedge_sent", 0) + 1
+            rprint(f"Send a hedged request after {_delay:.3f}s for {self.call_target}", style="white on yellow")
+            backup = asyncio.ensure_future(afunc())  # note: in the balance mode, it is likely to go to another endpoint since the primary one is more loaded now
+            pending, first_error = {primary, backup}, None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for one in done:
+                    if one.exception() is None:  # the first response wins
+                        if one is backup:
+                            _stat["hedge_won"] = _stat.get("hedge_won", 0) + 1
+                        return one.result()
+                    first_error = first_error or one.exception()
+            raise first_error
+        finally:  # cancel the loser (or all if we are cancelled)
+            for one in [primary, backup]:
+                if one is not None and not one.done():
+                    one.cancel()
+                    _stat["hedge_cancelled"] = _stat.get("hedge_cancelled", 0) + 1
+
+    def get_hedge_delay(self, kwargs=None):
+        _controllers = [self.get_endpoint_controller(z, kwargs) for z in self.call_targets]
+        if any(z is None for z in _controllers):
+            return None
+        _latency = EndpointController.get_latency_quantile(_controllers, self.hedge_quantile, min_samples=self.hedge_min_samples)
+        return None if _latency is None else max(self.hedge_min_delay, _latency)
+
+    def get_cache_key(self, messages, kwargs):
+        if not self.response_cache.enabled or self.call_target_type not in ["gpt", "claude", "request"]:
+            return None  # only cache the real calls
+        _call_kwargs = self.call_kwargs.copy()
+        _call_kwargs.update(kwargs)
+        if _call_kwargs.get("temperature", 1.) > 0 and not self.response_cache.cache_sampled:
+            return None  # only cache the deterministic calls by default
+        if self.call_target_type == "claude":
+            _call_kwargs["thinking"] = self.thinking
+        return self.response_cache.get_key(messages, self.call_target, _call_kwargs, self.seed)
+
+    # "gpt:model[@endpoint]" -> (model, endpoint)
+    @staticmethod
+    def parse_gpt_target(target: str):
+        _model = target.split(":", 1)[1]
+        if "@" in _model:
+            _model, _endpoint = _model.split("@", 1)
+            return _model, _endpoint
+        return _model, None
+
+    def get_endpoint_name(self, target, kwargs=None):
+        if self.call_target_type == "gpt":
+            _model, _endpoint = LLM.parse_gpt_target(target)
+            _endpoint = _endpoint or (kwargs or {}).get("api_base") or self.call_kwargs.get("api_base") or ""
+            return f"gpt:{_model}@{_endpoint}" if _endpoint else f"gpt:{_model}"
+        elif self.call_target_type == "request":
+            return HttpHelper.get_endpoint(target)
+        elif self.call_target_type == "claude":
+            return target
+        else:
+            return None  # no control for the others
+
+    def get_endpoint_controller(self, target, kwargs=None):
+        _name = self.get_endpoint_name(target, kwargs) if self.endpoint_control else None
+        if _name is None:
+            return None
+        return EndpointController.get_shared(_name, **self.endpoint_kwargs)
+
+    # select one target from the equivalent ones
+    def select_call_target(self, kwargs=None):
+        if len(self.call_targets) == 1:
+            return self.call_targets[0]
+        _targets = self.call_targets
+        _key = _AFFINITY_KEY.get() if self.routing == "affinity" else None
+        if _key is not None:  # rendezvous hashing: the preferred order is stable for the key and little affected by adding/removing endpoints
+            _targets = sorted(_targets, key=lambda z: hashlib.sha1(f"{_key}|{z}".encode()).digest(), reverse=True)
+        _controllers = [self.get_endpoint_controller(z, kwargs) for z in _targets]
+        if any(z is None for z in _controllers):
+            return _targets[0] if _key is not None else random.choice(_targets)
+        if _key is not None:
+            _now = time.monotonic()
+            for _ii, _controller in enumerate(_controllers):
+                if _controller.get_score(_now)[0] == 0:  # the first available one
+                    if _ii > 0:
+                        self.call_stat["affinity_fallback"] = self.call_stat.get("affinity_fallback", 0) + 1
+                    return _targets[_ii]
+            self.call_stat["affinity_fallback"] = self.call_stat.get("affinity_fallback", 0) + 1
+        return _targets[EndpointController.select(_controllers)]  # otherwise, the one with the lowest score
+
+    # a slot of the endpoint: waiting for the controller and reporting the outcome to it
+    # -- yield the target to use, which may be switched to another one while waiting (with multiple targets)
+    @contextlib.asynccontextmanager
+    async def _endpoint_slot(self, target, kwargs=None):
+        _controller = self.get_endpoint_controller(target, kwargs)
+        if _controller is None:
+            yield target
+            return
+        while True:
+            start, _wait = _controller.try_acquire()
+            if start is not None:
+                break
+            await asyncio.sleep(_controller.get_sleep_time(_wait))
+            target = self.select_call_target(kwargs)
+            _controller = self.get_endpoint_controller(target, kwargs)
+        async with _controller.slot(start):
+            yield target
+
+    def get_endpoint_metrics(self):  # endpoint_name -> metrics
+        ret = {}
+        for _trg in self.call_targets:
+            _controller = self.get_endpoint_controller(_trg)
+            if _controller is not None:
+                ret[_controller.name] = _controller.get_metrics()
+        return ret
 
     def get_call_stat(self, clear=False):
         ret = self.call_stat.copy()
@@ -282,7 +809,13 @@ class LLM(KwargsInitializable):
         self.call_stat.clear()
 
     def get_call_target_type(self):
-        _trg = self.call_target
+        all_types = set(self._get_one_target_type(z) for z in self.call_targets)
+        if len(all_types) != 1:
+            raise RuntimeError(f"Expecting one type of call_target, but get {self.call_target}")
+        return list(all_types)[0]
+
+    @staticmethod
+    def _get_one_target_type(_trg: str):
         if _trg == "manual":
             return "manual"
         elif _trg == "fake":
@@ -293,10 +826,12 @@ class LLM(KwargsInitializable):
             return "request"
         elif _trg.startswith("claude:"):
             return "claude"
+        elif _trg.startswith("replay:"):
+            return "replay"
         else:
             raise RuntimeError(f"UNK call_target = {_trg}")
 
-    def show_messages_str(self, messages, calling_kwargs, rprint_style):
+    def show_messages_str(self, messages, calling_kwargs, rprint_style, target=None):
         ret_ss = []
         if isinstance(messages, list):
             for one_mesg in messages:
@@ -306,79 +841,188 @@ class LLM(KwargsInitializable):
                 ret_ss.extend([f"=====\n", (f"{one_mesg['role']}: {_content}\n", rprint_style)])
         else:
             ret_ss.append((f"{messages}\n", rprint_style))
-        ret = [f"### ----- Call {self.call_target} with {calling_kwargs} [ctime={time.ctime()}]\n{'#'*10}\n"] + ret_ss + [f"{'#'*10}"]
+        ret = [f"### ----- Call {target or self.call_target} with {calling_kwargs} [ctime={time.ctime()}]\n{'#'*10}\n"] + ret_ss + [f"{'#'*10}"]
         return ret
 
     # still return a str here, for simplicity!
-    def _call_with_messages(self, messages, **kwargs):
+    async def _acall_with_messages(self, messages, stop_checker=None, **kwargs):
         time0 = time.perf_counter()
         _call_target_type = self.call_target_type
         _call_kwargs = self.call_kwargs.copy()
         _call_kwargs.update(kwargs)  # this time's kwargs
-        if self.print_call_in:
-            rprint(self.show_messages_str(messages, _call_kwargs, self.print_call_in))  # print it out
+        _target = self.select_call_target(_call_kwargs)
+        if self.print_call_in:  # note: rendering (possibly long) messages, not in the loop
+            await asyncio.to_thread(lambda: rprint(self.show_messages_str(messages, _call_kwargs, self.print_call_in, target=_target)))  # print it out
+        if _call_target_type in ["gpt", "claude", "request"] and self.image_optimizer.enabled and isinstance(messages, list) and have_images_in_messages(messages):
+            messages = await asyncio.to_thread(self.image_optimizer.optimize_messages, messages, stat=self.call_stat)  # note: cpu-heavy, not in the loop
         # --
         if _call_target_type == "manual":
-            user_input = input("Put your input >> ")
+            user_input = await asyncio.to_thread(input, "Put your input >> ")
             response = user_input.strip()
             ret = response
         elif _call_target_type == "fake":
             ret = "You are correct! As long as you are happy!"
         elif _call_target_type == "gpt":
-            ret = self._call_openai_chat(messages, **_call_kwargs)
+            ret = await self._acall_openai_chat(messages, _target, stop_checker=stop_checker, **_call_kwargs)
         elif _call_target_type == "claude":
             _call_kwargs['thinking'] = self.thinking or self.thinking == "True"
-            ret = self._call_claude_chat(messages, **_call_kwargs)
+            ret = await self._acall_claude_chat(messages, _target, stop_checker=stop_checker, **_call_kwargs)
         elif _call_target_type == "request":
-            messages = self.message_truncator.truncate_message_list(messages, self.max_token_num)
-            headers = {"Content-Type": "application/json"}
-            if isinstance(messages, list):
-                json_data = {
-                    "model": "ck",
-                    "stop": ["<|eot_id|>", "<|eom_id|>", "<|im_end|>"],
-                    "messages": messages,
-                }
-                if self.seed != 0:  # only if non-zero!
-                    json_data.update(seed=self.seed)
-            else:  # directly put it!
-                json_data = messages.copy()
-            json_data.update(_call_kwargs)
-            r = requests.post(self.call_target, headers=headers, json=json_data, timeout=self.request_timeout)
-            assert (200 <= r.status_code <= 300), f"response error: {r.status_code} {json_data}"
-            call_return = r.json()
-            if isinstance(call_return, dict) and "choices" in call_return:
-                update_stat(self.call_stat, call_return)
-                ret0 = call_return["choices"][0]
-                if "message" in ret0:
-                    ret = ret0["message"]["content"]  # chat-format
-                    # thought = ret0["message"]["reasoning_content"] # for qwen3
-                    # remove <think> </think> tokens
-                    import re
-                    ret = re.sub(r'<think>.*?</think>', '', ret, flags=re.DOTALL)
-                else:
-                    ret = ret0["text"]
-            else:  # directly return the full object
-                ret = call_return
+            ret = await self._acall_request(messages, _target, stop_checker=stop_checker, **_call_kwargs)
+        elif _call_target_type == "replay":
+            ret = await self._acall_replay(messages, stop_checker=stop_checker, **kwargs)
         else:
             ret = None
         # --
         assert ret is not None, f"Calling failed for {_call_target_type}"
         if self.print_call_out:
             ss = [f"# == Calling result [ctime={time.ctime()}, interval={time.perf_counter() - time0:.3f}s] =>\n", (ret, self.print_call_out), "\n# =="]
-            rprint(ss)
+            await asyncio.to_thread(rprint, ss)
+        return ret
+
+    def _get_request_data(self, messages, kwargs):
+        messages = self.message_truncator.truncate_message_list(messages, self.max_token_num, stat=self.call_stat)
+        if isinstance(messages, list):
+            json_data = {
+                "model": "ck",
+                "stop": ["<|eot_id|>", "<|eom_id|>", "<|im_end|>"],
+                "messages": messages,
+            }
+            if self.seed != 0:  # only if non-zero!
+                json_data.update(seed=self.seed)
+        else:  # directly put it!
+            json_data = messages.copy()
+        json_data.update(kwargs)
+        return json_data
+
+    async def _acall_request(self, messages, target, stop_checker=None, **kwargs):
+        if self.stream and isinstance(messages, list):
+            async with self._endpoint_slot(target, kwargs) as target:
+                ret = await self._acollect_stream(self._astream_request(messages, target, **kwargs), stop_checker)
+            ret = remove_think_str(ret)
+            return ret
+        json_data = await asyncio.to_thread(self._get_request_data, messages, kwargs)  # note: tokenizing for truncation, not in the loop
+        async with self._endpoint_slot(target, kwargs) as target:
+            call_return = await HttpHelper.post_json(target, json_data, timeout=self.request_timeout)
+        if isinstance(call_return, dict) and "choices" in call_return:
+            update_stat(self.call_stat, call_return)
+            ret0 = call_return["choices"][0]
+            if "message" in ret0:
+                ret = ret0["message"]["content"]  # chat-format
+                # thought = ret0["message"]["reasoning_content"] # for qwen3
+                # remove <think> </think> tokens
+                ret = remove_think_str(ret)
+            else:
+                ret = ret0["text"]
+        else:  # directly return the full object
+            ret = call_return
+        return ret
+
+    async def _astream_request(self, messages, target, **kwargs):
+        json_data = await asyncio.to_thread(self._get_request_data, messages, kwargs)
+        json_data["stream"] = True
+        if self.stream_usage:
+            json_data["stream_options"] = {"include_usage": True}
+        _got_usage = False
+        try:
+            async for chunk in HttpHelper.stream_json(target, json_data, timeout=self.request_timeout):
+                if chunk.get("usage"):
+                    update_stat(self.call_stat, chunk)
+                    _got_usage = True
+                for choice in chunk.get("choices", [])[:1]:
+                    piece = (choice.get("delta") or {}).get("content") or choice.get("text")
+                    if piece:
+                        yield piece
+        finally:
+            if not _got_usage:
+                update_stat(self.call_stat, {})  # still count the call
+
+    async def _acall_replay(self, messages, stop_checker=None, **kwargs):
+        # note: loading the files and hashing are blocking, not in the loop
+        _store = await asyncio.to_thread(ReplayStore.get_shared, [z.split(":", 1)[1] for z in self.call_targets])  # note: all the targets are loaded together
+        _hit, ret = await asyncio.to_thread(_store.get, messages)
+        _stat_key = "replay_hit" if _hit else "replay_miss"
+        self.call_stat[_stat_key] = self.call_stat.get(_stat_key, 0) + 1
+        if not _hit:
+            if not self.replay_fallback:
+                raise RuntimeError(f"No recorded output found in {self.call_target} for the input [key={ReplayStore.get_key(messages)[:16]}]")
+            if self._replay_fallback_llm is None:  # lazy init
+                self._replay_fallback_llm = LLM(call_target=self.replay_fallback, call_kwargs=self.call_kwargs, print_call_in="", print_call_out="", _default_init=True)
+                self._replay_fallback_llm.call_stat = self.call_stat  # share the stat
+            ret = await self._replay_fallback_llm.acall(messages, stop_checker=stop_checker, affinity_key=_AFFINITY_KEY.get(), **kwargs)
         return ret
 
-    def _call_openai_chat(self, messages, **kwargs):
-        _gpt_kwargs = {"model": self.call_target.split(":", 1)[1]}
-        _gpt_kwargs.update(kwargs)
+    # yield the pieces of the response as they arrive
+    async def astream(self, messages, **kwargs):
+        _call_target_type = self.call_target_type
+        _call_kwargs = self.call_kwargs.copy()
+        _call_kwargs.update(kwargs)  # this time's kwargs
+        _target = self.select_call_target(_call_kwargs)
+        if _call_target_type == "gpt":
+            agen = OpenaiHelper.astream_chat(messages, stat=self.call_stat, stream_usage=self.stream_usage, **self._get_gpt_kwargs(_target, _call_kwargs))
+        elif _call_target_type == "claude":
+            _claude_kwargs = {"model": _target.split(":", 1)[1], "thinking": self.thinking or self.thinking == "True"}
+            _claude_kwargs.update(_call_kwargs)
+            agen = Boto3Helper.astream_chat(messages, stat=self.call_stat, **_claude_kwargs)
+        elif _call_target_type == "request":
+            agen = self._astream_request(messages, _target, **_call_kwargs)
+        else:  # simply put the full one
+            agen = None
+        if agen is None:
+            yield await self._acall_with_messages(messages, **kwargs)
+        else:
+            try:
+                async for piece in agen:
+                    yield piece
+            finally:
+                await agen.aclose()
+
+    # collect the pieces and check whether we can stop early
+    async def _acollect_stream(self, agen, stop_checker):
+        time0 = time.perf_counter()
+        pieces = []
+        try:
+            async for piece in agen:
+                if not pieces:  # time to the first token
+                    self.call_stat["ttft_count"] = self.call_stat.get("ttft_count", 0) + 1
+                    self.call_stat["ttft_time"] = self.call_stat.get("ttft_time", 0) + (time.perf_counter() - time0)
+                pieces.append(piece)
+                if stop_checker is not None and "`" in piece:  # note: only need to check when there can be a closing mark
+                    if stop_checker(remove_think_str("".join(pieces), keep_unclosed=False)):
+                        self.call_stat["stream_cutoff"] = self.call_stat.get("stream_cutoff", 0) + 1
+                        break
+        finally:
+            await agen.aclose()  # abort the generation if not finished
+        return "".join(pieces)
+
+    def _get_gpt_kwargs(self, target, kwargs):
+        _model, _endpoint = LLM.parse_gpt_target(target)
+        ret = {"model": _model}
+        ret.update(kwargs)
+        if _endpoint:
+            ret["openai_endpoint"] = _endpoint
+        return ret
+
+    async def _acall_openai_chat(self, messages, target, stop_checker=None, **kwargs):
+        _controller = self.get_endpoint_controller(target, kwargs)
         while True:
             try:
-                ret = OpenaiHelper().call_chat(messages, stat=self.call_stat, **_gpt_kwargs)
+                async with self._endpoint_slot(target, kwargs) as target:
+                    _gpt_kwargs = self._get_gpt_kwargs(target, kwargs)
+                    if self.stream:
+                        ret = await self._acollect_stream(OpenaiHelper.astream_chat(messages, stat=self.call_stat, stream_usage=self.stream_usage, **_gpt_kwargs), stop_checker)
+                    else:
+                        ret = await OpenaiHelper.acall_chat(messages, stat=self.call_stat, **_gpt_kwargs)
+                if self.stream and ret.strip() == "":
+                    raise RuntimeError(f"Get empty response from gpt (stream)")
                 return ret
             except Exception as e:  # simply catch everything!
                 rprint(f"Get error when calling gpt: {e}", style="white on red")
                 if type(e).__name__ in ["RateLimitError"]:
-                    time.sleep(10)
+                    self.call_stat["throttled"] = self.call_stat.get("throttled", 0) + 1
+                    if _controller is None:
+                        await asyncio.sleep(10)
+                    # otherwise, the controller will make us wait for the next slot (or switch to another endpoint)
                 elif type(e).__name__ == "BadRequestError":
                     error_str = str(e)
                     if "ResponsibleAIPolicyViolation" in error_str or "content_filter" in error_str:
@@ -391,24 +1035,39 @@ class LLM(KwargsInitializable):
                     break
         return None
 
-    def _call_claude_chat(self, messages, **kwargs):
-        _claude_kwargs = {"model": self.call_target.split(":", 1)[1]}
-        _claude_kwargs.update(kwargs)
+    async def _acall_claude_chat(self, messages, target, stop_checker=None, **kwargs):
         import botocore
+        _controller = self.get_endpoint_controller(target, kwargs)
         while True:
             try:
-                ret = Boto3Helper().call_chat(messages, stat=self.call_stat, **_claude_kwargs)
+                async with self._endpoint_slot(target, kwargs) as target:
+                    _claude_kwargs = {"model": target.split(":", 1)[1]}
+                    _claude_kwargs.update(kwargs)
+                    if self.stream:
+                        ret = await self._acollect_stream(Boto3Helper.astream_chat(messages, stat=self.call_stat, **_claude_kwargs), stop_checker)
+                    else:
+                        ret = await Boto3Helper.acall_chat(messages, stat=self.call_stat, **_claude_kwargs)
+                if self.stream and ret.strip() == "":
+                    raise RuntimeError(f"Get empty response from claude (stream)")
                 return ret
             # except Exception as e:  # simply catch everything!
             except botocore.exceptions.ClientError as e:
                 rprint(f"Get error when calling gpt: {e}", style="white on red")
-                if e.response['Error']['Code'] == 'LimitExceededException':
-                    time.sleep(10)
+                if e.response['Error']['Code'] in ['LimitExceededException', 'ThrottlingException']:
+                    self.call_stat["throttled"] = self.call_stat.get("throttled", 0) + 1
+                    if _controller is None:
+                        await asyncio.sleep(10)
+                    # otherwise, the controller will make us wait for the next slot (or switch to another endpoint)
                 else:
                     return f"Error calling Claude: {e}"
         return None
 
 
+# --
+# load the shared tokenizer in advance (for example, before forking the workers)
+def preload_shared_tokenizer(model_name="Qwen/Qwen3-32B"):
+    return MessageTruncator.get_shared(model_name)
+
 # --
 def test_llm():
     llm = LLM(call_target="gpt:gpt-4o-mini")
@@ -0,0 +1,79 @@
+#
+
+# replaying the recorded LLM outputs (llm_input/llm_output pairs stored in the session files), matched by message hash
+
+import os
+import glob
+import json
+import hashlib
+import threading
+from collections import defaultdict
+from .utils import rprint
+from .blob import BlobStore
+from .session import decode_session_io
+
+class ReplayStore:
+    _shared_stores = {}  # paths -> ReplayStore
+    _shared_lock = threading.Lock()
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.outputs = defaultdict(list)  # hash -> [outputs]
+        self.cursors = defaultdict(int)  # hash -> next one to use
+        self.lock = threading.Lock()
+        for one_file in self.get_files(self.paths):
+            self.load_file(one_file)
+        rprint(f"Load replay store from {self.paths}: {len(self.outputs)} inputs, {sum(len(z) for z in self.outputs.values())} outputs")
+
+    @staticmethod
+    def get_shared(paths):
+        _key = tuple(paths)
+        with ReplayStore._shared_lock:
+            if _key not in ReplayStore._shared_stores:  # lazy init
+                ReplayStore._shared_stores[_key] = ReplayStore(paths)
+            return ReplayStore._shared_stores[_key]
+
+    @staticmethod
+    def get_files(paths):
+        ret = []
+        for path in paths:
+            if os.path.isdir(path):
+                ret.extend(sorted(glob.glob(os.path.join(path, "**", "*.jsonl"), recursive=True)))
+            else:
+                ret.extend(sorted(glob.glob(path)))
+        return ret
+
+    @staticmethod
+    def get_key(messages):
+        _s = json.dumps(messages, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(_s.encode()).hexdigest()
+
+    def load_file(self, file: str):
+        blob_store = BlobStore.find_for_file(file)  # note: the inputs should be rehydrated to match the live ones
+        with open(file) as fd:
+            for line in fd:
+                if line.strip():
+                    inst = json.loads(line)
+                    self.add_pairs(decode_session_io(blob_store.rehydrate(inst) if blob_store is not None else inst))
+
+    # recursively find all the pairs (including the ones in the sub-agents' sessions)
+    def add_pairs(self, obj):
+        if isinstance(obj, dict):
+            if "llm_input" in obj and "llm_output" in obj:
+                self.outputs[self.get_key(obj["llm_input"])].append(obj["llm_output"])
+            for v in obj.values():
+                self.add_pairs(v)
+        elif isinstance(obj, list):
+            for v in obj:
+                self.add_pairs(v)
+
+    # return (hit, output); for repeated inputs, the recorded outputs are replayed in order (cycling)
+    def get(self, messages):
+        _key = self.get_key(messages)
+        with self.lock:
+            _outputs = self.outputs.get(_key)
+            if not _outputs:
+                return False, None
+            _idx = self.cursors[_key]
+            self.cursors[_key] = _idx + 1
+            return True, _outputs[_idx % len(_outputs)]
@@ -0,0 +1,263 @@
+#
+
+# a pool of pre-warmed worker processes for executing the action code (isolated from the agent process):
+# the tools and sub-agents are proxied back to the parent, with resource limits and hard killing on timeout
+
+import os
+import pickle
+import threading
+import importlib
+import contextvars
+import concurrent.futures
+import multiprocessing as mp
+from .utils import KwargsInitializable, CodeExecutor, ExecWatchdog, ExecTimeoutError, ExecTimeoutExit, zwarn
+from .cancel import new_child_cancel_token, set_cancel_token, reset_cancel_token
+
+class SandboxPool(KwargsInitializable):
+    def __init__(self, **kwargs):
+        self.enabled = False  # whether executing the code in the sandbox processes
+        self.size = 2  # number of idle workers to keep (more will be started if needed)
+        self.start_method = "spawn"  # note: not forking the (multi-threaded) agent process
+        self.preload_modules = ["os", "sys", "re", "json", "math", "time", "datetime", "random", "collections", "itertools", "functools", "numpy", "pandas"]  # skipped if not available
+        self.memory_limit_mb = 4096  # address space limit of a worker (0 means no limit)
+        self.cpu_limit = 0  # cpu seconds for one run (0 means using the run's timeout, no limit if both are 0)
+        self.max_jobs = 100  # recycle a worker after this number of runs
+        self.max_concurrent_calls = 16  # max number of concurrent proxied calls of one run (for example, with the parallel tool)
+        self.poll_interval = 0.1
+        # --
+        super().__init__(**kwargs)
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._idle = []  # idle workers
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    # note: simply re-create things in the new process
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        for k in ["_idle", "_lock", "_pid"]:
+            del ret[k]
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def get_executor(self):
+        return SandboxExecutor(pool=self)
+
+    def warmup(self):
+        with self._lock:
+            self._check_pid()
+            while len(self._idle) < self.size:
+                self._idle.append(SandboxWorker(self))
+
+    def acquire(self):
+        with self._lock:
+            self._check_pid()
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+        return SandboxWorker(self)
+
+    def release(self, worker, reusable: bool):
+        if reusable and worker.is_alive() and worker.num_jobs < self.max_jobs:
+            with self._lock:
+                if len(self._idle) < self.size and self._pid == os.getpid():
+                    self._idle.append(worker)
+                    return
+        worker.stop()
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.stop()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():  # note: do not use the parent's workers
+            self._idle, self._pid = [], os.getpid()
+
+class SandboxWorker:
+    def __init__(self, pool: SandboxPool):
+        _ctx = mp.get_context(pool.start_method)
+        self.conn, _child_conn = _ctx.Pipe()
+        self.process = _ctx.Process(target=sandbox_worker_main, args=(_child_conn, pool.preload_modules, pool.memory_limit_mb), daemon=True)
+        self.process.start()
+        _child_conn.close()
+        self.num_jobs = 0
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            if self.process.is_alive():
+                self.conn.send(("stop", None))
+                self.process.join(timeout=1)
+        except Exception:
+            pass
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=1)
+        self.conn.close()
+
+# the same interface as CodeExecutor, but running in a sandbox worker
+class SandboxExecutor(CodeExecutor):
+    def __init__(self, pool: SandboxPool, global_dict=None):
+        super().__init__(global_dict=global_dict)
+        self.pool = pool
+
+    def run(self, code, catch_exception=True, null_stdin=None, timeout=0):
+        if null_stdin is None:
+            null_stdin = self.null_stdin
+        _cpu_limit = self.pool.cpu_limit if self.pool.cpu_limit > 0 else timeout
+        _functions = {k: v for k, v in self.globals.items() if callable(v)}
+        job = {"code": code, "functions": [k for k, v in _functions.items() if not getattr(v, "run_locally", False)],
+               "local_functions": {k: v for k, v in _functions.items() if getattr(v, "run_locally", False)},  # such as the parallel tool
+               "catch_exception": catch_exception, "null_stdin": null_stdin, "cwd": os.getcwd(), "cpu_limit": _cpu_limit}
+        worker = self.pool.acquire()
+        worker.num_jobs += 1
+        watchdog = ExecWatchdog(timeout) if timeout > 0 else None  # note: only interrupting this thread, not the proxied calls
+        call_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.max_concurrent_calls, thread_name_prefix="sandbox_call")
+        call_token = new_child_cancel_token()  # note: the proxied calls (sub-agents, tools) run under this, which is cancelled when the run is over
+        send_lock = threading.Lock()
+        reusable, err = False, None
+        try:
+            if watchdog is not None:
+                watchdog.start()
+            worker.conn.send(("run", job))
+            while True:
+                if not worker.conn.poll(self.pool.poll_interval):
+                    if not worker.is_alive():
+                        raise EOFError("worker exited")
+                    continue
+                kind, *args = worker.conn.recv()
+                if kind == "call":  # call the function here (in another thread, since there can be concurrent calls) and send back the results
+                    call_executor.submit(contextvars.copy_context().run, self._handle_call, worker.conn, send_lock, call_token, *args)
+                elif kind == "done":
+                    _results, err = args
+                    self.results.extend(_results)
+                    reusable = True
+                    break
+        except (ExecTimeoutError, ExecTimeoutExit):
+            worker.kill()  # hard kill
+            self.custom_print(f"Code Execution Error:\nExecTimeoutError: Code execution exceeded timeout ({timeout}s) and the sandbox process is killed.\n-> Please revise your code and simplify the next step to control the runtime.")
+            zwarn(f"Kill the sandbox worker due to timeout ({timeout}s)")
+        except (EOFError, OSError) as e:  # the worker is dead, probably because of exceeding the resource limits
+            worker.kill()
+            self.custom_print(f"Code Execution Error:\nSandboxError: The sandbox process exited unexpectedly ({e}, exitcode={worker.process.exitcode}), probably because of exceeding the cpu/memory limits.\n-> Please revise your code and simplify the next step to control the resource usage.")
+            zwarn(f"Sandbox worker exited unexpectedly: {e}")
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+            call_token.cancel("sandbox run finished or killed")  # stop the calls that are still running (after timeout or the worker's death)
+            call_executor.shutdown(wait=False, cancel_futures=True)
+            self.pool.release(worker, reusable)
+        if err is not None and not catch_exception:
+            raise RuntimeError(f"Error executing code in the sandbox: {err}")
+
+    def _handle_call(self, conn, send_lock, cancel_token, call_id, name, args, kwargs):
+        _ctx_token = set_cancel_token(cancel_token)
+        try:
+            kind, value = "ret", self.globals[name](*args, **kwargs)
+        except BaseException as e:
+            kind, value = "err", e
+        finally:
+            reset_cancel_token(_ctx_token)
+        with send_lock:
+            try:
+                conn.send(("ret", call_id, kind, value))
+            except (EOFError, OSError):  # the worker is already gone
+                pass
+            except Exception:  # cannot pickle
+                conn.send(("ret", call_id, kind, (RuntimeError(repr(value)) if kind == "err" else str(value))))
+
+# --
+# the worker side
+
+def sandbox_worker_main(conn, preload_modules, memory_limit_mb):
+    try:
+        import resource
+    except ImportError:  # not available on this platform
+        resource = None
+    if resource is not None and memory_limit_mb > 0:
+        _limit = int(memory_limit_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (_limit, _limit))
+    for _module in preload_modules:
+        try:
+            importlib.import_module(_module)
+        except Exception:
+            pass
+    while True:
+        try:
+            kind, job = conn.recv()
+        except EOFError:
+            break
+        if kind == "stop":
+            break
+        if resource is not None and job["cpu_limit"] > 0:  # killed by SIGXCPU if exceeded
+            _used = resource.getrusage(resource.RUSAGE_SELF)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(_used.ru_utime + _used.ru_stime + job["cpu_limit"]) + 1, resource.RLIM_INFINITY))
+        os.chdir(job["cwd"])
+        client = SandboxRpcClient(conn)
+        executor = CodeExecutor(global_dict={name: client.get_proxy(name) for name in job["functions"]})
+        executor.add_global_vars(**job["local_functions"])
+        err = None
+        try:
+            executor.run(job["code"], catch_exception=job["catch_exception"], null_stdin=job["null_stdin"])
+        except BaseException as e:
+            err = f"{type(e).__name__}: {e}"
+        if resource is not None and job["cpu_limit"] > 0:
+            resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+        conn.send(("done", [_to_picklable(z) for z in executor.results], err))
+
+# calling the functions in the parent (thread-safe: the waiting callers take turns to read the replies)
+class SandboxRpcClient:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cond = threading.Condition()
+        self.replies = {}  # call_id -> (kind, value)
+        self.reading = False
+        self.next_id = 0
+
+    def get_proxy(self, name):
+        def _proxy(*args, **kwargs):
+            return self.call(name, args, kwargs)
+        _proxy.__name__ = name
+        return _proxy
+
+    def call(self, name, args, kwargs):
+        with self.cond:
+            call_id = self.next_id
+            self.next_id += 1
+            self.conn.send(("call", call_id, name, args, kwargs))
+            while call_id not in self.replies:
+                if self.reading:  # another one is reading
+                    self.cond.wait()
+                    continue
+                self.reading = True
+                self.cond.release()
+                try:
+                    _, _reply_id, _kind, _value = self.conn.recv()
+                finally:
+                    self.cond.acquire()
+                    self.reading = False
+                    self.cond.notify_all()
+                self.replies[_reply_id] = (_kind, _value)
+            kind, value = self.replies.pop(call_id)
+        if kind == "err":
+            raise value
+        return value
+
+def _to_picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return obj
+    except Exception:
+        return str(obj)
@@ -3,7 +3,7 @@
 # a session of one task running
 
 __all__ = [
-    "AgentSession",
+    "AgentSession", "decode_session_io",
 ]
 
 from .utils import get_unique_id
@@ -15,14 +15,22 @@ class AgentSession:
         self.info.update(kwargs)
         self.task = task  # target task
         self.steps = []  # a list of dicts to indicate each step's running, simply use dict to max flexibility
+        self.stats = {}  # incremental counters of the steps (error steps, observation sizes, time of each phase, ...)
+        self.io_segments = []  # shared segments (lines) of the stored llm inputs (if encoded by encode_io)
+        self._io_segment_index = None  # segment -> idx (lazily built)
 
-    def to_dict(self):
-        return self.__dict__.copy()
+    # if blob_store is given, the large payloads (such as screenshots) are stored there and replaced by references
+    def to_dict(self, blob_store=None):
+        ret = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        if blob_store is not None:
+            ret = blob_store.dedup(ret)
+        return ret
 
     def from_dict(self, data: dict):
         for k, v in data.items():
             assert k in self.__dict__
             self.__dict__[k] = v
+        self._io_segment_index = None
 
     @classmethod
     def init_from_dict(cls, data: dict):
@@ -55,3 +63,65 @@ class AgentSession:
 
     def add_step(self, step_info):
         self.steps.append(step_info)
+
+    def update_stats(self, **kwargs):
+        for k, v in kwargs.items():
+            self.stats[k] = self.stats.get(k, 0) + v
+
+    def get_stat(self, key: str, df=0):
+        return self.stats.get(key, df)
+
+    # compact encoding of the llm inputs: the strings are split into lines which are stored once in io_segments,
+    # and each string is replaced by {"__segs__": [idx or [start, end], ...]} (the runs of consecutive segments are merged)
+    def encode_io(self, obj, min_len=64):
+        if isinstance(obj, str):
+            if len(obj) < min_len:
+                return obj
+            if self._io_segment_index is None:
+                self._io_segment_index = {z: i for i, z in enumerate(self.io_segments)}
+            runs = []
+            for line in obj.split("\n"):
+                _idx = self._io_segment_index.get(line)
+                if _idx is None:
+                    _idx = len(self.io_segments)
+                    self.io_segments.append(line)
+                    self._io_segment_index[line] = _idx
+                if runs and isinstance(runs[-1], list) and runs[-1][1] + 1 == _idx:
+                    runs[-1][1] = _idx
+                elif runs and isinstance(runs[-1], int) and runs[-1] + 1 == _idx:
+                    runs[-1] = [runs[-1], _idx]
+                else:
+                    runs.append(_idx)
+            return {SEGS_KEY: runs}
+        elif isinstance(obj, dict):
+            return {k: self.encode_io(v, min_len) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return [self.encode_io(v, min_len) for v in obj]
+        else:
+            return obj
+
+# --
+SEGS_KEY = "__segs__"
+
+def _decode_segs(runs, segments):
+    lines = []
+    for one in runs:
+        if isinstance(one, list):
+            lines.extend(segments[one[0]:one[1]+1])
+        else:
+            lines.append(segments[one])
+    return "\n".join(lines)
+
+# rebuild the exact llm inputs of the (dict of) sessions stored with encode_io (also for the sub-agents' sessions inside)
+def decode_session_io(obj, segments=None):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and SEGS_KEY in obj and segments is not None:
+            return _decode_segs(obj[SEGS_KEY], segments)
+        if isinstance(obj.get("io_segments"), list):  # a session
+            segments = obj["io_segments"]
+            return {k: (v if k == "io_segments" else decode_session_io(v, segments)) for k, v in obj.items()}
+        return {k: decode_session_io(v, segments) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [decode_session_io(v, segments) for v in obj]
+    else:
+        return obj
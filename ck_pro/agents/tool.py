@@ -1,7 +1,8 @@
 #
 
 import requests
-from .utils import KwargsInitializable, rprint, GET_ENV_VAR
+from .utils import KwargsInitializable, rprint, GET_ENV_VAR, run_parallel
+from .trace import traced_tool_call
 
 class Tool(KwargsInitializable):
     def __init__(self, **kwargs):
@@ -14,6 +15,12 @@ class Tool(KwargsInitializable):
     def __call__(self, *args, **kwargs):
         raise NotImplementedError("To be implemented")
 
+    # note: trace the calls of all the tools
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "__call__" in cls.__dict__:
+            cls.__call__ = traced_tool_call(cls.__dict__["__call__"])
+
 # --
 # useful tools
 
@@ -54,6 +61,38 @@ def stop(output: str, log: str) -> dict:
             self.agent.put_final_result(ret)  # mark end and put final result
         return ret
 
+class ParallelTool(Tool):
+    def __init__(self, max_workers=4, timeout=0):
+        super().__init__(name="parallel")
+        self.max_workers = max_workers  # max number of concurrent calls
+        self.timeout = timeout  # timeout (in seconds) for each call (0 means no timeout)
+        self.run_locally = True  # note: run where the code runs (even in the sandbox), the calls inside are proxied as usual
+
+    def get_function_definition(self, short: bool):
+        if short:
+            return """- def parallel(calls: list) -> list:  # Run multiple independent sub-agent or tool calls concurrently and return their results in order."""
+        else:
+            return """- parallel
+```python
+def parallel(calls: list) -> list:
+    \""" Run multiple independent sub-agent or tool calls concurrently and return their results in order.
+    Args:
+        calls (list): The calls to run, each one is a function without arguments (such as a lambda or functools.partial), which is called inside `parallel`.
+    Returns:
+        list: The results of the calls, in the same order as the inputs. If a call fails or times out, its result is an error message string.
+    Notes:
+        - Only use this for calls that are independent of each other (no call needs the result of another one).
+        - Each call should still be a complete and self-contained task.
+        - Wrap each call in a lambda. Do NOT write `parallel([web_agent(task=...), web_agent(task=...)])`, which runs the calls one by one before `parallel` is called.
+    Examples:
+        >>> results = parallel([lambda: web_agent(task="Find the population of Paris in 2020."), lambda: web_agent(task="Find the population of Berlin in 2020.")])
+        >>> print(results)
+    \"""
+```"""
+
+    def __call__(self, calls: list):
+        return run_parallel(calls, max_workers=self.max_workers, timeout=self.timeout)
+
 class AskLLMTool(Tool):
     def __init__(self, llm=None):
         super().__init__(name="ask_llm")
@@ -0,0 +1,119 @@
+#
+
+# hierarchical span tracing (agent run -> step phases -> sub-agents / LLM calls / env requests / tool calls):
+# one tracer for each top-level run, and the current span is passed down through a context var (no-op if not tracing)
+
+import os
+import json
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+class Span:
+    def __init__(self, tracer, span_id: int, parent_id, name: str, attrs: dict):
+        self.tracer = tracer
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end_time = None
+        self.tid = threading.get_ident()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+
+    def to_dict(self):
+        _t0 = self.tracer.start
+        _end = self.end_time if self.end_time is not None else time.perf_counter()
+        return {"id": self.span_id, "parent": self.parent_id, "name": self.name, "start": round(self.start - _t0, 6),
+                "dur": round(_end - self.start, 6), "tid": self.tid, "attrs": self.attrs}
+
+class Tracer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, parent=None, **attrs):
+        with self._lock:
+            span = Span(self, len(self.spans), (parent.span_id if parent is not None else None), name, attrs)
+            self.spans.append(span)
+        return span
+
+    # a list of span dicts (start and dur are in seconds, relative to the start of the tracer)
+    def to_list(self):
+        with self._lock:
+            spans = list(self.spans)
+        return [z.to_dict() for z in spans]
+
+    # the Chrome trace format (can be loaded by chrome://tracing or Perfetto)
+    def to_chrome(self, spans=None):
+        spans = self.to_list() if spans is None else spans
+        _tids = {}
+        events = []
+        for one in spans:
+            _tid = _tids.setdefault(one["tid"], len(_tids))
+            events.append({"name": one["name"], "cat": one["name"].split(".")[0], "ph": "X", "ts": int(one["start"] * 1e6),
+                           "dur": int(one["dur"] * 1e6), "pid": 0, "tid": _tid, "args": {"id": one["id"], "parent": one["parent"], **one["attrs"]}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path: str, format="chrome"):
+        _dir = os.path.dirname(path)
+        if _dir:
+            os.makedirs(_dir, exist_ok=True)
+        _data = self.to_chrome() if format == "chrome" else self.to_list()
+        with open(path, "w") as fd:
+            json.dump(_data, fd, ensure_ascii=False, default=str)
+
+# --
+_CURRENT_SPAN = contextvars.ContextVar("ck_current_span", default=None)
+
+def get_current_span():
+    return _CURRENT_SPAN.get()
+
+def set_current_span(span):
+    return _CURRENT_SPAN.set(span)
+
+def reset_current_span(ctx_token):
+    _CURRENT_SPAN.reset(ctx_token)
+
+# start a child span of the given (or the current) one (None if not tracing)
+def start_span(name: str, parent=None, **attrs):
+    if parent is None:
+        parent = _CURRENT_SPAN.get()
+    if parent is None:
+        return None
+    return parent.tracer.start_span(name, parent, **attrs)
+
+# a child span of the current one, which is the current one inside the block (yield None if not tracing)
+@contextmanager
+def trace_span(name: str, **attrs):
+    span = start_span(name, **attrs)
+    if span is None:
+        yield None
+        return
+    _token = _CURRENT_SPAN.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=type(e).__name__)
+        raise
+    finally:
+        _CURRENT_SPAN.reset(_token)
+        span.end()
+
+# decorator for the tool calls
+def traced_tool_call(func):
+    @functools.wraps(func)
+    def _call(self, *args, **kwargs):
+        with trace_span("tool.call", tool=getattr(self, "name", type(self).__name__)):
+            return func(self, *args, **kwargs)
+    return _call
@@ -9,8 +9,11 @@ import json
 import types
 import contextlib
 from typing import Union, Callable
+import functools
 from functools import partial
+import ctypes
 import signal
+import threading
 import numpy as np
 
 from rich.console import Console as rich_console
@@ -93,6 +96,35 @@ def wrapped_trying(func, default_return=None, max_times=10, wait_error_names=(),
                         break
     return ret
 
+# the async version of wrapped_trying (afunc returns an awaitable)
+# retry_wait: Callable[[Exception], float], the waiting time before retrying (by default random 1~5s)
+async def awrapped_trying(afunc, default_return=None, max_times=10, wait_error_names=(), reraise=False, retry_wait=None):
+    import asyncio
+    # --
+    if max_times < 0:
+        return await afunc()  # directly no wrap (useful for debugging)!
+    # --
+    remaining_tryings = max_times
+    ret = default_return
+    while True:
+        try:
+            ret = await afunc()
+            break  # remember to jump out!!!
+        except Exception as e:  # note: cancellation is not an Exception, thus will not be caught here
+            rprint(f"Retry with Error: {e}", style="white on red")
+            _wait = random.randint(1, 5) if retry_wait is None else retry_wait(e)
+            await asyncio.sleep(_wait)
+            if type(e).__name__ in wait_error_names:
+                continue  # simply wait it
+            else:
+                remaining_tryings -= 1
+                if remaining_tryings <= 0:
+                    if reraise:
+                        raise e
+                    else:
+                        break
+    return ret
+
 # get env variable until hitting a key or returning the default value
 def GET_ENV_VAR(*keys: str, df=None):
     for k in keys:
@@ -148,10 +180,15 @@ class TemplatedString:
         else:
             _inner_locals = _locals.copy()
         _inner_locals.update(kwargs)
-        assert '"""' not in s, "Special seq not allowed!"
-        ret = eval('f"""'+s+'"""', _globals, _inner_locals)
+        ret = eval(TemplatedString.compile_fstring(s), _globals, _inner_locals)
         return ret
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def compile_fstring(s: str):  # compile once and reuse
+        assert '"""' not in s, "Special seq not allowed!"
+        return compile('f"""'+s+'"""', "<fstring>", "eval")
+
 # a simple wrapper class for with expression
 class WithWrapper:
     def __init__(self, f_start: Callable = None, f_end: Callable = None, item=None):
@@ -311,20 +348,15 @@ class CodeExecutor:
         return ret
 
     def _exec(self, code, null_stdin, timeout):
-        original_stdin = sys.stdin  # original stdin
-        if timeout > 0:
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(timeout)
+        watchdog = ExecWatchdog(timeout) if timeout > 0 else None  # note: works in any thread (with SIGALRM only in the main thread)
         try:
-            with open(os.devnull, 'r') as fd:
-                if null_stdin:  # change stdin
-                    sys.stdin = fd
+            with (null_stdin_context() if null_stdin else contextlib.nullcontext()):
+                if watchdog is not None:
+                    watchdog.start()
                 exec(code, self.globals)  # note: no locals since things can be strange!
         finally:
-            if null_stdin:  # change stdin
-                sys.stdin = original_stdin
-            if timeout > 0:
-                signal.alarm(0)  # Disable the alarm
+            if watchdog is not None:
+                watchdog.stop()
             # simply remove global vars to avoid pickle errors for multiprocessing running!
             # self.globals.clear()  # note: simply create a new executor for each run!
 
@@ -335,8 +367,9 @@ class CodeExecutor:
         if code:  # some simple modifications
             code_nopes = []
             code_lines = [f"import {lib}\n" for lib in ["os", "sys"]] + ["", ""]
+            _import_pattern = CodeExecutor.get_import_pattern(tuple(self.globals.keys()))
             for one_line in code.split("\n"):
-                if any(re.match(r"from\s*.*\s*import\s*"+function_name, one_line.strip()) for function_name in self.globals.keys()):  # no need of such imports
+                if _import_pattern is not None and _import_pattern.match(one_line.strip()):  # no need of such imports
                     code_nopes.append(one_line)
                 else:
                     code_lines.append(one_line)
@@ -348,12 +381,12 @@ class CodeExecutor:
         if catch_exception:
             try:
                 self._exec(code, null_stdin, timeout)
-            except Exception as e:
+            except (Exception, ExecTimeoutExit) as e:
                 err = self.format_error(code)
                 # self.results.append(err)
                 if self.results:
                     err = f"{err.strip()}\n(* Partial Results={self.get_print_results()})"
-                if isinstance(e, TimeoutError):
+                if isinstance(e, (TimeoutError, ExecTimeoutExit)):
                     err = f"{err}\n-> Please revise your code and simplify the next step to control the runtime."
                 self.custom_print(err)  # put err
                 zwarn(f"Error executing code: {e}")
@@ -361,6 +394,14 @@ class CodeExecutor:
             self._exec(code, null_stdin, timeout)
         # --
 
+    # one pattern for all the function names (compiled once)
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def get_import_pattern(function_names):
+        if not function_names:
+            return None
+        return re.compile(r"from\s*.*\s*import\s*(?:" + "|".join(re.escape(z) for z in function_names) + ")")
+
     @staticmethod
     def format_error(code: str):
         import traceback
@@ -380,8 +421,168 @@ class CodeExecutor:
             pass
         return f"Code Execution Error:\n{err}"
 
-def timeout_handler(signum, frame):
-    raise TimeoutError("Code execution exceeded timeout")
+class ExecTimeoutError(TimeoutError):
+    def __init__(self, *args):
+        super().__init__(*(args if args else ["Code execution exceeded timeout"]))
+
+# raised for the repeated ones: not an Exception, so that it cannot be swallowed by "except Exception"
+class ExecTimeoutExit(BaseException):
+    def __init__(self, *args):
+        super().__init__(*(args if args else ["Code execution exceeded timeout (forced exit)"]))
+
+# timeout for the code running in the current thread:
+# -- in the main thread (if SIGALRM is not used by others), a SIGALRM timer raises ExecTimeoutError, which also interrupts blocking calls such as time.sleep;
+# -- in the other threads, a timer thread raises ExecTimeoutError asynchronously in the target thread, which takes effect at the next python bytecode
+#    (LIMITATION: a blocking C call, such as a long time.sleep or socket read, finishes first; long waits in our own helpers such as AsyncRunner.run are sliced for this,
+#    and the sandbox executor kills its worker process for hard timeouts);
+# it is re-raised periodically (as ExecTimeoutExit) in case the code catches it, until stopped or the guarded frame (the caller of start) is left
+class ExecWatchdog:
+    def __init__(self, timeout: float, repeat_interval=1., use_signal=True):
+        self.timeout = timeout
+        self.repeat_interval = repeat_interval
+        self.use_signal = use_signal  # use SIGALRM if in the main thread
+        self.thread_id = threading.get_ident()
+        self.lock = threading.Lock()
+        self.active = False  # note: a plain flag that is set/unset with one store
+        self.stopped = threading.Event()
+        self.fired = 0
+        self.frame = None  # the guarded frame
+        self.thread = None
+        self.prev_handler = None  # for the signal mode
+
+    def start(self):
+        self.frame = sys._getframe(1)
+        self.active = True
+        if self.use_signal and hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread() and signal.getitimer(signal.ITIMER_REAL)[0] == 0:
+            self.prev_handler = signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout, self.repeat_interval)
+        else:  # note: nested ones in the main thread also go here
+            self.thread = threading.Thread(target=self._watch, name="exec_watchdog", daemon=True)
+            self.thread.start()
+
+    def _in_scope(self, frame):
+        while frame is not None:
+            if frame is self.frame:
+                return True
+            frame = frame.f_back
+        return False
+
+    def _on_alarm(self, signum, frame):
+        if not self.active or not self._in_scope(frame):  # note: stop() may have been skipped by a pending exception
+            self._stop_signal()
+            return
+        _exc = ExecTimeoutExit if self.fired else ExecTimeoutError
+        self.fired += 1
+        raise _exc()
+
+    def _stop_signal(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        if self.prev_handler is not None:
+            signal.signal(signal.SIGALRM, self.prev_handler)
+            self.prev_handler = None
+
+    def _watch(self):
+        if self.stopped.wait(self.timeout):
+            return
+        while True:
+            with self.lock:
+                if not self.active or not self._in_scope(sys._current_frames().get(self.thread_id)):  # note: stop() may have been skipped by a pending exception
+                    return
+                _exc = ExecTimeoutExit if self.fired else ExecTimeoutError
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), ctypes.py_object(_exc))
+                self.fired += 1
+            if self.stopped.wait(self.repeat_interval):
+                return
+
+    def stop(self):  # note: called in the target thread
+        self.active = False  # note: first of all, so that nothing is fired after this
+        while True:
+            try:
+                if self.thread is None:
+                    self._stop_signal()
+                else:
+                    with self.lock:  # wait for the ongoing firing
+                        if self.fired:  # clear the possibly pending one
+                            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread_id), None)
+                    self.stopped.set()
+                break
+            except (ExecTimeoutError, ExecTimeoutExit):  # a pending one got in before clearing, simply retry
+                continue
+        self.frame = None
+
+# run the calls concurrently (with bounded concurrency and per-call timeout), return the results (or error strs) in order
+# -- each call can be a callable without arguments or a tuple of (function, *args);
+# -- the other items are taken as already-computed results (such as `parallel([web_agent(...), ...])`, where the calls have been evaluated one by one before this) and returned in place
+def run_parallel(calls, max_workers=4, timeout=0):
+    import contextvars
+    import concurrent.futures
+    from .cancel import new_child_cancel_token, set_cancel_token
+    all_items = list(calls)
+    ret = [None] * len(all_items)
+    call_ids, calls = [], []
+    for ii, one_item in enumerate(all_items):
+        if callable(one_item) or (isinstance(one_item, (tuple, list)) and one_item and callable(one_item[0])):
+            call_ids.append(ii)
+            calls.append(one_item)
+        else:
+            ret[ii] = one_item
+    if len(calls) < len(all_items):
+        zwarn(f"parallel() gets {len(all_items)-len(calls)} non-callable items, which are taken as already-computed results (they were not run concurrently; wrap each call in a lambda for that)")
+    # --
+    def _run_one(one_call, cancel_token):
+        set_cancel_token(cancel_token)  # note: already in a copied context
+        watchdog = ExecWatchdog(timeout) if timeout > 0 else None
+        try:
+            if watchdog is not None:
+                watchdog.start()
+            if callable(one_call):
+                return one_call()
+            else:
+                return one_call[0](*one_call[1:])
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+    # --
+    if not calls:
+        return ret
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls))), thread_name_prefix="parallel")
+    cancel_tokens = [new_child_cancel_token() for _ in calls]  # note: to stop the running calls if we are interrupted
+    try:
+        futures = {executor.submit(contextvars.copy_context().run, _run_one, one_call, cancel_tokens[ii]): call_ids[ii] for ii, one_call in enumerate(calls)}  # note: keep the context vars (including the trace span)
+        pending = set(futures)
+        while pending:  # note: wait in slices so that the async exceptions (such as ExecTimeoutError) can get in
+            _, pending = concurrent.futures.wait(pending, timeout=0.2)
+        for future, ii in futures.items():
+            try:
+                ret[ii] = future.result()
+            except (Exception, ExecTimeoutExit) as e:
+                ret[ii] = f"Error: {type(e).__name__}: {e}"
+    finally:
+        for one_token in cancel_tokens:  # note: no effect on the finished ones
+            one_token.cancel("parallel call interrupted")
+        executor.shutdown(wait=False, cancel_futures=True)
+    return ret
+
+# replace stdin with devnull while there are any code running (reference counted since sys.stdin is shared by the threads)
+_NULL_STDIN_LOCK = threading.Lock()
+_NULL_STDIN_STATE = {"count": 0, "orig": None, "fd": None}
+
+@contextlib.contextmanager
+def null_stdin_context():
+    with _NULL_STDIN_LOCK:
+        if _NULL_STDIN_STATE["count"] == 0:
+            _NULL_STDIN_STATE["orig"], _NULL_STDIN_STATE["fd"] = sys.stdin, open(os.devnull, 'r')
+            sys.stdin = _NULL_STDIN_STATE["fd"]
+        _NULL_STDIN_STATE["count"] += 1
+    try:
+        yield
+    finally:
+        with _NULL_STDIN_LOCK:
+            _NULL_STDIN_STATE["count"] -= 1
+            if _NULL_STDIN_STATE["count"] == 0:
+                sys.stdin = _NULL_STDIN_STATE["orig"]
+                _NULL_STDIN_STATE["fd"].close()
+                _NULL_STDIN_STATE["orig"], _NULL_STDIN_STATE["fd"] = None, None
 
 def get_np_generator(seed):
     return np.random.RandomState(seed)
@@ -1,7 +1,7 @@
 #
 
 import json
-from ..agents.agent import MultiStepAgent, register_template, ActionResult
+from ..agents.agent import MultiStepAgent, register_template, ActionResult, step_timing
 from ..agents.utils import zwarn, GET_ENV_VAR, have_images_in_messages
 from ..agents.model import LLM
 
@@ -139,7 +139,8 @@ def file_agent(task: str, file_path_dict: dict = None) -> dict:
             action_str, action_result = "nop", action_str.strip()  # no-operation
         # --
         try:  # execute the action on the browser
-            step_result = file_env.step_state(action_str)
+            with step_timing("env"):
+                step_result = file_env.step_state(action_str)
             ret = action_result if action_result is not None else step_result  # use action result if there are direct ones
             # return f"File agent step: {action_str.strip()}"
         except Exception as e:
@@ -147,12 +148,9 @@ def file_agent(task: str, file_path_dict: dict = None) -> dict:
             ret = f"File agent error: {e} for {_rr}"
         return ret
 
-    def step_call(self, messages, session, model=None):
+    def get_call_model(self, messages, session):
         _use_multimodal = session.info.get("use_multimodal", False) or have_images_in_messages(messages)
-        if model is None:
-            model = self.model_multimodal if _use_multimodal else self.model  # use which model?
-        response = model(messages)
-        return response
+        return self.model_multimodal if _use_multimodal else self.model  # use which model?
 
     # --
     # other helpers
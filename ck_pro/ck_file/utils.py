@@ -14,6 +14,8 @@ import math
 import ast
 
 from ..agents.utils import KwargsInitializable, rprint, zwarn, zlog
+from ..agents.cancel import check_cancelled
+from ..agents.trace import trace_span
 from .mdconvert import MarkdownConverter
 import markdownify
 from ..ck_web.utils import MyMarkdownify
@@ -515,6 +517,7 @@ class FileEnv(KwargsInitializable):
         self.state.loaded_files.update({file: False for file in files})
 
     def step_state(self, action_string: str):
+        check_cancelled()  # note: the conversions can be slow
         state = self.state
         action_string = action_string.strip()
         # --
@@ -534,7 +537,9 @@ class FileEnv(KwargsInitializable):
             ret = f"File agent step: {action_string}"
         else:
             # actually perform action
-            action_succeed, results  = self.action(action)
+            _file = str(action.get("target_file") or "")
+            with trace_span(f"file.{action['action_name']}", file=_file, file_type=(os.path.splitext(_file)[-1].lower() if _file else "")):
+                action_succeed, results  = self.action(action)
             if not action_succeed:  # no succeed
                 state.error_message = f"The action you have chosen cannot be executed: {action_string}. Please double-check if you have selected the correct element or used correct action format."
                 ret = state.error_message
@@ -1,13 +1,16 @@
 #
 
+import os
 import time
 import re
 import random
+import threading
+import concurrent.futures
 from functools import partial
 import multiprocessing as mp
 
-from ..agents.agent import MultiStepAgent, register_template, AgentResult
-from ..agents.tool import StopTool, AskLLMTool, SimpleSearchTool
+from ..agents.agent import MultiStepAgent, register_template, AgentResult, _CURRENT_AFFINITY_KEY
+from ..agents.tool import StopTool, AskLLMTool, SimpleSearchTool, ParallelTool
 from ..agents.utils import zwarn, GET_ENV_VAR
 from ..ck_web.agent import WebAgent
 try:
@@ -29,13 +32,14 @@ class CKAgent(MultiStepAgent):
         self.file_agent = FileAgent()
         self.tool_ask_llm = AskLLMTool()
         self.tool_simple_search = SimpleSearchTool()
+        self.tool_parallel = ParallelTool()
         feed_kwargs = dict(
             name="ck_agent",
             description="Cognitive Kernel, an initial autopilot system.",
             templates={"plan": "ck_plan", "action": "ck_action", "end": "ck_end", "aggr": "ck_aggr"},  # template names (no need of END here since we do NOT use __call__ for this)
-            active_functions=["web_agent", "file_agent", "stop", "ask_llm", "simple_web_search"],  # enable the useful modules
+            active_functions=["web_agent", "file_agent", "stop", "ask_llm", "simple_web_search", "parallel"],  # enable the useful modules
             sub_agent_names=["web_agent", "file_agent"],  # note: another tricky point, use name rather than the objects themselves
-            tools=[StopTool(agent=self), self.tool_ask_llm, self.tool_simple_search],  # add related tools
+            tools=[StopTool(agent=self), self.tool_ask_llm, self.tool_simple_search, self.tool_parallel],  # add related tools
             max_steps=10,  # still give it more steps
             max_time_limit=5200,  # 70 minutes
             exec_timeout_with_call=1000,  # if calling sub-agent
@@ -46,25 +50,30 @@ class CKAgent(MultiStepAgent):
         self.step_mrun = 1  # step-level multiple run to do ensemble
         self.mrun_pool_size = 5  # max pool size for parallel running
         self.mrun_multimodal_count = 0  # how many runs to go with multimodal-web
+        self.mrun_browser_slots = 0  # max number of the multiple runs using the browser at the same time (0 means no limit, set it according to the capacity of the browser server)
+        self.mrun_start_method = "forkserver"  # start method for the worker pool (not fork, which may deadlock with the threads of the main process; spawn is used if forkserver is not available)
+        self.parallel_max_workers = 4  # max concurrent calls inside the parallel tool
+        self.parallel_call_timeout = 0  # timeout for each call inside the parallel tool (0 means using exec_timeout_with_call)
         # --
         register_template(CK_PROMPTS)  # add web prompts
         super().__init__(**feed_kwargs)
         self.tool_ask_llm.set_llm(self.model)  # another tricky part, we need to assign LLM later
         self.tool_simple_search.set_llm(self.model)
+        self.tool_parallel.max_workers = self.parallel_max_workers
+        self._mrun_pool, self._mrun_pool_pid, self._mrun_lock = None, None, threading.Lock()  # lazily created
+        self.tool_parallel.timeout = self.parallel_call_timeout if self.parallel_call_timeout > 0 else self.exec_timeout_with_call
         # --
 
     def get_function_definition(self, short: bool):
         raise RuntimeError("Should NOT use CKAgent as a sub-agent!")
 
-    def _super_step_action(self, _id: int, need_sleep: bool, action_res, action_input_kwargs, **kwargs):
-        if need_sleep and _id:
-            time.sleep(5 * int(_id))  # do not run them all at once!
-        # --
+    def _super_step_action(self, _id: int, action_res, action_input_kwargs, base_seed=None, **kwargs):
         if _id is None:  # not multiple run mode
             ret = super().step_action(action_res, action_input_kwargs, **kwargs)
         else:
             _old_multimodal, _old_seed = self.web_agent.get_multimodal(), self.get_seed()
-            _new_multimodal, _new_seed = ("auto" if int(_id) < self.mrun_multimodal_count else "off"), (_old_seed + int(_id))
+            _base_seed = _old_seed if base_seed is None else base_seed  # note: given by the main process for the replicas
+            _new_multimodal, _new_seed = ("auto" if int(_id) < self.mrun_multimodal_count else "off"), (_base_seed + int(_id))
             try:
                 self.web_agent.set_multimodal(_new_multimodal)
                 self.set_seed(_new_seed)
@@ -78,12 +87,11 @@ class CKAgent(MultiStepAgent):
     def step_action(self, action_res, action_input_kwargs, **kwargs):
         _need_multiple = any(f"{kk}(" in action_res["code"] for kk in ["web_agent", "file_agent", "ask_llm"])  # tools that might benefit from multiple running
         if self.step_mrun <= 1 or (not _need_multiple):  # just run once
-            return self._super_step_action(None, False, action_res, action_input_kwargs, **kwargs)
+            return self._super_step_action(None, action_res, action_input_kwargs, **kwargs)
         else:  # multiple run and aggregation
-            _need_sleep = ("web_agent(" in action_res["code"])  # do not run web_agent all at once!
-            with mp.Pool(min(self.mrun_pool_size, self.step_mrun)) as pool:  # note: no handle of errors here since the wraps (including the timeout) will be inside each sub-process
-                # all_results = pool.map(partial(self._super_step_action, need_sleep=_need_sleep, action_res=action_res, action_input_kwargs=action_input_kwargs, **kwargs), list(range(self.step_mrun)))
-                all_results = pool.map(ck_step_action, [(self, _id, _need_sleep, action_res, action_input_kwargs, kwargs) for _id in range(self.step_mrun)])
+            _need_browser = ("web_agent(" in action_res["code"])  # do not run too many web_agent at once!
+            _tasks = [(_id, self.get_seed(), _CURRENT_AFFINITY_KEY.get(), action_res, action_input_kwargs, kwargs) for _id in range(self.step_mrun)]  # note: only send the inputs, the agent replicas are already in the workers
+            all_results = self._run_mrun_tasks(_tasks, _need_browser)  # note: the errors of the step (including the timeout) are handled inside each sub-process, the ones of the pool are put into the results as strings
             # aggregate results
             aggr_res = None
             try:
@@ -105,9 +113,85 @@ class CKAgent(MultiStepAgent):
             return _ret
         # --
 
+    # --
+    # the persistent worker pool for step_mrun (each worker holds a replica of the agent)
+
+    def _get_mrun_pool(self):
+        if self._mrun_pool is None or self._mrun_pool_pid != os.getpid():
+            _method = self.mrun_start_method
+            if _method and _method not in mp.get_all_start_methods():
+                _method = "spawn"
+            _ctx = mp.get_context(_method) if _method else None
+            self._mrun_pool = concurrent.futures.ProcessPoolExecutor(min(self.mrun_pool_size, self.step_mrun), mp_context=_ctx, initializer=init_mrun_worker, initargs=(self,))  # note: pickle the agent only once per worker
+            self._mrun_pool_pid = os.getpid()
+        return self._mrun_pool
+
+    def close(self):
+        self.close_mrun_pool()
+        super().close()
+
+    # note: called (by close) at the end of ck_main.main and of each request of the service (the idle workers are also stopped at exit)
+    def close_mrun_pool(self):
+        if self._mrun_pool is not None and self._mrun_pool_pid == os.getpid():
+            self._mrun_pool.shutdown(wait=False, cancel_futures=True)  # note: the busy workers exit after their current tasks
+        self._mrun_pool, self._mrun_pool_pid = None, None
+
+    # schedule the tasks: the browser-using ones are started as soon as there are free browser slots (no fixed staggering)
+    def _run_mrun_tasks(self, tasks, need_browser: bool):
+        with self._mrun_lock:  # note: one ensemble at a time for the pool
+            _max_running = len(tasks)
+            if need_browser and self.mrun_browser_slots > 0:
+                _max_running = min(_max_running, self.mrun_browser_slots)
+            results, pending, running = [None] * len(tasks), list(range(len(tasks))), {}  # running: future -> (idx, pool)
+            while pending or running:
+                while pending and len(running) < _max_running:
+                    _ii = pending.pop(0)
+                    pool = self._get_mrun_pool()  # note: re-created if dropped because of a broken one
+                    try:
+                        running[pool.submit(ck_mrun_step_action, tasks[_ii])] = (_ii, pool)
+                    except Exception as e:
+                        results[_ii] = self._handle_mrun_error(_ii, pool, e)
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(list(running.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+                for _future in done:
+                    _ii, pool = running.pop(_future)
+                    try:
+                        results[_ii] = _future.result()
+                    except Exception as e:
+                        results[_ii] = self._handle_mrun_error(_ii, pool, e)
+            return results
+
+    def _handle_mrun_error(self, idx: int, pool, err: Exception):
+        zwarn(f"Error in the multiple run {idx}: {err}")
+        if isinstance(err, concurrent.futures.BrokenExecutor) and pool is self._mrun_pool:  # note: a worker died (for example, OOM-killed), drop the pool and create a new one for the later runs
+            self.close_mrun_pool()
+        return f"Error in the multiple run {idx}: {type(err).__name__}: {err}"
+
+    # note: do not pickle the pool
+    def __getstate__(self):
+        ret = super().__getstate__()
+        for k in ["_mrun_pool", "_mrun_pool_pid", "_mrun_lock"]:
+            ret.pop(k, None)
+        return ret
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._mrun_pool, self._mrun_pool_pid, self._mrun_lock = None, None, threading.Lock()
+
 # --
-# make it a top-level function
-def ck_step_action(args):
-    ck, _id, need_sleep, action_res, action_input_kwargs, kwargs = args
-    return ck._super_step_action(_id, need_sleep, action_res, action_input_kwargs, **kwargs)
+# make them top-level functions
+_MRUN_AGENT = None  # the replica in the worker
+
+def init_mrun_worker(ck):
+    global _MRUN_AGENT
+    _MRUN_AGENT = ck
+
+def ck_mrun_step_action(args):
+    _id, base_seed, affinity_key, action_res, action_input_kwargs, kwargs = args
+    _token = _CURRENT_AFFINITY_KEY.set(affinity_key)
+    try:
+        return _MRUN_AGENT._super_step_action(_id, action_res, action_input_kwargs, base_seed=base_seed, **kwargs)
+    finally:
+        _CURRENT_AFFINITY_KEY.reset(_token)
 # --
@@ -10,6 +10,7 @@ import signal
 
 from ..agents.utils import rprint, my_open_with, zwarn, incr_update_dict, get_until_hit, my_json_dumps, tuple_keys_to_str
 from ..agents.evaluator import Evaluator
+from ..agents.blob import BlobStore, get_default_blob_dir
 
 from .agent import CKAgent
 from .gaia_scorer import question_scorer
@@ -42,6 +43,11 @@ def get_args():
     parser.add_argument("--max_retry_num", default=3, type=int) # maximum number of retries when sampling-mode or inference_time_evaluation_method is on.
     parser.add_argument("--reflection", type=bool, default=False)
     parser.add_argument("--save_failed_tries", action="store_true") # whether to save "failed" tries. Can disable this when running inference on test set.
+    parser.add_argument("--blob_store", type=int, default=0)  # store the large payloads (screenshots, ...) of the sessions once in a content-addressed store (at "OUTPUT.blobs" by default)
+    parser.add_argument("--blob_dir", type=str, default="")  # dir for the blob store (if not the default one)
+    parser.add_argument("--blob_min_size", type=int, default=4096)  # strings with at least this number of chars are stored as blobs
+    parser.add_argument("--checkpoint_dir", type=str, default="")  # save checkpoints after each step and resume the unfinished tasks from them
+    parser.add_argument("--optimize_images", type=int, default=0)  # downsize and re-encode (lossily) the large images before sending them to the LLMs
     # parser.add_argument("-t", "--timeout", type=int, default=3600)  # timeout seconds for each task
     return parser.parse_args()
 
@@ -94,7 +100,11 @@ def main():
         src_dict = eval(one_update)
         incr_update_dict(configs, src_dict)  # updates
         rprint(f"Update configs with {src_dict}")
+    if args.checkpoint_dir:
+        configs["checkpoint_dir"] = os.path.abspath(args.checkpoint_dir)
     ck_agent = CKAgent(**configs)
+    if args.optimize_images:
+        ck_agent.set_optimize_images(True)
     if args.sampling_mode or args.inference_time_evaluation_method != "disabled":
         ck_evaluator = Evaluator()
     # --
@@ -112,6 +122,10 @@ def main():
                     existing_inst_map[_inst["id"]] = _inst
     if existing_inst_map:
         rprint(f"Load existing_inst_map: L={len(existing_inst_map)}")
+    blob_store = None
+    if args.blob_store and args.output:
+        blob_store = BlobStore((args.blob_dir if args.blob_dir else get_default_blob_dir(args.output)), min_size=args.blob_min_size)
+        rprint(f"Store the large payloads at {blob_store.root_dir}")
     # --
     total_task, corr_task = 0, 0
     with my_open_with(args.output, 'w') as fout:
@@ -119,7 +133,7 @@ def main():
             _input_file = None
             if args.sep_run_root:
                 trg_dir = os.path.join(args.sep_run_root, inst["id"])
-                os.makedirs(trg_dir, exist_ok=False)  # mkdir
+                os.makedirs(trg_dir, exist_ok=bool(args.checkpoint_dir))  # mkdir (may exist if resuming)
                 if inst.get("file"):
                     _input_file = "input." + inst["file"].split(".")[-1]  # make a simpler name!
                     shutil.copy(os.path.join(input_dir, inst["file"]), os.path.join(trg_dir, _input_file))
@@ -157,7 +171,7 @@ def main():
                     if args.sampling_mode:
                         # sampling mode
                         if args.evaluation_method == "disabled":
-                            res_session = ck_agent.run(_task)
+                            res_session = ck_agent.run(_task, checkpoint_key=inst["id"])
                         elif args.evaluation_method in ["em", "llm_score"]:
                             _try_num = 0
                             res_session = ck_agent.run(_task)
@@ -172,7 +186,7 @@ def main():
                     else:
                         # inference mode
                         if args.inference_time_evaluation_method == "disabled":
-                            res_session = ck_agent.run(_task)
+                            res_session = ck_agent.run(_task, checkpoint_key=inst["id"])
                         else:
                             # ensemble
                             candidate_num = 5 if "ensemble" in args.inference_time_evaluation_method else 1
@@ -207,9 +221,9 @@ def main():
                     res_session.info["call_stat"] = ck_agent.get_call_stat(clear=True)
                     end_pc, end_time = time.perf_counter(), time.ctime()
                     res_session.info.update({"start_time": start_time, "end_time": end_time, "duration": end_pc-start_pc})
-                    inst["session"] = res_session.to_dict()
+                    inst["session"] = res_session.to_dict(blob_store=blob_store)
                     if args.save_failed_tries and len(res_session_list) > 1:
-                        inst['previous_failed_sessions'] = [sess.to_dict() for sess in res_session_list[:-1]]
+                        inst['previous_failed_sessions'] = [sess.to_dict(blob_store=blob_store) for sess in res_session_list[:-1]]
             # --
             # simple EVAL
             answer_gold = str(inst.get("answer", "UNK"))
@@ -236,6 +250,7 @@ def main():
                     fout.write(my_json_dumps(tuple_keys_to_str(inst), ensure_ascii=False) + "\n")
                     # breakpoint()
             # --
+    ck_agent.close()
     # --
     if args.no_final_breakpoint:
         pass
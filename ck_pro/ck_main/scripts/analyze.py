@@ -7,6 +7,7 @@ import sys
 import argparse
 from collections import Counter, defaultdict
 from ...agents.utils import rprint
+from ...agents.blob import BlobStore
 
 def print_session(session):
     all_sub_sessions = {}
@@ -38,11 +39,48 @@ def print_session(session):
                     rprint(str(_printings), style="white on purple")
     return all_sub_sessions
 
+# collect the timing of each step (by agent and phase), including the sub-agents' sessions
+def collect_step_timings(obj, timings, agent=None):
+    if isinstance(obj, dict):
+        if isinstance(obj.get("steps"), list) and "task" in obj:  # a session
+            agent = (obj.get("info") or {}).get("agent") or ("main" if agent is None else "sub")
+            for step_info in obj["steps"]:
+                if isinstance(step_info, dict):
+                    for _phase, _sec in (step_info.get("timing") or {}).items():
+                        timings[agent][_phase].append(_sec)
+                    collect_step_timings(step_info.get("action"), timings, agent)
+            return
+        for v in obj.values():
+            collect_step_timings(v, timings, agent)
+    elif isinstance(obj, list):
+        for v in obj:
+            collect_step_timings(v, timings, agent)
+
+def get_percentile(sorted_values, q: float):
+    if not sorted_values:
+        return 0.
+    _pos = (len(sorted_values) - 1) * q
+    _lo = int(_pos)
+    _hi = min(_lo + 1, len(sorted_values) - 1)
+    return sorted_values[_lo] + (sorted_values[_hi] - sorted_values[_lo]) * (_pos - _lo)
+
+def print_timing_table(timings, title=""):
+    _header = f"{'agent':<12} {'phase':<16} {'n':>6} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'total':>10}"
+    rprint(f"Step timing (seconds) {title}\n{_header}")
+    for agent in sorted(timings.keys()):
+        for phase in sorted(timings[agent].keys()):
+            _vs = sorted(timings[agent][phase])
+            if not _vs:
+                continue
+            rprint(f"{agent:<12} {phase:<16} {len(_vs):>6} {sum(_vs)/len(_vs):>8.2f} {get_percentile(_vs, 0.5):>8.2f} {get_percentile(_vs, 0.9):>8.2f} {get_percentile(_vs, 0.99):>8.2f} {_vs[-1]:>8.2f} {sum(_vs):>10.1f}")
+
 def analyze(file: str, args):
     cc = Counter()
     token_cc = defaultdict(Counter)
     func_bd = eval(args.breakdowns) if args.breakdowns else (lambda x: None)
     bd_counts, bd_corr = Counter(), Counter()
+    timings = defaultdict(lambda: defaultdict(list))  # agent -> phase -> [seconds]
+    blob_store = BlobStore.find_for_file(file, args.blob_dir)  # only rehydrate the sessions when printing them
     with open(file) as fd:
         for line in fd:
             if line.strip():
@@ -61,10 +99,14 @@ def analyze(file: str, args):
                     if "__ALL__" in _vv:
                         _vv = _vv["__ALL__"]
                     token_cc[_kk].update(_vv)
+                collect_step_timings(inst.get("session", {}), timings)
+                _duration = inst.get("session", {}).get("info", {}).get("duration")
+                if _duration is not None:
+                    timings["task"]["duration"].append(_duration)
                 # --
                 if args.print:
                     if cc['inst_all'] >= args.print_start and ((not args.print_levels) or (int(_level) in args.print_levels)):
-                        all_sub_sessions = print_session(inst["session"])
+                        all_sub_sessions = print_session(blob_store.rehydrate(inst["session"]) if blob_store is not None else inst["session"])
                         rprint(f"# ==\nTask (L={_level}) => {inst['task']}", style="white on yellow")
                         rprint(f"Eval result = {inst['eval']}", style="white on yellow")
                         if args.breakpoint:
@@ -79,6 +121,8 @@ def analyze(file: str, args):
     rprint(f"CC for {file}: {cc}")
     rprint(f"Token-CC for {file}: {token_cc}")
     rprint(f"Acc for {file}: {acc_results}")
+    if args.timing and timings:
+        print_timing_table(timings, title=f"for {file}")
     if args.breakdowns:
         rprint(f"Breakdown by {args.breakdowns}")
         for kk in sorted(bd_counts.keys()):
@@ -168,6 +212,8 @@ def get_args():
     parser.add_argument("--breakdowns", type=str, default="")  # breaking down function
     parser.add_argument("--print_start", type=int, default=0)
     parser.add_argument("--print_levels", type=int, default=None, nargs="+")
+    parser.add_argument("--timing", type=int, default=1)  # print the percentile tables of the step timing
+    parser.add_argument("--blob_dir", type=str, default="")  # blob store of the sessions ("FILE.blobs" by default)
     return parser.parse_args()
 
 def main():
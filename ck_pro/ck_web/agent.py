@@ -6,7 +6,7 @@ import shutil
 import urllib.request
 from contextlib import contextmanager
 
-from ..agents.agent import MultiStepAgent, register_template, ActionResult
+from ..agents.agent import MultiStepAgent, register_template, ActionResult, step_timing
 from ..agents.model import LLM
 from ..agents.utils import zwarn, rprint, have_images_in_messages
 from ..agents.tool import SimpleSearchTool
@@ -129,12 +129,19 @@ def web_agent(task: str) -> dict:
         del self.web_envs[_id]  # remove web env
         return ret
 
-    def step_call(self, messages, session, model=None):
+    def get_checkpoint_env(self, session):
+        ret = self.web_envs[session.id].get_state()
+        for k in ["boxed_screenshot", "snapshot", "html_md", "current_accessibility_tree"]:  # note: obtained again when restoring
+            ret[k] = ""
+        return ret
+
+    def restore_checkpoint_env(self, session, env_state):
+        if env_state:
+            self.web_envs[session.id].restore_state(env_state)
+
+    def get_call_model(self, messages, session):
         _use_multimodal = session.info.get("use_multimodal", False) or have_images_in_messages(messages)
-        if model is None:
-            model = self.model_multimodal if _use_multimodal else self.model  # use which model?
-        response = model(messages)
-        return response
+        return self.model_multimodal if _use_multimodal else self.model  # use which model?
 
     def step_prepare(self, session, state):
         _input_kwargs, _extra_kwargs = super().step_prepare(session, state)
@@ -170,9 +177,11 @@ def web_agent(task: str) -> dict:
             action_str, action_result = "nop", action_str.strip()  # no-operation
         # state step
         try:  # execute the action on the browser
-            step_result = web_env.step_state(action_str)
+            with step_timing("env"):
+                step_result = web_env.step_state(action_str)
             ret = action_result if action_result is not None else step_result  # use action result if there are direct ones
-            web_env.sync_files()
+            with step_timing("env"):
+                web_env.sync_files()
             # ret = f"Browser step: {action_str.strip()}"
         except Exception as e:
             zwarn("web_env execution error!")
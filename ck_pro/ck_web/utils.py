@@ -11,6 +11,8 @@ import requests
 import base64
 import markdownify
 from ..agents.utils import KwargsInitializable, rprint, zwarn, zlog
+from ..agents.cancel import check_cancelled, get_capped_timeout
+from ..agents.trace import trace_span
 
 # --
 # web state
@@ -156,10 +158,19 @@ class WebEnv(KwargsInitializable):
     # --
     # helpers
 
+    # note: cancellable (checked before the request, and the timeout is capped by the remaining time of the task)
+    def _post(self, url, data):
+        check_cancelled()
+        with trace_span(f"web.{url.rsplit('/', 1)[-1]}", url=(data.get("url") or data.get("targetUrl"))) as span:
+            response = requests.post(url, json=data, timeout=get_capped_timeout(self.web_timeout))
+            if span is not None:
+                span.set(status=response.status_code, bytes=len(response.content))
+        return response
+
     def get_browser(self, storage_state, geo_location):
         url = f"http://{self.web_ip}/getBrowser"
         data = {"storageState": storage_state, "geoLocation": geo_location}
-        response = requests.post(url, json=data, timeout=self.web_timeout)
+        response = self._post(url, data)
         if response.status_code == 200:
             zlog(f"==> Get browser {response.json()}")
             return response.json()["browserId"]
@@ -187,7 +198,7 @@ class WebEnv(KwargsInitializable):
         last_detail = None
         last_status = None
         for attempt in range(1, max_retries + 1):
-            response = requests.post(url, json=data, timeout=self.web_timeout)
+            response = self._post(url, data)
             if response.status_code == 200:
                 return response.json()["pageId"]
             # parse detail for diagnostics
@@ -214,7 +225,7 @@ class WebEnv(KwargsInitializable):
     def goto_url(self, browser_id, page_id, target_url):
         url = f"http://{self.web_ip}/gotoUrl"
         data = {"browserId": browser_id, "pageId": page_id, "targetUrl": target_url}
-        response = requests.post(url, json=data, timeout=self.web_timeout)
+        response = self._post(url, data)
         if response.status_code == 200:
             return True
         else:
@@ -275,7 +286,7 @@ class WebEnv(KwargsInitializable):
         default_axtree = ""  # default empty
         default_res = {"current_accessibility_tree": default_axtree, "step_url": "", "html_md": "", "snapshot": "", "boxed_screenshot": "", "downloaded_file_path": []}
         try:
-            response = requests.post(url, json=data, timeout=self.web_timeout)
+            response = self._post(url, data)
             if response.status_code == 200:
                 res_json = response.json()
                 res_dict = self.process_axtree(res_json)
@@ -300,7 +311,7 @@ class WebEnv(KwargsInitializable):
             "needEnter": action["need_enter"],
         }
         try:
-            response = requests.post(url, json=data, timeout=self.web_timeout)
+            response = self._post(url, data)
             if response.status_code == 200:
                 return True
             else:
@@ -456,7 +467,7 @@ class WebEnv(KwargsInitializable):
     def reset_to_state(self, target_state):
         state = self.state
         if isinstance(target_state, dict):
-            target_state = WebState.create_from_dict(target_state)
+            target_state = WebState(**target_state)
         # assert state.browser_id == target_state.browser_id and state.page_id == target_state.page_id, "Mismatched basic IDs"
         if state.get_id() != target_state.get_id():  # need to revert to another URL
             self.goto_url(target_state.browser_id, target_state.page_id, target_state.step_url)
@@ -476,6 +487,16 @@ class WebEnv(KwargsInitializable):
             return False
         # --
 
+    # restore a saved state with the current browser (for example, when resuming from a checkpoint)
+    def restore_state(self, saved_state):
+        target_state = WebState(**saved_state) if isinstance(saved_state, dict) else saved_state.copy()
+        if not target_state.step_url or target_state.total_actual_step == 0:
+            return False  # nothing to restore
+        target_state.update(browser_id=self.state.browser_id, page_id=self.state.page_id)  # note: the old browser is gone
+        ret = self.reset_to_state(target_state)
+        self.state.update(total_actual_step=target_state.total_actual_step, downloaded_file_path=list(target_state.downloaded_file_path))
+        return ret
+
     def _get_accessibility_tree_results(self, state):
         get_accessibility_tree_succeed, curr_res = self.get_accessibility_tree(state.browser_id, state.page_id, state.curr_step)
         current_accessibility_tree = curr_res.get("current_accessibility_tree", "")
@@ -575,7 +596,7 @@ class WebEnv(KwargsInitializable):
             url = f"http://{self.web_ip}/getFile"
             data = {"filename": _f}
             try:
-                response = requests.post(url, json=data, timeout=self.web_timeout)
+                response = self._post(url, data)
                 if response.status_code == 200:
                     res_json = response.json()
                     base64_str = res_json["file"]
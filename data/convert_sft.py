@@ -16,6 +16,15 @@ from concurrent.futures import ThreadPoolExecutor
 from langchain_openai import AzureChatOpenAI
 from langchain.evaluation import load_evaluator
 
+# Ensure repo root is on sys.path (to share the session helpers with ck_pro)
+import sys
+_REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0, _REPO_ROOT)
+
+from ck_pro.agents.blob import BlobStore, get_default_blob_dir
+from ck_pro.agents.session import decode_session_io
+
 
 class LangChainEvaluator:
     def __init__(self):
@@ -45,10 +54,16 @@ class LangChainEvaluator:
                     return None
 
 
-def read_jsonl(file_path):
+def read_jsonl(file_path, blob_dir=None):
     with open(file_path, 'r') as f:
         lines = f.readlines()
         data = [json.loads(line) for line in lines]
+    # rehydrate the blob references, the store is at "FILE.blobs" by default
+    blob_dir = blob_dir if blob_dir else get_default_blob_dir(file_path)
+    if os.path.isdir(blob_dir):
+        blob_store = BlobStore(blob_dir)
+        data = [blob_store.rehydrate(item) for item in data]
+    data = [decode_session_io(item) for item in data]  # rebuild the compactly encoded llm_input
     return data
 
 def save_jsonl(data, filename):
@@ -58,9 +73,18 @@ def save_jsonl(data, filename):
 
 from copy import deepcopy
 
+# the stored call of a step: a fused plan+action step has only one call (stored with the plan), which is taken as its action
+def get_step_io(step, key):
+    if step.get('action', {}).get('fused'):
+        return None if key == 'plan' else step['plan']
+    return step[key]
+
 def build_messages(step, key):
     """通用构建消息的函数，key为'action'或'plan'"""
-    d = deepcopy(step[key])
+    d = get_step_io(step, key)
+    if d is None:
+        return None
+    d = deepcopy(d)
     msg = d['llm_input']
     msg.append({"role": "assistant", "content": d['llm_output']})
     return msg
@@ -79,7 +103,10 @@ def process_sub_steps(sub_steps, key):
     """处理子步骤，key为'action'或'plan'"""
     messages = []
     for sub_step in sub_steps:
-        d = deepcopy(sub_step[key])
+        d = get_step_io(sub_step, key)
+        if d is None:
+            continue
+        d = deepcopy(d)
         msg = d['llm_input']
         if not is_valid_msg(msg):
             continue
@@ -108,8 +135,10 @@ def get_text_sft_data(item):
     for step in item['session']['steps']:
         # action
         action_messages.append(build_messages(step, 'action'))
-        # plan
-        planning_messages.append(build_messages(step, 'plan'))
+        # plan (none for a fused step)
+        plan_msg = build_messages(step, 'plan')
+        if plan_msg is not None:
+            planning_messages.append(plan_msg)
         # end
         if 'end' in step:
             end_messages.append(build_end_messages(step))
@@ -203,6 +232,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--input_file', type=str, nargs='+', required=True, help='Input JSONL file path(s)')
     parser.add_argument('--output_file', type=str, required=True, help='Output SFT JSONL file path')
+    parser.add_argument('--blob_dir', type=str, default=None, help='Blob store of the large payloads in the sessions (default: INPUT_FILE.blobs if it exists)')
 
     parser.add_argument('--remove_ask_llm', action='store_true', help='Whether to remove the stopped trajectories where ask_llm is performed to acquire the final answer due to previous failures.')
     parser.add_argument('--save_ask_llm', action='store_true', help='Whether to save the ask_llm results.')
@@ -221,7 +251,7 @@ if __name__ == '__main__':
 
     trajectories = []
     for input_file in args.input_file:
-        trajectories += read_jsonl(input_file)
+        trajectories += read_jsonl(input_file, args.blob_dir)
 
     if args.rejection_sampling_type == 'em':
         # exact match
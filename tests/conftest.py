@@ -0,0 +1,8 @@
+#
+
+# run the tests from the repo root: python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
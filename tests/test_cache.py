@@ -0,0 +1,41 @@
+#
+
+import os
+from ck_pro.agents.cache import ResponseCache
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+def test_key_normalization():
+    cache = ResponseCache(enabled=True)
+    k0 = cache.get_key(MESSAGES, "gpt:m", {"temperature": 0., "max_tokens": 10}, 1)
+    assert k0 == cache.get_key(MESSAGES, "gpt:m", {"max_tokens": 10, "temperature": 0.}, 1)  # order does not matter
+    assert k0 == cache.get_key(MESSAGES, "gpt:m", {"temperature": 0., "max_tokens": 10, "api_key": "secret"}, 1)  # ignored kwargs
+    assert k0 != cache.get_key(MESSAGES, "gpt:m", {"temperature": 0., "max_tokens": 10}, 2)  # seed
+    assert k0 != cache.get_key(MESSAGES, "gpt:m2", {"temperature": 0., "max_tokens": 10}, 1)  # target
+
+def test_mem_lru():
+    cache = ResponseCache(enabled=True, mem_size=2)
+    assert cache.get("a") == (False, None)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == (True, "A")  # now "b" is the least recently used
+    cache.put("c", "C")
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, "A") and cache.get("c") == (True, "C")
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(enabled=True, mem_size=0, disk_path=path)
+    cache.put("k", {"x": [1, 2]})
+    assert os.path.exists(path)
+    cache2 = ResponseCache(enabled=True, mem_size=4, disk_path=path)  # a new one (such as in another process) reads from the disk
+    assert cache2.get("k") == (True, {"x": [1, 2]})
+    assert cache2.get("missing") == (False, None)
+
+def test_disk_eviction(tmp_path):
+    cache = ResponseCache(enabled=True, mem_size=0, disk_path=str(tmp_path / "cache.db"), disk_max_bytes=10000, disk_evict_ratio=0.5)
+    for ii in range(120):
+        cache.put(f"k{ii}", "x" * 200)
+    assert cache._disk_bytes <= 10000
+    assert cache.get("k119") == (True, "x" * 200)  # the latest ones are kept
+    assert cache.get("k0") == (False, None)  # the old ones are evicted
@@ -0,0 +1,55 @@
+#
+
+import time
+import pytest
+from ck_pro.agents.cancel import CancelToken, TaskCancelledError, set_cancel_token, reset_cancel_token, new_child_cancel_token, check_cancelled, get_capped_timeout
+
+def test_explicit_cancel():
+    token = CancelToken()
+    assert not token.cancelled and token.remaining() is None
+    token.cancel("first")
+    token.cancel("second")
+    assert token.cancelled and token.reason == "first"  # the first reason is kept
+    assert not token.timed_out
+    with pytest.raises(TaskCancelledError):
+        token.check()
+
+def test_deadline():
+    token = CancelToken(timeout=0.05)
+    assert not token.cancelled and 0 < token.remaining() <= 0.05
+    time.sleep(0.1)
+    assert token.cancelled and token.timed_out
+    assert token.reason == CancelToken.DEADLINE_REASON and token.remaining() == 0.
+
+def test_child():
+    parent = CancelToken(timeout=10)
+    child = parent.new_child(timeout=100)
+    assert child.remaining() <= 10  # capped by the parent
+    child.cancel("child only")
+    assert child.cancelled and not parent.cancelled  # not the other way around
+    child2 = parent.new_child()
+    parent.cancel("parent")
+    assert child2.cancelled and child2.reason == "parent"
+
+def test_child_of_timed_out_parent():
+    parent = CancelToken(timeout=0.05)
+    child = parent.new_child()
+    time.sleep(0.1)
+    assert child.cancelled and child.timed_out
+
+def test_context_helpers():
+    assert get_capped_timeout(30) == 30  # no current token
+    token = CancelToken(timeout=5)
+    ctx_token = set_cancel_token(token)
+    try:
+        check_cancelled()
+        assert 1 <= get_capped_timeout(30) <= 5
+        assert get_capped_timeout(0) <= 5
+        child = new_child_cancel_token()
+        assert child.parent is token
+        token.cancel("stop")
+        with pytest.raises(TaskCancelledError):
+            check_cancelled()
+    finally:
+        reset_cancel_token(ctx_token)
+    check_cancelled()  # no current token any more
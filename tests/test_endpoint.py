@@ -0,0 +1,95 @@
+#
+
+import pytest
+from ck_pro.agents import endpoint as E
+from ck_pro.agents.endpoint import EndpointController, HttpStatusError, get_error_info, parse_retry_after
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    ret = FakeClock()
+    monkeypatch.setattr(E.time, "monotonic", ret)
+    return ret
+
+# run one round of concurrent calls with the given latency, return the number of acquired ones
+def run_round(c, clock, latency, kind="success"):
+    starts = []
+    while True:
+        start, _ = c.try_acquire()
+        if start is None:
+            break
+        starts.append(start)
+    clock.now += latency
+    for start in starts:
+        c.release(start, kind)
+    return len(starts)
+
+def test_error_info():
+    assert get_error_info(HttpStatusError("x", 429, {"Retry-After": "3"})) == ("throttle", 3.)
+    assert get_error_info(HttpStatusError("x", 503)) == ("failure", None)
+    assert get_error_info(HttpStatusError("x", 400)) == ("other", None)
+    assert get_error_info(TimeoutError()) == ("failure", None)
+    assert parse_retry_after({"retry-after-ms": "1500"}) == 1.5
+
+def test_aimd(clock):
+    c = EndpointController(init_limit=8, decrease_cooldown=0.)
+    assert run_round(c, clock, 1.) == 8
+    assert c.limit > 8  # additive increase when the limit is reached
+    c.release(c.try_acquire()[0], "throttle", retry_after=2.)
+    assert c.limit < 5  # multiplicative decrease
+    assert c.try_acquire() == (None, pytest.approx(2.))  # paused by retry-after
+    clock.now += 2.
+    assert c.try_acquire()[0] is not None
+
+def test_decrease_cooldown(clock):
+    c = EndpointController(init_limit=16, decrease_cooldown=2.)
+    for _ in range(3):
+        c.release(c.try_acquire()[0], "throttle", retry_after=0.)
+    assert c.limit == 8.  # at most one decrease in the window
+
+def test_latency_signal_recovers(clock):
+    c = EndpointController(init_limit=8, decrease_cooldown=0., latency_tolerance=3.)
+    for _ in range(30):
+        run_round(c, clock, 0.5)
+    for _ in range(100):  # a slower regime (such as longer outputs): decreases first, but the baseline follows
+        run_round(c, clock, 5.)
+    _limit = c.limit
+    for _ in range(20):
+        run_round(c, clock, 5.)
+    assert c.limit > _limit  # additive increase resumes
+    assert EndpointController().latency_tolerance == 0.  # ignored by default
+
+def test_token_bucket(clock):
+    c = EndpointController(rate=2., burst=3)
+    assert [c.try_acquire()[0] is not None for _ in range(4)] == [True, True, True, False]
+    _, wait = c.try_acquire()
+    assert wait == pytest.approx(0.5)
+    clock.now += 0.5
+    assert c.try_acquire()[0] is not None
+
+def test_circuit_breaker(clock):
+    c = EndpointController(failure_threshold=3, open_time=10., eject_health=0.)
+    for _ in range(3):
+        c.release(c.try_acquire()[0], "failure")
+    assert c.circuit == "open"
+    assert c.try_acquire() == (None, pytest.approx(10.))
+    clock.now += 10.
+    start, _ = c.try_acquire()  # the probe
+    assert start is not None and c.circuit == "half_open"
+    assert c.try_acquire()[0] is None  # only one probe at a time
+    c.release(start, "failure")  # failed again: wait longer
+    assert c.circuit == "open" and c.curr_open_time == 20.
+    clock.now += 20.
+    c.release(c.try_acquire()[0], "success")
+    assert c.circuit == "closed" and c.curr_open_time == 10.
+
+def test_select(clock):
+    good, bad = EndpointController(name="good"), EndpointController(name="bad", failure_threshold=1)
+    bad.release(bad.try_acquire()[0], "failure")
+    assert all(EndpointController.select([bad, good]) == 1 for _ in range(5))
@@ -0,0 +1,67 @@
+#
+
+import time
+import threading
+import pytest
+from ck_pro.agents.sandbox import SandboxPool
+from ck_pro.agents.cancel import get_cancel_token
+from ck_pro.agents.tool import ParallelTool
+
+@pytest.fixture(scope="module")
+def pool():
+    ret = SandboxPool(enabled=True, size=1, preload_modules=[], memory_limit_mb=0)
+    yield ret
+    ret.shutdown()
+
+def get_executor(pool, **functions):
+    executor = pool.get_executor()
+    executor.add_global_vars(**functions)
+    return executor
+
+def test_proxied_calls(pool):
+    calls = []
+    def lookup(key, suffix=""):  # runs in this process
+        calls.append(key)
+        return {"key": key + suffix, "pid_thread": threading.current_thread().name}
+    def fail():
+        raise KeyError("missing")
+    executor = get_executor(pool, lookup=lookup, fail=fail)
+    executor.run("r = lookup('a', suffix='!')\nprint(r['key'])\ntry:\n  fail()\nexcept KeyError as e:\n  print(f'caught {e}')")
+    assert executor.get_print_results() == ["a!", "caught 'missing'"]
+    assert calls == ["a"]
+
+def test_concurrent_calls(pool):
+    def slow(x):
+        time.sleep(0.3)
+        return x * 2
+    executor = get_executor(pool, slow=slow, parallel=ParallelTool(max_workers=4))  # note: the parallel tool runs in the worker, while the calls inside are proxied
+    t0 = time.perf_counter()
+    executor.run("print(parallel([lambda i=i: slow(i) for i in range(4)]))")
+    assert executor.get_print_results() == [0, 2, 4, 6]
+    assert time.perf_counter() - t0 < 1.  # the proxied calls run concurrently
+
+def test_errors_in_code(pool):
+    executor = get_executor(pool)
+    executor.run("print('before')\n1 / 0")
+    _out = "\n".join(executor.results)
+    assert "before" in _out and "ZeroDivisionError" in _out
+
+def test_timeout_kills_worker_and_cancels_calls(pool):
+    tokens = []
+    def wait_long():
+        token = get_cancel_token()
+        tokens.append(token)
+        for _ in range(100):
+            if token.cancelled:
+                return "cancelled"
+            time.sleep(0.05)
+        return "finished"
+    executor = get_executor(pool, wait_long=wait_long)
+    t0 = time.perf_counter()
+    executor.run("print(wait_long())", timeout=1)
+    assert time.perf_counter() - t0 < 3.
+    assert "sandbox process is killed" in "\n".join(executor.results)
+    assert tokens and tokens[0].cancelled  # the still running call is stopped
+    executor = get_executor(pool)  # a new worker is used for the next run
+    executor.run("print('ok')")
+    assert executor.get_print_results() == "ok"
@@ -0,0 +1,77 @@
+#
+
+import json
+from ck_pro.agents.session import AgentSession, decode_session_io, SEGS_KEY
+from ck_pro.agents.blob import BlobStore, BLOB_REF_KEY, get_default_blob_dir, yield_jsonl_with_blobs
+from ck_pro.agents.replay import ReplayStore
+
+SYSTEM = "\n".join(f"system line {ii}: " + "x" * 40 for ii in range(20))
+
+def get_messages(user: str):
+    return [{"role": "system", "content": SYSTEM}, {"role": "user", "content": user}]
+
+def test_compact_io_roundtrip():
+    session = AgentSession(task="t")
+    m0, m1 = get_messages("short"), get_messages("a longer user message that is above the min length\nwith two lines")
+    e0, e1 = session.encode_io(m0), session.encode_io(m1)
+    assert e0[1]["content"] == "short"  # short strings are kept as they are
+    assert e0[0]["content"] == {SEGS_KEY: [[0, 19]]}  # merged into one run
+    assert e1[0]["content"] == e0[0]["content"]  # the shared lines are stored once
+    assert len(session.io_segments) == 22
+    data = session.to_dict()
+    data["steps"] = [{"plan": {"llm_input": e0}}, {"sub": {"session": {"io_segments": ["other"], "x": {SEGS_KEY: [0]}}}}, {"action": {"llm_input": e1}}]
+    decoded = decode_session_io(json.loads(json.dumps(data)))
+    assert decoded["steps"][0]["plan"]["llm_input"] == m0
+    assert decoded["steps"][2]["action"]["llm_input"] == m1
+    assert decoded["steps"][1]["sub"]["session"]["x"] == "other"  # the sub-agents' sessions use their own segments
+
+def test_compact_io_after_reload():
+    session = AgentSession(task="t")
+    session.encode_io(get_messages("x" * 100))
+    session2 = AgentSession.init_from_dict(json.loads(json.dumps(session.to_dict())))
+    _n = len(session2.io_segments)
+    e = session2.encode_io(get_messages("x" * 100))  # the index is rebuilt from the loaded segments
+    assert len(session2.io_segments) == _n
+    assert decode_session_io({"io_segments": session2.io_segments, "m": e})["m"] == get_messages("x" * 100)
+
+def test_blob_dedup_rehydrate(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"), min_size=100)
+    big = "screenshot" * 50
+    obj = {"a": big, "b": [big, "small"], "c": 1, "d": ("t", big)}
+    deduped = store.dedup(obj)
+    assert deduped["a"] == deduped["b"][0] == deduped["d"][1]
+    assert list(deduped["a"].keys()) == [BLOB_REF_KEY]
+    assert deduped["b"][1] == "small" and deduped["c"] == 1
+    assert len(list((tmp_path / "blobs").rglob("*"))) == 2  # stored once (one sub-dir and one file)
+    assert store.rehydrate(json.loads(json.dumps(deduped))) == {"a": big, "b": [big, "small"], "c": 1, "d": ["t", big]}
+    missing = {BLOB_REF_KEY: "00" * 32}
+    assert store.rehydrate({"m": missing}) == {"m": missing}  # missing ones are kept
+
+def test_blob_jsonl(tmp_path):
+    file = str(tmp_path / "out.jsonl")
+    store = BlobStore(get_default_blob_dir(file), min_size=10)
+    with open(file, "w") as fd:
+        fd.write(json.dumps(store.dedup({"v": "y" * 20})) + "\n")
+    assert list(yield_jsonl_with_blobs(file)) == [{"v": "y" * 20}]
+    assert BlobStore.find_for_file(str(tmp_path / "other.jsonl")) is None
+
+def test_replay_matching(tmp_path):
+    session = AgentSession(task="t")
+    m0, m1 = get_messages("first"), get_messages("second " * 20)
+    data = session.to_dict()
+    data["steps"] = [
+        {"plan": {"llm_input": session.encode_io(m0), "llm_output": "out0"}},
+        {"action": {"llm_input": session.encode_io(m0), "llm_output": "out0b"}},  # the same input again
+        {"action": {"observation": {"session": {"steps": [{"plan": {"llm_input": m1, "llm_output": "sub_out"}}]}}}},  # in a sub-agent's session
+    ]
+    data["io_segments"] = session.io_segments
+    file = str(tmp_path / "out.jsonl")
+    store = BlobStore(get_default_blob_dir(file), min_size=100)
+    with open(file, "w") as fd:
+        fd.write(json.dumps({"session": store.dedup(data)}) + "\n")
+    replay = ReplayStore([str(tmp_path)])
+    assert replay.get(m0) == (True, "out0")
+    assert replay.get(m0) == (True, "out0b")  # repeated inputs are replayed in order
+    assert replay.get(m0) == (True, "out0")  # cycling
+    assert replay.get(m1) == (True, "sub_out")
+    assert replay.get(get_messages("unknown")) == (False, None)
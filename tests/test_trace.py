@@ -0,0 +1,65 @@
+#
+
+import json
+import threading
+import contextvars
+import pytest
+from ck_pro.agents.trace import Tracer, start_span, trace_span, set_current_span, reset_current_span, traced_tool_call
+
+def test_no_tracing():
+    assert start_span("x") is None
+    with trace_span("x") as span:
+        assert span is None
+
+def test_spans(tmp_path):
+    tracer = Tracer()
+    root = tracer.start_span("agent.run", agent="a")
+    ctx_token = set_current_span(root)
+    try:
+        with trace_span("agent.step", idx=0) as step:
+            with trace_span("llm.call") as call:
+                call.set(prompt_tokens=10)
+            _ctx = contextvars.copy_context()  # the span is passed to the other threads with the context
+            th = threading.Thread(target=_ctx.run, args=(lambda: start_span("web.request").end(),))
+            th.start()
+            th.join()
+        with pytest.raises(ValueError):
+            with trace_span("tool.call"):
+                raise ValueError()
+    finally:
+        reset_current_span(ctx_token)
+    root.end()
+    spans = {z["name"]: z for z in tracer.to_list()}
+    assert spans["agent.run"]["parent"] is None and spans["agent.run"]["attrs"] == {"agent": "a"}
+    assert spans["agent.step"]["parent"] == spans["agent.run"]["id"]
+    assert spans["llm.call"]["parent"] == spans["web.request"]["parent"] == spans["agent.step"]["id"]
+    assert spans["llm.call"]["attrs"] == {"prompt_tokens": 10}
+    assert spans["tool.call"]["attrs"] == {"error": "ValueError"}
+    assert spans["web.request"]["tid"] != spans["llm.call"]["tid"]
+    assert all(z["dur"] >= 0 and z["start"] >= 0 for z in spans.values())
+    assert spans["agent.run"]["dur"] >= spans["agent.step"]["dur"]
+    # --
+    path = str(tmp_path / "sub" / "trace.json")
+    tracer.save(path)
+    with open(path) as fd:
+        chrome = json.load(fd)
+    events = {z["name"]: z for z in chrome["traceEvents"]}
+    assert len(events) == 5 and all(z["ph"] == "X" for z in events.values())
+    assert events["llm.call"]["cat"] == "llm" and events["llm.call"]["args"]["prompt_tokens"] == 10
+    assert len({z["tid"] for z in events.values()}) == 2  # thread ids are renumbered
+
+def test_traced_tool_call():
+    class Tool:
+        name = "search"
+
+        @traced_tool_call
+        def __call__(self, x):
+            return x + 1
+
+    tracer = Tracer()
+    ctx_token = set_current_span(tracer.start_span("agent.run"))
+    try:
+        assert Tool()(1) == 2
+    finally:
+        reset_current_span(ctx_token)
+    assert [(z["name"], z["attrs"]) for z in tracer.to_list()][1] == ("tool.call", {"tool": "search"})
@@ -0,0 +1,67 @@
+#
+
+import time
+import signal
+import threading
+from ck_pro.agents.utils import CodeExecutor, ExecWatchdog, run_parallel
+
+def run_code(code, timeout):
+    executor = CodeExecutor()
+    t0 = time.perf_counter()
+    executor.run(code, timeout=timeout)
+    return time.perf_counter() - t0, str(executor.get_print_results())
+
+def run_in_thread(func):
+    ret = []
+    th = threading.Thread(target=lambda: ret.append(func()))
+    th.start()
+    th.join()
+    return ret[0]
+
+def test_main_thread_blocking_call():
+    _t, _out = run_code("import time\ntime.sleep(5)\nprint('done')", 1)  # interrupted by SIGALRM
+    assert _t < 3 and "exceeded timeout" in _out and "done" not in _out
+    assert signal.getitimer(signal.ITIMER_REAL) == (0., 0.)  # cleared
+
+def test_other_thread():
+    _t, _out = run_in_thread(lambda: run_code("while True:\n  pass", 1))
+    assert _t < 3 and "exceeded timeout" in _out
+
+def test_swallowed_timeout():
+    _code = "import time\nwhile True:\n  try:\n    time.sleep(0.05)\n  except Exception:\n    pass"
+    _t, _out = run_in_thread(lambda: run_code(_code, 1))  # re-raised as ExecTimeoutExit
+    assert _t < 4 and "forced exit" in _out
+
+def test_no_stray_exception():
+    def _body():
+        for _ in range(200):
+            watchdog = ExecWatchdog(0.001, repeat_interval=0.001)
+            try:
+                watchdog.start()
+                sum(range(1000))
+            except BaseException:
+                pass
+            finally:
+                watchdog.stop()
+        time.sleep(0.3)  # nothing is fired after stopping
+        return "clean"
+    assert run_in_thread(_body) == "clean"
+    assert _body() == "clean"
+
+def test_not_stopped():
+    def _guarded(watchdog):
+        watchdog.start()  # as if stop() is skipped
+    def _body():
+        _guarded(ExecWatchdog(0.05, repeat_interval=0.05))
+        time.sleep(0.3)  # the guarded frame is left, so nothing is fired
+        return "clean"
+    assert run_in_thread(_body) == "clean"
+    assert _body() == "clean"
+
+def test_run_parallel():
+    _t0 = time.perf_counter()
+    ret = run_parallel([lambda: time.sleep(0.3) or 1, (max, 2, 3), "precomputed", lambda: 1 / 0], max_workers=4)
+    assert time.perf_counter() - _t0 < 1
+    assert ret[:3] == [1, 3, "precomputed"] and ret[3].startswith("Error: ZeroDivisionError")
+    ret = run_parallel([lambda: [None for _ in iter(int, 1)], lambda: 2], timeout=1)  # note: a python-level loop, a blocking C call is not interrupted in the other threads
+    assert ret[0].startswith("Error: ExecTimeoutError") and ret[1] == 2